@@ -0,0 +1,460 @@
+"""Сквозной бенчмарк обработки обновлений.
+
+Заполняет временную БД SQLite (benchmarks/seed.py) и прогоняет через
+dp.feed_update настоящего диспетчера из main.py сценарии пользователей:
+регистрация, продажа, просмотр и покупка, отзыв, спор, меню, статистика
+администратора. Бот работает с MockSession: запросы к Telegram не
+выполняются, а следующее нажатие сценарий выбирает по клавиатуре последнего
+ответа бота. Обновления одного пользователя идут последовательно, разные
+пользователи - параллельно (до --concurrency сценариев).
+
+Для каждого обработчика считаются число обновлений, ошибки, задержка
+(p50/p95/p99) и SQL-запросы на обновление, для всего прогона - пропускная
+способность. Результат пишется в JSON; с --baseline в него добавляется
+сравнение с прошлым запуском.
+
+    python -m benchmarks.flows --users 1000 --listings 5000 --sessions 2000 --output bench.json
+    python -m benchmarks.flows --output new.json --baseline bench.json --fail-on-regression
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Dict, List, Optional
+
+# telegram_id пользователей, которые регистрируются во время прогона
+NEW_USER_BASE = 900_000
+# Сценарии и их доли по умолчанию
+DEFAULT_MIX = "registration=1,sell=2,buy=4,review=1,dispute=1,menu=2,admin=0.5"
+
+_current: ContextVar[Optional[dict]] = ContextVar("bench_update", default=None)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--listings", type=int, default=5000)
+    parser.add_argument("--transactions", type=int, default=2000)
+    parser.add_argument("--reviews", type=int, default=1000)
+    parser.add_argument("--disputes", type=int, default=100)
+    parser.add_argument("--sessions", type=int, default=2000, help="число сценариев")
+    parser.add_argument("--warmup", type=int, default=100, help="сценариев до начала замеров")
+    parser.add_argument("--concurrency", type=int, default=8, help="одновременных сценариев")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="доли сценариев: имя=вес,...")
+    parser.add_argument("--telegram-latency", type=float, default=0.0, help="секунд на ответ MockSession")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--database-url", help="по умолчанию - временный файл SQLite")
+    parser.add_argument("--output", help="файл для JSON (по умолчанию - stdout)")
+    parser.add_argument("--baseline", help="JSON прошлого запуска для сравнения")
+    parser.add_argument("--max-slowdown", type=float, default=1.25,
+                        help="во сколько раз может вырасти p95 обработчика до регрессии")
+    parser.add_argument("--max-extra-queries", type=float, default=0.5,
+                        help="на сколько может вырасти среднее число SQL-запросов обработчика")
+    parser.add_argument("--min-samples", type=int, default=50,
+                        help="меньше обновлений у обработчика - p95 не сравнивается")
+    parser.add_argument("--fail-on-regression", action="store_true", help="код выхода 1 при регрессиях")
+    return parser.parse_args()
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    """Процентиль методом ближайшего ранга по отсортированному списку"""
+    if not values:
+        return 0.0
+    index = max(0, min(len(values) - 1, int(round(fraction * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def latency_summary(seconds: List[float]) -> dict:
+    values = sorted(seconds)
+    return {
+        "p50": round(percentile(values, 0.50) * 1000, 3),
+        "p95": round(percentile(values, 0.95) * 1000, 3),
+        "p99": round(percentile(values, 0.99) * 1000, 3),
+        "mean": round(sum(values) / len(values) * 1000, 3) if values else 0.0,
+        "max": round(values[-1] * 1000, 3) if values else 0.0,
+    }
+
+
+class Bench:
+    """Прогон сценариев и сбор замеров по обновлениям"""
+
+    def __init__(self, main, session, seeded, args):
+        from benchmarks.updates import UpdateFactory
+        from config import ADMIN_IDS
+
+        self.dp = main.dp
+        self.bot = main.bot
+        self.session = session
+        self.updates = UpdateFactory(main.bot)
+        self.rng = random.Random(args.seed)
+        self.admin_id = ADMIN_IDS[0] if ADMIN_IDS else None
+        self.user_ids = list(seeded.user_ids)
+        self.reviewers = list(seeded.reviewers)
+        self.disputers = list(seeded.disputers)
+        self.rng.shuffle(self.reviewers)
+        self.rng.shuffle(self.disputers)
+        self.new_user_ids = iter(range(NEW_USER_BASE, NEW_USER_BASE + 10 ** 6))
+        self._user_locks: Dict[int, asyncio.Lock] = {}
+        self.recording = False
+        self.samples: List[tuple] = []
+        self.scenarios: Dict[str, Dict[str, int]] = {}
+
+    # --- Отправка обновлений ---
+
+    async def send(self, step: str, update) -> None:
+        record = {"handler": None, "queries": 0}
+        token = _current.set(record)
+        error = None
+        started = time.perf_counter()
+        try:
+            await self.dp.feed_update(self.bot, update)
+        except Exception as e:
+            error = type(e).__name__
+        finally:
+            elapsed = time.perf_counter() - started
+            _current.reset(token)
+        if self.recording:
+            self.samples.append((step, record["handler"] or "unhandled", elapsed, record["queries"], error))
+
+    async def text(self, step: str, user_id: int, text: str):
+        await self.send(step, self.updates.text(user_id, text))
+
+    async def callback(self, step: str, user_id: int, data: str):
+        await self.send(step, self.updates.callback(user_id, data))
+
+    def pick(self, buttons: List[str], prefix: str = "", exclude: str = "❌ Отмена") -> Optional[str]:
+        choices = [b for b in buttons if b.startswith(prefix) and b != exclude]
+        return self.rng.choice(choices) if choices else None
+
+    # --- Сценарии; False - сценарий не дошел до конца (нет данных или бот ответил иначе) ---
+
+    async def registration(self, user_id: int) -> bool:
+        await self.text("start", user_id, "/start")
+        await self.text("registration", user_id, "🔄 Начать регистрацию")
+        await self.send("contact", self.updates.contact(user_id, f"+7999{user_id:07d}"))
+        return True
+
+    async def sell(self, user_id: int) -> bool:
+        await self.text("sell", user_id, "📱 Продать номер")
+        duration = self.pick(self.session.reply_buttons(user_id), "⏰")
+        if duration is None:
+            return False
+        await self.text("sell_duration", user_id, duration)
+        service = self.pick(self.session.reply_buttons(user_id))
+        if service is None:
+            return False
+        await self.text("sell_service", user_id, service)
+        await self.text("sell_price", user_id, f"{self.rng.uniform(1, 20):.2f}")
+        return True
+
+    async def buy(self, user_id: int) -> bool:
+        await self.text("buy_menu", user_id, "🛒 Купить номер")
+        await self.text("browse", user_id, self.rng.choice(["💰 Сначала дешевые", "💰 Сначала дорогие", "🔄 Сначала новые"]))
+        for _ in range(self.rng.randint(1, 5)):
+            if "next_listing" not in self.session.inline_buttons(user_id):
+                break
+            await self.callback("next", user_id, "next_listing")
+        purchase = self.pick(self.session.inline_buttons(user_id), "buy_")
+        if purchase is None:
+            return False
+        await self.callback("buy", user_id, purchase)
+        return True
+
+    async def review(self, user_id: int) -> bool:
+        await self.text("reviews", user_id, "⭐️ Отзывы")
+        transaction = self.pick(self.session.reply_buttons(user_id), "📝 Оставить отзыв")
+        if transaction is None:
+            return False
+        await self.text("review_transaction", user_id, transaction)
+        ratings = self.session.reply_buttons(user_id)
+        if not ratings:
+            return False
+        await self.text("review_rating", user_id, ratings[0])
+        await self.text("review_comment", user_id, "Все прошло хорошо")
+        return True
+
+    async def dispute(self, user_id: int) -> bool:
+        await self.text("disputes_menu", user_id, "⚠️ Споры")
+        await self.text("dispute_start", user_id, "📝 Открыть спор")
+        transaction = self.pick(self.session.reply_buttons(user_id), "📱")
+        if transaction is None:
+            return False
+        await self.text("dispute_description", user_id, transaction)
+        return True
+
+    async def menu(self, user_id: int) -> bool:
+        await self.text("profile", user_id, "👤 Профиль")
+        await self.text("balance", user_id, "💰 Баланс")
+        await self.text("my_disputes", user_id, "📋 Мои споры")
+        await self.text("my_reviews", user_id, "👤 Мои отзывы")
+        return True
+
+    async def admin(self, user_id: int) -> bool:
+        await self.text("admin_panel", user_id, "🔑 Панель администратора")
+        await self.text("admin_stats", user_id, "📊 Статистика")
+        await self.callback("admin_stats_window", user_id, self.rng.choice(["stats_7d", "stats_30d", "stats_all"]))
+        await self.text("admin_stats_command", user_id, "/stats 14")
+        await self.text("admin_disputes", user_id, "⚠️ Активные споры")
+        page = self.pick(self.session.inline_buttons(user_id), "disputes_after_")
+        if page is not None:
+            await self.callback("admin_disputes_page", user_id, page)
+        return True
+
+    # --- Выбор пользователей и запуск ---
+
+    def _user_for(self, scenario: str) -> Optional[int]:
+        if scenario == "registration":
+            return next(self.new_user_ids)
+        if scenario == "review":
+            return self.reviewers.pop() if self.reviewers else None
+        if scenario == "dispute":
+            return self.disputers.pop() if self.disputers else None
+        if scenario == "admin":
+            return self.admin_id
+        return self.rng.choice(self.user_ids)
+
+    async def run_scenario(self, scenario: str):
+        counts = self.scenarios.setdefault(scenario, {"runs": 0, "completed": 0, "skipped": 0})
+        user_id = self._user_for(scenario)
+        if user_id is None:
+            counts["skipped"] += 1
+            return
+        # Обновления одного пользователя обрабатываются по очереди, как в процессах-обработчиках
+        async with self._user_locks.setdefault(user_id, asyncio.Lock()):
+            completed = await getattr(self, scenario)(user_id)
+        if self.recording:
+            counts["runs"] += 1
+            counts["completed"] += int(completed)
+
+    async def run_many(self, scenarios: List[str], concurrency: int):
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def one(name: str):
+            async with semaphore:
+                await self.run_scenario(name)
+
+        await asyncio.gather(*(one(name) for name in scenarios))
+
+
+def _install_probes(dp):
+    """Счетчик SQL-запросов и имя обработчика для текущего обновления"""
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+    from services.text_router import TextCommandRouter
+
+    @event.listens_for(Engine, "before_cursor_execute")
+    def count_query(conn, cursor, statement, parameters, context, executemany):
+        record = _current.get()
+        if record is not None:
+            record["queries"] += 1
+
+    async def probe(handler, event, data):
+        record = _current.get()
+        handler_object = data.get("handler")
+        if record is not None and handler_object is not None:
+            callback = handler_object.callback
+            router = getattr(callback, "__self__", None)
+            if isinstance(router, TextCommandRouter):
+                callback = router.handlers[event.text].callback
+            record["handler"] = f"{callback.__module__.rsplit('.', 1)[-1]}.{callback.__name__}"
+        return await handler(event, data)
+
+    dp.message.middleware(probe)
+    dp.callback_query.middleware(probe)
+
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    weights = {}
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in ("registration", "sell", "buy", "review", "dispute", "menu", "admin"):
+            raise SystemExit(f"Неизвестный сценарий: {name}")
+        weights[name] = float(weight or 1)
+    return weights
+
+
+def summarize(bench: Bench, duration: float) -> dict:
+    handlers: Dict[str, dict] = {}
+    for step, handler, elapsed, queries, error in bench.samples:
+        entry = handlers.setdefault(handler, {"latency": [], "queries": [], "errors": 0, "steps": set()})
+        entry["latency"].append(elapsed)
+        entry["queries"].append(queries)
+        entry["steps"].add(step)
+        if error:
+            entry["errors"] += 1
+
+    all_latency = [sample[2] for sample in bench.samples]
+    all_queries = sum(sample[3] for sample in bench.samples)
+    return {
+        "totals": {
+            "updates": len(bench.samples),
+            "errors": sum(1 for sample in bench.samples if sample[4]),
+            "duration_s": round(duration, 3),
+            "updates_per_second": round(len(bench.samples) / duration, 1) if duration else 0.0,
+            "latency_ms": latency_summary(all_latency),
+            "queries": {
+                "total": all_queries,
+                "per_update": round(all_queries / len(bench.samples), 2) if bench.samples else 0.0,
+            },
+        },
+        "scenarios": bench.scenarios,
+        "handlers": {
+            name: {
+                "updates": len(entry["latency"]),
+                "errors": entry["errors"],
+                "steps": sorted(entry["steps"]),
+                "latency_ms": latency_summary(entry["latency"]),
+                "queries": {
+                    "mean": round(sum(entry["queries"]) / len(entry["queries"]), 2),
+                    "max": max(entry["queries"]),
+                },
+            }
+            for name, entry in sorted(handlers.items())
+        },
+        "telegram_requests": dict(sorted(bench.session.requests.items())),
+    }
+
+
+def compare(report: dict, baseline: dict, args) -> dict:
+    """Изменения относительно прошлого запуска и список регрессий"""
+    regressions = []
+    handlers = {}
+    for name, current in report["handlers"].items():
+        previous = baseline.get("handlers", {}).get(name)
+        if previous is None:
+            continue
+        p95_ratio = current["latency_ms"]["p95"] / max(previous["latency_ms"]["p95"], 0.001)
+        queries_delta = round(current["queries"]["mean"] - previous["queries"]["mean"], 2)
+        handlers[name] = {"p95_ratio": round(p95_ratio, 2), "queries_delta": queries_delta}
+        if p95_ratio > args.max_slowdown and min(current["updates"], previous["updates"]) >= args.min_samples:
+            regressions.append(f"{name}: p95 x{p95_ratio:.2f}")
+        if queries_delta > args.max_extra_queries:
+            regressions.append(f"{name}: +{queries_delta} SQL-запросов на обновление")
+
+    previous_rate = baseline.get("totals", {}).get("updates_per_second") or 0
+    throughput_ratio = report["totals"]["updates_per_second"] / previous_rate if previous_rate else None
+    if throughput_ratio is not None and throughput_ratio < 1 / args.max_slowdown:
+        regressions.append(f"пропускная способность x{throughput_ratio:.2f}")
+    return {
+        "baseline_started_at": baseline.get("meta", {}).get("started_at"),
+        "throughput_ratio": round(throughput_ratio, 2) if throughput_ratio is not None else None,
+        "handlers": handlers,
+        "regressions": regressions,
+    }
+
+
+def _versions() -> dict:
+    import aiogram
+    import sqlalchemy
+
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=5,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {
+        "git_commit": commit,
+        "python": platform.python_version(),
+        "aiogram": aiogram.__version__,
+        "sqlalchemy": sqlalchemy.__version__,
+    }
+
+
+async def run(args) -> dict:
+    import logging
+    logging.disable(logging.WARNING)
+
+    import main
+    from benchmarks.seed import seed_database
+    from benchmarks.updates import MockSession
+    from config import ADMIN_IDS
+    from database.db import engine, read_engine, init_db
+    from middlewares.database import CommitBeforeRequest
+
+    # Сессия без сети; ограничитель частоты из main.py остается на исходной сессии,
+    # коммит перед ответом переносится - он определяет, сколько держится запись
+    session = MockSession(args.telegram_latency)
+    session.middleware(CommitBeforeRequest())
+    main.bot.session = session
+    _install_probes(main.dp)
+
+    await init_db()
+    started = time.perf_counter()
+    seeded = await seed_database(
+        engine, args.users, args.listings, args.transactions, args.reviews, args.disputes,
+        admin_ids=ADMIN_IDS, seed=args.seed
+    )
+    seed_seconds = time.perf_counter() - started
+    await main.setup_worker()
+
+    bench = Bench(main, session, seeded, args)
+    weights = parse_mix(args.mix)
+    names = list(weights)
+    plan = bench.rng.choices(names, [weights[name] for name in names], k=args.warmup + args.sessions)
+
+    await bench.run_many(plan[:args.warmup], args.concurrency)
+    bench.recording = True
+    started = time.perf_counter()
+    await bench.run_many(plan[args.warmup:], args.concurrency)
+    duration = time.perf_counter() - started
+
+    report = {
+        "meta": {
+            "started_at": datetime.utcnow().isoformat(timespec="seconds"),
+            "args": {key: value for key, value in vars(args).items() if key not in ("output", "baseline")},
+            **_versions(),
+        },
+        "seed": {**seeded.counts, "seconds": round(seed_seconds, 2)},
+        **summarize(bench, duration),
+    }
+
+    await main.storage.close()
+    await engine.dispose()
+    await read_engine.dispose()
+    return report
+
+
+def main():
+    args = parse_args()
+    if args.database_url:
+        os.environ["DATABASE_URL"] = args.database_url
+    else:
+        tmpdir = tempfile.mkdtemp(prefix="roxort-bench-")
+        os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{os.path.join(tmpdir, 'bench.db')}"
+        os.environ["FSM_STORAGE_PATH"] = os.path.join(tmpdir, "fsm.db")
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    report = asyncio.run(run(args))
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            report["comparison"] = compare(report, json.load(f), args)
+
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+        totals = report["totals"]
+        print(f"{totals['updates']} обновлений, {totals['updates_per_second']} в секунду, "
+              f"p95 {totals['latency_ms']['p95']} мс -> {args.output}")
+    else:
+        print(output)
+
+    regressions = report.get("comparison", {}).get("regressions")
+    if regressions:
+        print("Регрессии:\n  " + "\n  ".join(regressions), file=sys.stderr)
+    return 1 if regressions and args.fail_on_regression else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,163 @@
+"""Нагрузочная проверка покупки объявлений одновременными покупателями.
+
+Создает отдельную БД с объявлениями и покупателями и запускает тысячи
+одновременных покупок (каждая - в своей сессии, как при обработке
+обновления). Затем проверяет инварианты: объявление продано не более одного
+раза, балансы не ушли в минус, списания равны сумме сделок и совпадают с
+журналом проводок.
+
+    python -m benchmarks.purchase_concurrency --buys 5000 --listings 500 --buyers 200
+    python -m benchmarks.purchase_concurrency --naive   # старая схема: проверка в Python
+
+Результат печатается в JSON.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--buys", type=int, default=5000, help="число покупок")
+    parser.add_argument("--listings", type=int, default=500)
+    parser.add_argument("--buyers", type=int, default=200)
+    parser.add_argument("--balance", type=float, default=20.0, help="начальный баланс покупателя")
+    parser.add_argument("--database-url", help="по умолчанию - временный файл SQLite")
+    parser.add_argument("--naive", action="store_true", help="чтение и проверка в Python, затем запись")
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args()
+
+
+async def naive_purchase(session, listing_id: int, buyer_id: int) -> str:
+    """Прежняя схема покупки: прочитать, проверить в Python, изменить объекты"""
+    from database.models import User, PhoneListing, Transaction
+    from database.ledger import to_minor
+
+    listing = await session.get(PhoneListing, listing_id)
+    buyer = await session.get(User, buyer_id)
+    if not listing.is_active:
+        return "unavailable"
+    if buyer.balance_minor < to_minor(listing.price):
+        return "insufficient_funds"
+    listing.is_active = False
+    buyer.balance_minor -= to_minor(listing.price)
+    session.add(Transaction(buyer_id=buyer_id, seller_id=listing.seller_id, listing_id=listing_id,
+                            amount=listing.price, status="pending"))
+    return "purchased"
+
+
+async def run(args):
+    from sqlalchemy import select, func, delete
+    from database.db import init_db, async_session, engine, read_engine
+    from database.models import User, PhoneListing, Transaction, LedgerEntry, LedgerCheckpoint
+    from database.trades import purchase_listing
+    from database.ledger import post, to_minor, from_minor, checkpoint_ledger, DEPOSIT
+
+    await init_db()
+    rng = random.Random(args.seed)
+
+    async with async_session() as session:
+        for model in (LedgerCheckpoint, LedgerEntry, Transaction, PhoneListing, User):
+            await session.execute(delete(model))
+        seller = User(telegram_id=1, username="seller")
+        session.add(seller)
+        await session.flush()
+        buyers = [User(telegram_id=1000 + i, username=f"buyer{i}") for i in range(args.buyers)]
+        session.add_all(buyers)
+        await session.flush()
+        for buyer in buyers:
+            await post(session, buyer.id, to_minor(args.balance), DEPOSIT, "benchmark")
+        listings = [PhoneListing(seller_id=seller.id, service="Telegram", duration=1,
+                                 price=round(rng.uniform(1, 10), 2), is_active=True)
+                    for _ in range(args.listings)]
+        session.add_all(listings)
+        await session.commit()
+        buyer_ids = [buyer.id for buyer in buyers]
+        listing_ids = [listing.id for listing in listings]
+
+    outcomes = {}
+    latencies = []
+
+    async def buy(listing_id, buyer_id):
+        started = time.perf_counter()
+        try:
+            async with async_session() as session:
+                if args.naive:
+                    status = await naive_purchase(session, listing_id, buyer_id)
+                else:
+                    status = (await purchase_listing(session, listing_id, buyer_id)).status
+                await session.commit()
+        except Exception as e:
+            status = f"error: {type(e).__name__}"
+        latencies.append(time.perf_counter() - started)
+        outcomes[status] = outcomes.get(status, 0) + 1
+
+    jobs = [(rng.choice(listing_ids), rng.choice(buyer_ids)) for _ in range(args.buys)]
+    started = time.perf_counter()
+    await asyncio.gather(*(buy(listing_id, buyer_id) for listing_id, buyer_id in jobs))
+    elapsed = time.perf_counter() - started
+
+    async with async_session() as session:
+        sold_twice = await session.scalar(
+            select(func.count()).select_from(
+                select(Transaction.listing_id).group_by(Transaction.listing_id)
+                .having(func.count() > 1).subquery()
+            )
+        )
+        negative = await session.scalar(select(func.count(User.id)).where(User.balance_minor < 0))
+        spent = await session.scalar(
+            select(func.coalesce(func.sum(to_minor(args.balance) - User.balance_minor), 0))
+            .where(User.id.in_(buyer_ids))
+        )
+        paid = sum(to_minor(amount) for amount in (await session.scalars(select(Transaction.amount))))
+        inactive_unsold = await session.scalar(
+            select(func.count(PhoneListing.id)).where(
+                PhoneListing.is_active == False,
+                PhoneListing.id.not_in(select(Transaction.listing_id))
+            )
+        )
+
+    latencies.sort()
+    report = {
+        "mode": "naive" if args.naive else "conditional",
+        "buys": args.buys,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_per_s": round(args.buys / elapsed, 1),
+        "p50_ms": round(latencies[len(latencies) // 2] * 1000, 2),
+        "p99_ms": round(latencies[int(len(latencies) * 0.99)] * 1000, 2),
+        "outcomes": outcomes,
+        "oversold_listings": sold_twice,
+        "negative_balances": negative,
+        "lost_debits": from_minor(paid - spent),
+        "inactive_without_sale": inactive_unsold,
+        "ledger_mismatches": len((await checkpoint_ledger()).mismatches),
+    }
+    await engine.dispose()
+    await read_engine.dispose()
+    return report
+
+
+def main():
+    args = parse_args()
+    tmpdir = None
+    if args.database_url:
+        os.environ["DATABASE_URL"] = args.database_url
+    else:
+        tmpdir = tempfile.mkdtemp(prefix="roxort-bench-")
+        os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{os.path.join(tmpdir, 'bench.db')}"
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    report = asyncio.run(run(args))
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    failed = (report["oversold_listings"] or report["negative_balances"] or report["lost_debits"]
+              or report["ledger_mismatches"])
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
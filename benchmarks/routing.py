@@ -0,0 +1,188 @@
+"""Стоимость маршрутизации нажатий кнопок.
+
+Собирает диспетчеры с фильтрами настоящих роутеров и пустыми обработчиками:
+    empty  - без обработчиков, только накладные расходы диспетчера;
+    before - прежняя схема: фильтр-лямбда на каждую кнопку в роутерах модулей,
+             дубли кнопок в main.py, состояния FSM как фильтры State;
+    after  - текущие роутеры (StateFilter) и TextCommandRouter последним.
+Для сравнения на одинаковом наборе кнопок в обоих вариантах подключены все
+модули, включая payments, ratings и admin. Обновления - сообщения с текстами
+кнопок и обычным текстом, который не совпадает ни с одной кнопкой. Обработка
+идет через dp.feed_update без обращений к Telegram и БД.
+
+    python -m benchmarks.routing --updates 20000 --free-text 0.1
+
+Результат печатается в JSON: время на обновление и его часть, приходящаяся
+на поиск обработчика кнопки (за вычетом empty).
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+# Порядок подключения роутеров в main.py
+MODULES = ("registration", "common", "selling", "buying", "disputes", "payments", "ratings", "admin")
+# Кнопки, которые main.py до TextCommandRouter обрабатывал сам
+MAIN_DUPLICATES = ("👤 Профиль", "💰 Баланс")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--updates", type=int, default=20000, help="обновлений на каждый вариант")
+    parser.add_argument("--free-text", type=float, default=0.1, help="доля сообщений не по кнопкам")
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--rounds", type=int, default=3, help="повторов; берется лучший")
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args()
+
+
+async def noop(message):
+    pass
+
+
+def mirror(router, name: str, button_filters=(), bare_states: bool = False):
+    """Роутер с фильтрами сообщений исходного роутера и пустыми обработчиками"""
+    from aiogram import Router
+    from aiogram.filters import StateFilter
+
+    copy = Router(name=name)
+    # Кнопки модуля объявлены выше его обработчиков состояний
+    for check in button_filters:
+        copy.message.register(noop, check)
+    for handler in router.message.handlers:
+        filters = []
+        for f in handler.filters or ():
+            if bare_states and isinstance(f.callback, StateFilter):
+                filters.extend(f.callback.states)
+            else:
+                filters.append(f.magic or f.callback)
+        copy.message.register(noop, *filters)
+    return copy
+
+
+def button_filter(text: str, checks: list = None):
+    if checks is None:
+        return lambda message: message.text == text
+
+    def check(message):
+        checks[0] += 1
+        return message.text == text
+    return check
+
+
+def build(variant: str, buttons: dict, checks: list = None):
+    from aiogram import Dispatcher
+    from services.text_router import TextCommandRouter
+    import handlers
+
+    dp = Dispatcher()
+    if variant == "empty":
+        return dp
+
+    if variant == "before":
+        for text in MAIN_DUPLICATES:
+            dp.message.register(noop, button_filter(text, checks))
+
+    for module in MODULES:
+        filters = [button_filter(text, checks) for text in buttons[module]] if variant == "before" else ()
+        dp.include_router(mirror(getattr(handlers, module).router, f"{module}-{variant}", filters,
+                                 bare_states=variant == "before"))
+
+    if variant == "after":
+        text_router = TextCommandRouter(name="text-after")
+        for module in MODULES:
+            for text in buttons[module]:
+                text_router.button(text)(noop)
+        dp.include_router(text_router)
+    return dp
+
+
+def make_updates(count: int, texts: list, free_text: float, users: int, rng: random.Random):
+    from aiogram.types import Update, Message, Chat, User
+
+    updates = []
+    now = datetime.utcnow()
+    for update_id in range(count):
+        user_id = rng.randint(1, users)
+        text = f"произвольный текст {update_id}" if rng.random() < free_text else rng.choice(texts)
+        updates.append(Update(update_id=update_id, message=Message(
+            message_id=update_id,
+            date=now,
+            chat=Chat(id=user_id, type="private"),
+            from_user=User(id=user_id, is_bot=False, first_name="bench"),
+            text=text
+        )))
+    return updates
+
+
+async def measure(dp, bot, updates, rounds: int) -> float:
+    best = None
+    for _ in range(rounds):
+        started = time.perf_counter()
+        for update in updates:
+            await dp.feed_update(bot, update)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+async def run(args):
+    from aiogram import Bot
+    import handlers.registration, handlers.common, handlers.selling, handlers.buying  # noqa: F401
+    import handlers.disputes, handlers.payments, handlers.ratings, handlers.admin  # noqa: F401
+    from services.text_router import text_router
+
+    buttons = {module: [] for module in MODULES}
+    for text, handler in text_router.handlers.items():
+        buttons[handler.callback.__module__.split(".")[-1]].append(text)
+    texts = list(text_router.handlers)
+
+    rng = random.Random(args.seed)
+    updates = make_updates(args.updates, texts, args.free_text, args.users, rng)
+    bot = Bot(token="42:BENCHMARK")
+
+    report = {"updates": args.updates, "buttons": len(texts), "free_text": args.free_text}
+    timings = {}
+    for variant in ("empty", "before", "after"):
+        dp = build(variant, buttons)
+        # Прогрев: первые обновления создают состояния FSM и кэши aiogram
+        await measure(dp, bot, updates[:200], 1)
+        elapsed = await measure(dp, bot, updates, args.rounds)
+        timings[variant] = elapsed / args.updates * 1e6
+        report[variant] = {
+            "us_per_update": round(timings[variant], 2),
+            "updates_per_second": round(args.updates / elapsed),
+        }
+
+    # Число проверенных фильтров кнопок считается отдельным проходом, чтобы счетчик не влиял на время
+    checks = [0]
+    await measure(build("before", buttons, checks), bot, updates, 1)
+    report["before"]["button_filters_per_update"] = round(checks[0] / args.updates, 1)
+
+    for variant in ("before", "after"):
+        report[variant]["routing_us_per_update"] = round(timings[variant] - timings["empty"], 2)
+    report["routing_speedup"] = round(
+        report["before"]["routing_us_per_update"] / max(report["after"]["routing_us_per_update"], 0.01), 1
+    )
+    await bot.session.close()
+    return report
+
+
+def main():
+    args = parse_args()
+    # Обработчики импортируют модули БД; сами запросы в бенчмарке не выполняются
+    os.environ.setdefault("DATABASE_URL", f"sqlite+aiosqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}")
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    report = asyncio.run(run(args))
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,170 @@
+"""Заполнение БД для бенчмарков.
+
+Создает пользователей, объявления, сделки, отзывы и споры пачками INSERT
+в одной транзакции. Данные согласованы: у каждого пользователя есть
+проводка открытия баланса в ledger, счетчики профиля и рейтинг посчитаны по
+сделкам и отзывам, сводки статистики пересчитаны из таблиц.
+"""
+import random
+from datetime import datetime, timedelta
+from typing import List, NamedTuple
+
+from sqlalchemy import insert
+from sqlalchemy.engine import Connection
+
+# telegram_id заполненных пользователей: USER_ID_BASE + номер
+USER_ID_BASE = 100_000
+
+
+class Seeded(NamedTuple):
+    user_ids: List[int]  # telegram_id всех заполненных пользователей
+    reviewers: List[int]  # покупатели с завершенной за неделю сделкой без отзыва
+    disputers: List[int]  # покупатели с незавершенной сделкой
+    counts: dict
+
+
+def _seed(conn: Connection, users: int, listings: int, transactions: int, reviews: int, disputes: int,
+          balance: float, admin_ids: List[int], rng: random.Random) -> Seeded:
+    from config import RENTAL_PERIODS
+    from database.ledger import to_minor, OPENING
+    from database.models import User, PhoneListing, Transaction, Review, Dispute, LedgerEntry, UserRole
+    from database.rollups import rebuild_rollups
+    from handlers.selling import available_services
+
+    now = datetime.utcnow()
+    transactions = min(transactions, listings)
+    disputes = min(disputes, transactions)
+    balance_minor = to_minor(balance)
+
+    telegram_ids = [USER_ID_BASE + i for i in range(users)]
+    telegram_ids += [a for a in admin_ids if a not in set(telegram_ids)]
+    user_rows = [{
+        "id": index + 1,
+        "telegram_id": telegram_id,
+        "username": f"user{telegram_id}",
+        "phone_number": f"+7900{telegram_id:07d}",
+        "balance_minor": balance_minor,
+        "rating": 5.0,
+        "role": UserRole.ADMIN if telegram_id in admin_ids else UserRole.USER,
+        "registered_at": now - timedelta(minutes=rng.randint(60, 30 * 24 * 60)),
+        "sold_count": 0,
+        "bought_count": 0,
+        "reviews_count": 0,
+        "rating_sum": 0,
+        "trade_volume": 0.0,
+    } for index, telegram_id in enumerate(telegram_ids)]
+    users = len(user_rows)
+
+    listing_rows = [{
+        "id": index + 1,
+        "seller_id": rng.randint(1, users),
+        "service": rng.choice(available_services),
+        "duration": rng.choice(RENTAL_PERIODS),
+        "price": round(rng.uniform(1, 20), 2),
+        "is_active": True,
+        # Моложе LISTING_TTL, чтобы объявления не снимались очисткой
+        "created_at": now - timedelta(minutes=rng.randint(1, 48 * 60)),
+    } for index in range(listings)]
+
+    transaction_rows = []
+    for index, listing in enumerate(rng.sample(listing_rows, transactions)):
+        listing["is_active"] = False
+        buyer_id = rng.randint(1, users)
+        if buyer_id == listing["seller_id"]:
+            buyer_id = buyer_id % users + 1
+        created_at = listing["created_at"] + timedelta(minutes=rng.randint(1, 60))
+        if index < disputes:
+            status = "disputed"
+        else:
+            status = "completed" if rng.random() < 0.75 else "pending"
+        transaction_rows.append({
+            "id": index + 1,
+            "buyer_id": buyer_id,
+            "seller_id": listing["seller_id"],
+            "listing_id": listing["id"],
+            "amount": listing["price"],
+            "status": status,
+            "created_at": created_at,
+            "completed_at": created_at + timedelta(minutes=30) if status == "completed" else None,
+        })
+
+    completed = [tx for tx in transaction_rows if tx["status"] == "completed"]
+    for tx in completed:
+        user_rows[tx["seller_id"] - 1]["sold_count"] += 1
+        user_rows[tx["buyer_id"] - 1]["bought_count"] += 1
+        user_rows[tx["seller_id"] - 1]["trade_volume"] += tx["amount"]
+        user_rows[tx["buyer_id"] - 1]["trade_volume"] += tx["amount"]
+
+    review_rows = []
+    for index, tx in enumerate(rng.sample(completed, min(reviews, len(completed)))):
+        rating = rng.randint(1, 5)
+        review_rows.append({
+            "id": index + 1,
+            "transaction_id": tx["id"],
+            "reviewer_id": tx["buyer_id"],
+            "reviewed_id": tx["seller_id"],
+            "rating": rating,
+            "comment": "Все хорошо" if rating > 3 else "Были проблемы",
+            "created_at": tx["completed_at"] + timedelta(minutes=10),
+        })
+        reviewed = user_rows[tx["seller_id"] - 1]
+        reviewed["reviews_count"] += 1
+        reviewed["rating_sum"] += rating
+        reviewed["rating"] = reviewed["rating_sum"] / reviewed["reviews_count"]
+
+    dispute_rows = [{
+        "id": index + 1,
+        "transaction_id": tx["id"],
+        "initiator_id": tx["buyer_id"],
+        "description": f"📱 Спор по сделке (ID: {tx['id']})",
+        "status": "open",
+        "created_at": tx["created_at"] + timedelta(minutes=5),
+    } for index, tx in enumerate(transaction_rows[:disputes])]
+
+    ledger_rows = [{
+        "user_id": row["id"],
+        "amount_minor": balance_minor,
+        "balance_after_minor": balance_minor,
+        "kind": OPENING,
+        "ref": "seed",
+        "created_at": row["registered_at"],
+    } for row in user_rows]
+
+    for model, rows in ((User, user_rows), (PhoneListing, listing_rows), (Transaction, transaction_rows),
+                        (Review, review_rows), (Dispute, dispute_rows), (LedgerEntry, ledger_rows)):
+        if rows:
+            conn.execute(insert(model), rows)
+    rebuild_rollups(conn)
+
+    week_ago = now - timedelta(days=7)
+    reviewed_ids = {row["transaction_id"] for row in review_rows}
+    reviewers = sorted({
+        telegram_ids[tx["buyer_id"] - 1] for tx in completed
+        if tx["id"] not in reviewed_ids and tx["completed_at"] >= week_ago
+    })
+    disputers = sorted({telegram_ids[tx["buyer_id"] - 1] for tx in transaction_rows if tx["status"] == "pending"})
+
+    return Seeded(
+        user_ids=telegram_ids,
+        reviewers=reviewers,
+        disputers=disputers,
+        counts={
+            "users": users,
+            "listings": len(listing_rows),
+            "active_listings": sum(1 for row in listing_rows if row["is_active"]),
+            "transactions": len(transaction_rows),
+            "reviews": len(review_rows),
+            "disputes": len(dispute_rows),
+        }
+    )
+
+
+async def seed_database(engine, users: int = 1000, listings: int = 5000, transactions: int = 2000,
+                        reviews: int = 1000, disputes: int = 100, balance: float = 100.0,
+                        admin_ids: List[int] = (), seed: int = 1) -> Seeded:
+    """Заполняет пустую БД (схема уже создана init_db)"""
+    rng = random.Random(seed)
+    async with engine.begin() as conn:
+        return await conn.run_sync(
+            _seed, users, listings, transactions, reviews, disputes, balance, list(admin_ids), rng
+        )
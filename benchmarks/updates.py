@@ -0,0 +1,110 @@
+"""Синтетические обновления и сессия бота без сети для бенчмарков.
+
+MockSession отвечает на запросы бота так, как ответил бы Telegram
+(sendMessage и editMessageText возвращают сообщение, остальное - True), и
+запоминает последнее сообщение, отправленное в каждый чат: по его
+клавиатуре сценарий выбирает следующее нажатие, как это сделал бы
+пользователь.
+"""
+import asyncio
+import itertools
+import time
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import SendMessage, EditMessageText
+from aiogram.types import Update, Message, Chat, ReplyKeyboardMarkup, InlineKeyboardMarkup
+
+
+class MockSession(BaseSession):
+    def __init__(self, latency: float = 0.0):
+        super().__init__()
+        # Имитация времени ответа Telegram
+        self.latency = latency
+        self.requests: Dict[str, int] = {}
+        self.last_sent: Dict[int, SendMessage] = {}
+        self._message_ids = itertools.count(1)
+
+    async def make_request(self, bot, method, timeout: Optional[int] = None):
+        name = type(method).__name__
+        self.requests[name] = self.requests.get(name, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if isinstance(method, (SendMessage, EditMessageText)):
+            chat_id = int(method.chat_id or 0)
+            if isinstance(method, SendMessage):
+                self.last_sent[chat_id] = method
+            return Message(
+                message_id=next(self._message_ids),
+                date=datetime.utcnow(),
+                chat=Chat(id=chat_id, type="private"),
+                text=method.text
+            )
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b""
+
+    async def close(self):
+        pass
+
+    def reply_buttons(self, chat_id: int) -> List[str]:
+        """Тексты кнопок обычной клавиатуры последнего сообщения в чат"""
+        sent = self.last_sent.get(chat_id)
+        if sent is None or not isinstance(sent.reply_markup, ReplyKeyboardMarkup):
+            return []
+        return [button.text for row in sent.reply_markup.keyboard for button in row]
+
+    def inline_buttons(self, chat_id: int) -> List[str]:
+        """callback_data кнопок под последним сообщением в чат"""
+        sent = self.last_sent.get(chat_id)
+        if sent is None or not isinstance(sent.reply_markup, InlineKeyboardMarkup):
+            return []
+        return [button.callback_data for row in sent.reply_markup.inline_keyboard for button in row
+                if button.callback_data]
+
+
+class UpdateFactory:
+    """Обновления от пользователей в личном чате с ботом.
+
+    Обновления собираются из JSON, как при получении от Telegram, и сразу
+    привязываются к боту - feed_update не пересоздает их.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self._ids = itertools.count(1)
+
+    @staticmethod
+    def _user(user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": "Bench", "username": f"user{user_id}"}
+
+    def _message(self, user_id: int, **fields) -> dict:
+        return {
+            "message_id": next(self._ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": self._user(user_id),
+            **fields
+        }
+
+    def _update(self, **fields) -> Update:
+        return Update.model_validate({"update_id": next(self._ids), **fields}, context={"bot": self.bot})
+
+    def text(self, user_id: int, text: str) -> Update:
+        return self._update(message=self._message(user_id, text=text))
+
+    def contact(self, user_id: int, phone_number: str) -> Update:
+        contact = {"phone_number": phone_number, "first_name": "Bench", "user_id": user_id}
+        return self._update(message=self._message(user_id, contact=contact))
+
+    def callback(self, user_id: int, data: str) -> Update:
+        return self._update(callback_query={
+            "id": str(next(self._ids)),
+            "from": self._user(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": self._message(user_id, text="...")
+        })
@@ -6,11 +6,70 @@ load_dotenv()
 # Токен бота
 BOT_TOKEN = "8129643535:AAEN6aiJ6R-dE-BXA76CgewnpEVbSys597o"
 
+# Режим получения обновлений: "polling" (long polling) или "webhook"
+BOT_MODE = os.getenv('BOT_MODE', "polling")
+TELEGRAM_WEBHOOK_URL = os.getenv('TELEGRAM_WEBHOOK_URL', "")  # внешний адрес, например https://example.com
+TELEGRAM_WEBHOOK_PATH = os.getenv('TELEGRAM_WEBHOOK_PATH', "/telegram/webhook")
+TELEGRAM_WEBHOOK_SECRET = os.getenv('TELEGRAM_WEBHOOK_SECRET', "")
+WEBHOOK_CONCURRENCY = int(os.getenv('WEBHOOK_CONCURRENCY', 32))  # одновременно обрабатываемых обновлений
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', 1000))
+WEBHOOK_STATS_PATH = "/telegram/stats"
+
+# Обработка обновлений в нескольких процессах (1 - в одном процессе)
+WORKERS = int(os.getenv('WORKERS', 1))
+WORKER_CONCURRENCY = int(os.getenv('WORKER_CONCURRENCY', 32))  # одновременно обрабатываемых обновлений в процессе
+WORKER_STATS_INTERVAL = 5  # секунд между отчетами процессов
+WORKERS_STATS_PATH = "/workers/stats"
+LISTING_INDEX_REFRESH = int(os.getenv('LISTING_INDEX_REFRESH', 30))  # секунд между перечитыванием индекса объявлений в процессах
+
 # ID администраторов (используем числовой ID)
 ADMIN_IDS = [1396514552]  # @ASKIRYK
 
 # Настройки базы данных
 DATABASE_URL = os.getenv('DATABASE_URL', "sqlite+aiosqlite:///database.db")
+DATABASE_READ_URL = os.getenv('DATABASE_READ_URL', "")  # реплика для чтения, по умолчанию DATABASE_URL
+DB_ECHO = os.getenv('DB_ECHO', "0") == "1"  # логирование всех SQL-запросов
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 10))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 30))  # секунд ожидания свободного соединения
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', 1800))  # секунд жизни соединения (Postgres)
+SQLITE_BUSY_TIMEOUT = int(os.getenv('SQLITE_BUSY_TIMEOUT', 5000))  # мс ожидания блокировки
+SQLITE_CACHE_SIZE = int(os.getenv('SQLITE_CACHE_SIZE', -64000))  # отрицательное значение - в КиБ
+SQLITE_MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))
+
+# Хранилище состояний FSM
+FSM_STORAGE_PATH = os.getenv('FSM_STORAGE_PATH', "fsm.db")
+FSM_CACHE_SIZE = int(os.getenv('FSM_CACHE_SIZE', 10000))  # 0 - без кэша, запись сразу в файл
+FSM_FLUSH_INTERVAL = float(os.getenv('FSM_FLUSH_INTERVAL', 1))  # секунд между сбросами кэша
+FSM_TTL = int(os.getenv('FSM_TTL', 24 * 60 * 60))  # брошенные диалоги удаляются через сутки
+
+# Кэш пользователей по telegram_id
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 10000))  # 0 - без кэша
+USER_CACHE_TTL = int(os.getenv('USER_CACHE_TTL', 60))  # секунд
+
+# Сверка балансов с проводками ledger
+LEDGER_CHECKPOINT_INTERVAL = int(os.getenv('LEDGER_CHECKPOINT_INTERVAL', 60 * 60))  # секунд, 0 - не запускать
+LEDGER_CHECKPOINT_BATCH = int(os.getenv('LEDGER_CHECKPOINT_BATCH', 1000))  # пользователей в порции
+
+# Снятие устаревших объявлений с продажи
+LISTING_TTL = int(os.getenv('LISTING_TTL', 3 * 24 * 60 * 60))  # секунд, 0 - объявления не устаревают
+LISTING_SWEEP_INTERVAL = int(os.getenv('LISTING_SWEEP_INTERVAL', 10 * 60))  # секунд между проходами
+LISTING_SWEEP_BATCH = int(os.getenv('LISTING_SWEEP_BATCH', 500))  # объявлений за одну транзакцию
+LISTING_SWEEP_PAUSE = float(os.getenv('LISTING_SWEEP_PAUSE', 0.05))  # секунд между порциями
+
+# Отправка уведомлений из outbox
+OUTBOX_CONCURRENCY = int(os.getenv('OUTBOX_CONCURRENCY', 16))  # чатов, в которые отправка идет одновременно
+OUTBOX_BATCH = int(os.getenv('OUTBOX_BATCH', 200))  # сообщений за одну выборку
+OUTBOX_POLL_INTERVAL = float(os.getenv('OUTBOX_POLL_INTERVAL', 1))  # секунд между выборками без сигнала о новых
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', 5))
+OUTBOX_RETRY_DELAY = float(os.getenv('OUTBOX_RETRY_DELAY', 5))  # секунд, удваивается с каждой попыткой
+OUTBOX_RETENTION = int(os.getenv('OUTBOX_RETENTION', 24 * 60 * 60))  # секунд хранения отправленных
+
+# Ограничения Telegram на исходящие сообщения
+TELEGRAM_GLOBAL_RATE = float(os.getenv('TELEGRAM_GLOBAL_RATE', 30))  # сообщений в секунду на бота
+TELEGRAM_CHAT_RATE = float(os.getenv('TELEGRAM_CHAT_RATE', 1))  # сообщений в секунду в один чат
+TELEGRAM_CHAT_BURST = int(os.getenv('TELEGRAM_CHAT_BURST', 3))  # сообщений подряд в один чат без ожидания
+TELEGRAM_RETRY_WAIT = float(os.getenv('TELEGRAM_RETRY_WAIT', 10))  # секунд, которые ответ пользователю ждет RetryAfter
 
 # Доступные сервисы
 AVAILABLE_SERVICES = {
@@ -25,10 +84,34 @@ RENTAL_PERIODS = [1, 4, 12, 24]
 # Комиссия платформы (5%)
 PLATFORM_FEE = 0.05
 
+# Настройки рассылки объявлений (лимит Telegram - около 30 сообщений в секунду)
+BROADCAST_RATE = int(os.getenv('BROADCAST_RATE', 25))  # сообщений в секунду
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', 20))
+BROADCAST_CHUNK_SIZE = int(os.getenv('BROADCAST_CHUNK_SIZE', 500))
+BROADCAST_REPORT_INTERVAL = 5  # секунд между обновлениями отчета администратору
+
 # Минимальные суммы для операций
 MIN_DEPOSIT = 1  # Минимальная сумма пополнения в USDT
 MIN_WITHDRAWAL = 10  # Минимальная сумма вывода в USDT
 
 # Настройки CryptoBot
 CRYPTO_BOT_TOKEN = os.getenv('CRYPTO_BOT_TOKEN', "")
-CRYPTO_BOT_WEBHOOK_URL = os.getenv('CRYPTO_BOT_WEBHOOK_URL', "") 
\ No newline at end of file
+CRYPTO_BOT_WEBHOOK_URL = os.getenv('CRYPTO_BOT_WEBHOOK_URL', "")
+CRYPTO_PAY_API_URL = os.getenv('CRYPTO_PAY_API_URL', "https://pay.crypt.bot/api")
+CRYPTO_PAY_CONNECTIONS = int(os.getenv('CRYPTO_PAY_CONNECTIONS', 20))  # размер пула соединений
+CRYPTO_PAY_TIMEOUT = float(os.getenv('CRYPTO_PAY_TIMEOUT', 10))  # секунд на запрос
+CRYPTO_PAY_RETRIES = int(os.getenv('CRYPTO_PAY_RETRIES', 3))
+
+# Повтор выводов, исход которых неизвестен (таймаут, 5xx, обрыв связи), с тем же spend_id
+WITHDRAWAL_RETRY_DELAY = float(os.getenv('WITHDRAWAL_RETRY_DELAY', 60))  # секунд между попытками
+WITHDRAWAL_RETRY_INTERVAL = float(os.getenv('WITHDRAWAL_RETRY_INTERVAL', 30))  # секунд между проходами
+WITHDRAWAL_RETRY_BATCH = int(os.getenv('WITHDRAWAL_RETRY_BATCH', 50))
+
+# Встроенный HTTP-сервер для вебхуков
+WEB_SERVER_HOST = os.getenv('WEB_SERVER_HOST', "0.0.0.0")
+WEB_SERVER_PORT = int(os.getenv('WEB_SERVER_PORT', 8080))
+
+# Метрики обработчиков в формате Prometheus - отдельный сервер, по умолчанию только локальный
+METRICS_HOST = os.getenv('METRICS_HOST', "127.0.0.1")
+METRICS_PORT = int(os.getenv('METRICS_PORT', 9464))  # 0 - не запускать
+METRICS_PATH = "/metrics" 
\ No newline at end of file
@@ -0,0 +1,105 @@
+"""Денормализованные счетчики сделок и отзывов пользователя.
+
+Счетчики хранятся в строке users и обновляются в той же транзакции, что и
+изменение сделки или отзыва, поэтому профиль читает одну строку.
+Рейтинг пересчитывается по хранимым сумме и количеству оценок, поэтому
+новый отзыв стоит одного UPDATE независимо от числа отзывов о пользователе.
+Пересчет из таблиц сделок и отзывов: python -m database.counters
+"""
+import asyncio
+
+from sqlalchemy import select, update, func, and_, case, cast, Numeric
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .models import User, Transaction, Review
+from .user_cache import user_cache, invalidate_users
+from .ledger import to_minor
+from .rollups import record_stats, platform_fee
+
+
+async def record_trade_completed(session: AsyncSession, transaction: Transaction):
+    """Учитывает завершенную сделку в счетчиках продавца и покупателя"""
+    await session.execute(
+        update(User).where(User.id == transaction.seller_id).values(
+            sold_count=User.sold_count + 1,
+            trade_volume=User.trade_volume + transaction.amount
+        )
+    )
+    await session.execute(
+        update(User).where(User.id == transaction.buyer_id).values(
+            bought_count=User.bought_count + 1,
+            trade_volume=User.trade_volume + transaction.amount
+        )
+    )
+    invalidate_users(session, transaction.seller_id, transaction.buyer_id)
+    volume = to_minor(transaction.amount)
+    record_stats(session, completed_trades=1, volume_minor=volume, fees_minor=platform_fee(volume))
+
+
+def average_rating(rating_sum, reviews_count):
+    """Средняя оценка с округлением до десятых; без отзывов рейтинг равен 5.0"""
+    return case(
+        (reviews_count > 0, func.round(cast(rating_sum, Numeric) / reviews_count, 1)),
+        else_=5.0
+    )
+
+
+async def record_review(session: AsyncSession, review: Review):
+    """Учитывает новый отзыв в рейтинге и счетчике пользователя, о котором он оставлен"""
+    await session.execute(
+        update(User).where(User.id == review.reviewed_id).values(
+            rating_sum=User.rating_sum + review.rating,
+            reviews_count=User.reviews_count + 1,
+            rating=average_rating(User.rating_sum + review.rating, User.reviews_count + 1)
+        ).execution_options(synchronize_session="fetch")
+    )
+    invalidate_users(session, review.reviewed_id)
+
+
+def rebuild_counters_statement():
+    """UPDATE, пересчитывающий все счетчики агрегатами по сделкам и отзывам"""
+    def completed_count(column):
+        return select(func.count(Transaction.id)).where(and_(
+            column == User.id,
+            Transaction.status == "completed"
+        )).scalar_subquery()
+
+    volume = select(func.coalesce(func.sum(Transaction.amount), 0.0)).where(and_(
+        (Transaction.seller_id == User.id) | (Transaction.buyer_id == User.id),
+        Transaction.status == "completed"
+    )).scalar_subquery()
+
+    reviews = select(func.count(Review.id)).where(
+        Review.reviewed_id == User.id
+    ).scalar_subquery()
+    ratings = select(func.coalesce(func.sum(Review.rating), 0)).where(
+        Review.reviewed_id == User.id
+    ).scalar_subquery()
+
+    return update(User).values(
+        sold_count=completed_count(Transaction.seller_id),
+        bought_count=completed_count(Transaction.buyer_id),
+        trade_volume=volume,
+        reviews_count=reviews,
+        rating_sum=ratings,
+        rating=average_rating(ratings, reviews)
+    ).execution_options(synchronize_session=False)
+
+
+async def rebuild_user_counters(session: AsyncSession):
+    await session.execute(rebuild_counters_statement())
+    await session.commit()
+    user_cache.clear()
+
+
+async def _main():
+    from .db import async_session, init_db
+
+    await init_db()
+    async with async_session() as session:
+        await rebuild_user_counters(session)
+    print("✅ Счетчики пользователей пересчитаны")
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
@@ -1,16 +1,84 @@
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy.ext.asyncio import AsyncEngine
-from config import DATABASE_URL
-from .models import Base
-
-engine: AsyncEngine = create_async_engine(DATABASE_URL, echo=True)
-async_session = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
-
-async def init_db():
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
-
-async def get_session() -> AsyncSession:
-    async with async_session() as session:
-        return session 
\ No newline at end of file
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy.ext.asyncio import AsyncEngine
+from config import (
+    DATABASE_URL, DATABASE_READ_URL, DB_ECHO, DB_POOL_SIZE, DB_MAX_OVERFLOW,
+    DB_POOL_TIMEOUT, DB_POOL_RECYCLE, SQLITE_BUSY_TIMEOUT, SQLITE_CACHE_SIZE, SQLITE_MMAP_SIZE
+)
+from .models import Base
+from .migrations import run_migrations
+
+def _sqlite_pragmas(read_only: bool):
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        if not read_only:
+            # WAL: читатели не блокируют писателя и наоборот
+            cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT}")
+        cursor.execute(f"PRAGMA cache_size={SQLITE_CACHE_SIZE}")
+        cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+        if read_only:
+            cursor.execute("PRAGMA query_only=ON")
+        cursor.close()
+    return on_connect
+
+def create_engine(url: str = DATABASE_URL, read_only: bool = False, echo: bool = DB_ECHO) -> AsyncEngine:
+    """Движок БД для SQLite (aiosqlite) или Postgres (postgresql+asyncpg://, нужен пакет asyncpg)"""
+    backend = make_url(url).get_backend_name()
+    options = {"echo": echo}
+
+    if backend == "sqlite":
+        database = make_url(url).database
+        if database and database != ":memory:":
+            options.update(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT)
+        options["connect_args"] = {"timeout": SQLITE_BUSY_TIMEOUT / 1000}
+    else:
+        options.update(
+            pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT,
+            pool_recycle=DB_POOL_RECYCLE, pool_pre_ping=True
+        )
+        if read_only and backend == "postgresql":
+            options["connect_args"] = {"server_settings": {"default_transaction_read_only": "on"}}
+
+    new_engine = create_async_engine(url, **options)
+    if backend == "sqlite":
+        event.listen(new_engine.sync_engine, "connect", _sqlite_pragmas(read_only))
+    return new_engine
+
+engine: AsyncEngine = create_engine(DATABASE_URL)
+async_session = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+# Отдельный пул только для чтения: просмотр объявлений и статистика не ждут пишущие запросы
+read_engine: AsyncEngine = create_engine(DATABASE_READ_URL or DATABASE_URL, read_only=True)
+read_session = sessionmaker(read_engine, class_=AsyncSession, expire_on_commit=False)
+
+async def init_db():
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+    # Индексы и изменения схемы применяются версионированными миграциями
+    await run_migrations(engine)
+
+def dialect_insert(table, dialect_name: str):
+    """INSERT с поддержкой ON CONFLICT для SQLite и Postgres"""
+    if dialect_name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert(table)
+
+def after_commit(session: AsyncSession, callback):
+    """Вызывает callback после успешного коммита сессии; при откате он отбрасывается"""
+    session.info.setdefault("after_commit", []).append(callback)
+
+@event.listens_for(Session, "after_commit")
+def _run_after_commit(session):
+    for callback in session.info.pop("after_commit", []):
+        callback()
+
+@event.listens_for(Session, "after_rollback")
+def _drop_after_commit(session):
+    session.info.pop("after_commit", None) 
\ No newline at end of file
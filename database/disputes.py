@@ -0,0 +1,115 @@
+"""Очередь открытых споров для администратора.
+
+Страница очереди выбирается одним запросом: спор вместе с суммой сделки,
+покупателем и продавцом (users присоединяется дважды через псевдонимы).
+Страницы выбираются по ключу (created_at, id) относительно спора-курсора,
+поэтому в кнопках листания хранится только ID спора. Наличие страниц по обе
+стороны проверяется запросами: споры до курсора могли закрыть.
+"""
+from typing import NamedTuple, Optional
+
+from sqlalchemy import select, exists, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
+
+from .models import User, Transaction, Dispute
+
+DISPUTES_PAGE_SIZE = 5
+
+# Направления листания относительно спора-курсора
+AFTER = "after"  # следующая страница
+FROM = "from"  # страница, начинающаяся с курсора
+BEFORE = "before"  # предыдущая страница
+
+
+class DisputePage(NamedTuple):
+    rows: list
+    has_prev: bool
+    has_next: bool
+
+
+def dispute_rows_query():
+    """Спор, сделка, покупатель и продавец одной строкой"""
+    buyer = aliased(User, name="buyer")
+    seller = aliased(User, name="seller")
+    return (
+        select(
+            Dispute.id,
+            Dispute.description,
+            Dispute.status,
+            Dispute.created_at,
+            Transaction.id.label("transaction_id"),
+            Transaction.amount,
+            buyer.username.label("buyer_username"),
+            buyer.telegram_id.label("buyer_telegram_id"),
+            seller.username.label("seller_username"),
+            seller.telegram_id.label("seller_telegram_id"),
+        )
+        .join(Transaction, Transaction.id == Dispute.transaction_id)
+        .join(buyer, buyer.id == Transaction.buyer_id)
+        .join(seller, seller.id == Transaction.seller_id)
+    )
+
+
+def _anchor(dispute_id: int):
+    """Ключ сортировки (created_at, id) спора"""
+    return tuple_(
+        select(Dispute.created_at).where(Dispute.id == dispute_id).scalar_subquery(),
+        dispute_id
+    )
+
+
+def open_disputes_beyond(dispute_id: int, direction: str):
+    """Есть ли открытые споры раньше (BEFORE) или позже (AFTER) спора dispute_id"""
+    key = tuple_(Dispute.created_at, Dispute.id)
+    anchor = _anchor(dispute_id)
+    condition = key < anchor if direction == BEFORE else key > anchor
+    return select(exists().where(Dispute.status == "open", condition))
+
+
+def dispute_queue_query(direction: str = AFTER, cursor_id: int = 0, limit: int = DISPUTES_PAGE_SIZE):
+    """Открытые споры от старых к новым; на одну строку больше limit - признак продолжения"""
+    query = dispute_rows_query().where(Dispute.status == "open")
+    key = tuple_(Dispute.created_at, Dispute.id)
+
+    if cursor_id:
+        anchor = _anchor(cursor_id)
+        if direction == BEFORE:
+            query = query.where(key < anchor)
+        elif direction == FROM:
+            query = query.where(key >= anchor)
+        else:
+            query = query.where(key > anchor)
+
+    if direction == BEFORE:
+        ordering = (Dispute.created_at.desc(), Dispute.id.desc())
+    else:
+        ordering = (Dispute.created_at.asc(), Dispute.id.asc())
+    return query.order_by(*ordering).limit(limit + 1)
+
+
+async def fetch_dispute_page(session: AsyncSession, direction: str = AFTER, cursor_id: int = 0,
+                             limit: int = DISPUTES_PAGE_SIZE) -> DisputePage:
+    rows = list((await session.execute(dispute_queue_query(direction, cursor_id, limit))).all())
+    more = len(rows) > limit
+    rows = rows[:limit]
+
+    if not rows:
+        if cursor_id:
+            # Споры вокруг курсора успели закрыть - показываем начало очереди
+            return await fetch_dispute_page(session, AFTER, 0, limit)
+        return DisputePage(rows, has_prev=False, has_next=False)
+
+    if direction == BEFORE:
+        rows.reverse()
+        # Лишняя строка показывает страницу раньше; позже - проверяем запросом
+        has_next = await session.scalar(open_disputes_beyond(rows[-1].id, AFTER))
+        return DisputePage(rows, has_prev=more, has_next=has_next)
+
+    # Начало очереди без курсора; иначе перед первым спором страницы может ничего не остаться
+    has_prev = bool(cursor_id) and await session.scalar(open_disputes_beyond(rows[0].id, BEFORE))
+    return DisputePage(rows, has_prev=has_prev, has_next=more)
+
+
+async def fetch_dispute(session: AsyncSession, dispute_id: int) -> Optional[object]:
+    return (await session.execute(dispute_rows_query().where(Dispute.id == dispute_id))).first()
@@ -0,0 +1,229 @@
+"""Журнал проводок по балансам пользователей.
+
+Каждое изменение баланса - это одна проводка в таблице ledger (только
+добавление) и один условный UPDATE снимка users.balance_minor, поэтому баланс
+читается из строки пользователя, а история восстанавливается по журналу.
+Суммы хранятся целыми в миллионных долях USDT (MINOR_UNITS).
+
+Проводки сессии накапливаются и записываются одним пакетным INSERT перед
+коммитом, в той же транзакции, что и изменение снимка; при откате они
+отбрасываются.
+
+Периодическая сверка проходит по пользователям потоком и сравнивает снимок с
+последней контрольной точкой плюс суммой новых проводок, после чего сдвигает
+контрольные точки. Ручной запуск: python -m database.ledger
+"""
+import asyncio
+import logging
+from datetime import datetime
+from decimal import Decimal, ROUND_HALF_UP
+from typing import List, NamedTuple, Optional, Tuple
+
+from sqlalchemy import event, func, insert, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from config import LEDGER_CHECKPOINT_INTERVAL, LEDGER_CHECKPOINT_BATCH
+from .models import User, LedgerEntry, LedgerCheckpoint, MINOR_UNITS
+from .user_cache import invalidate_users
+
+logger = logging.getLogger(__name__)
+
+# Виды проводок
+OPENING = "opening"  # перенос баланса, существовавшего до журнала
+DEPOSIT = "deposit"
+PURCHASE = "purchase"
+REFUND = "refund"
+SALE = "sale"
+WITHDRAWAL = "withdrawal"
+WITHDRAWAL_REVERSAL = "withdrawal_reversal"
+ADJUSTMENT = "adjustment"
+
+_PENDING = "ledger_entries"
+
+# Сколько расхождений сверки выводить в лог поштучно
+MISMATCHES_LOGGED = 20
+
+
+def to_minor(amount) -> int:
+    """Сумма в USDT -> целые миллионные доли"""
+    return int((Decimal(str(amount)) * MINOR_UNITS).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+def from_minor(amount_minor: int) -> float:
+    return amount_minor / MINOR_UNITS
+
+
+async def post(
+    session: AsyncSession,
+    user_id: int,
+    amount_minor: int,
+    kind: str,
+    ref: Optional[str] = None,
+    require_funds: bool = False
+) -> Optional[int]:
+    """Проводка по балансу пользователя; возвращает новый баланс в minor units.
+
+    require_funds: списание выполняется, только если баланс не уйдет в минус.
+    None - пользователь не найден или средств недостаточно.
+    """
+    condition = [User.id == user_id]
+    if require_funds:
+        condition.append(User.balance_minor + amount_minor >= 0)
+    balance = (await session.execute(
+        update(User)
+        .where(*condition)
+        .values(balance_minor=User.balance_minor + amount_minor)
+        .returning(User.balance_minor)
+    )).scalar_one_or_none()
+    if balance is None:
+        return None
+
+    session.info.setdefault(_PENDING, []).append({
+        "user_id": user_id,
+        "amount_minor": amount_minor,
+        "balance_after_minor": balance,
+        "kind": kind,
+        "ref": ref,
+        "created_at": datetime.utcnow(),
+    })
+    invalidate_users(session, user_id)
+    return balance
+
+
+@event.listens_for(Session, "before_commit")
+def _write_pending_entries(session):
+    entries = session.info.pop(_PENDING, None)
+    if entries:
+        session.execute(insert(LedgerEntry), entries)
+
+
+@event.listens_for(Session, "after_rollback")
+def _drop_pending_entries(session):
+    session.info.pop(_PENDING, None)
+
+
+class CheckpointReport(NamedTuple):
+    entry_id: int  # проводки до этого id включительно учтены в контрольных точках
+    users: int
+    moved: int  # пользователей с новыми проводками
+    mismatches: List[Tuple[int, int, int]]  # (user_id, снимок, по журналу)
+
+
+def checkpoint_query(batch_size: int = LEDGER_CHECKPOINT_BATCH):
+    """Снимок, контрольная точка и сумма новых проводок каждого пользователя.
+
+    Одна выборка: снимки и проводки видны на один момент, и верхняя граница
+    проводок (upto) берется из того же снимка.
+    """
+    upto = select(func.coalesce(func.max(LedgerEntry.id), 0)).scalar_subquery()
+    since = func.coalesce(LedgerCheckpoint.entry_id, 0)
+    delta = select(func.coalesce(func.sum(LedgerEntry.amount_minor), 0)).where(
+        LedgerEntry.user_id == User.id,
+        LedgerEntry.id > since,
+        LedgerEntry.id <= upto
+    ).scalar_subquery()
+    return (
+        select(
+            User.id,
+            User.balance_minor,
+            func.coalesce(LedgerCheckpoint.balance_minor, 0),
+            delta,
+            upto
+        )
+        .outerjoin(LedgerCheckpoint, LedgerCheckpoint.user_id == User.id)
+        .order_by(User.id)
+        .execution_options(yield_per=batch_size)
+    )
+
+
+async def checkpoint_ledger(
+    write_factory=None,
+    read_factory=None,
+    batch_size: int = LEDGER_CHECKPOINT_BATCH
+) -> CheckpointReport:
+    """Сверяет снимки балансов с журналом и сдвигает контрольные точки"""
+    from .db import async_session, read_session, dialect_insert
+
+    write_factory = write_factory or async_session
+    read_factory = read_factory or read_session
+    users = moved = 0
+    entry_id = 0
+    mismatches = []
+
+    async with read_factory() as reader, write_factory() as writer:
+        result = await reader.stream(checkpoint_query(batch_size))
+        async for partition in result.partitions():
+            rows = []
+            for user_id, balance, checkpoint, delta, upto in partition:
+                users += 1
+                entry_id = upto
+                expected = checkpoint + delta
+                if balance != expected:
+                    mismatches.append((user_id, balance, expected))
+                if delta:
+                    rows.append({
+                        "user_id": user_id,
+                        "balance_minor": expected,
+                        "entry_id": upto,
+                        "checked_at": datetime.utcnow(),
+                    })
+            if rows:
+                moved += len(rows)
+                statement = dialect_insert(LedgerCheckpoint.__table__, writer.bind.dialect.name)
+                await writer.execute(
+                    statement.on_conflict_do_update(
+                        index_elements=["user_id"],
+                        set_={
+                            "balance_minor": statement.excluded.balance_minor,
+                            "entry_id": statement.excluded.entry_id,
+                            "checked_at": statement.excluded.checked_at,
+                        }
+                    ),
+                    rows
+                )
+                await writer.commit()
+            # Сверка не должна занимать цикл событий надолго
+            await asyncio.sleep(0)
+
+    for user_id, balance, expected in mismatches[:MISMATCHES_LOGGED]:
+        logger.error(
+            "Баланс пользователя %s (%s) не совпадает с журналом (%s)",
+            user_id, from_minor(balance), from_minor(expected)
+        )
+    if len(mismatches) > MISMATCHES_LOGGED:
+        logger.error("Всего расхождений с журналом: %s", len(mismatches))
+    return CheckpointReport(entry_id, users, moved, mismatches)
+
+
+async def checkpoint_loop(interval: float = LEDGER_CHECKPOINT_INTERVAL):
+    """Периодическая сверка журнала; запускается отдельной задачей"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            report = await checkpoint_ledger()
+            logger.info(
+                "Сверка журнала: %s пользователей, %s с новыми проводками, расхождений: %s",
+                report.users, report.moved, len(report.mismatches)
+            )
+        except Exception:
+            logger.exception("Сверка журнала завершилась ошибкой")
+
+
+async def _main():
+    from .db import init_db, engine, read_engine
+
+    await init_db()
+    report = await checkpoint_ledger()
+    print(f"Проверено пользователей: {report.users}, проводки до #{report.entry_id}")
+    for user_id, balance, expected in report.mismatches:
+        print(f"❌ users.id={user_id}: баланс {from_minor(balance)}, по журналу {from_minor(expected)}")
+    if not report.mismatches:
+        print("✅ Балансы совпадают с журналом")
+    await engine.dispose()
+    await read_engine.dispose()
+    return 1 if report.mismatches else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(asyncio.run(_main()))
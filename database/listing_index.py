@@ -0,0 +1,169 @@
+"""Индекс активных объявлений в памяти процесса.
+
+Для каждого сочетания (сервис, длительность) хранятся два отсортированных
+представления - по цене и по дате размещения. Выборка страницы и поиск самого
+дешевого предложения выполняются двоичным поиском без обращения к БД.
+Индекс загружается при старте и обновляется при создании и покупке объявлений.
+Изменения, сделанные пока идет перезагрузка (load), записываются в журнал и
+применяются к загруженному снимку перед заменой, поэтому не теряются.
+"""
+from bisect import bisect_left, bisect_right, insort
+from datetime import datetime
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from sqlalchemy import select
+
+from .models import PhoneListing
+
+
+class ListingEntry(NamedTuple):
+    id: int
+    seller_id: int
+    service: str
+    duration: int
+    price: float
+    created_at: datetime
+
+
+class _Book:
+    """Объявления одного ключа, отсортированные по цене и по дате"""
+
+    def __init__(self):
+        self.by_price: List[Tuple[float, int]] = []
+        self.by_time: List[Tuple[datetime, int]] = []
+
+    def add(self, entry: ListingEntry):
+        insort(self.by_price, (entry.price, entry.id))
+        insort(self.by_time, (entry.created_at, entry.id))
+
+    def remove(self, entry: ListingEntry):
+        for view, key in ((self.by_price, (entry.price, entry.id)),
+                          (self.by_time, (entry.created_at, entry.id))):
+            pos = bisect_left(view, key)
+            if pos < len(view) and view[pos] == key:
+                del view[pos]
+
+    def __len__(self):
+        return len(self.by_price)
+
+
+class ListingIndex:
+    def __init__(self):
+        self.loaded = False
+        self._entries: Dict[int, ListingEntry] = {}
+        # Ключ (сервис, длительность); None означает "любой"
+        self._books: Dict[Tuple[Optional[str], Optional[int]], _Book] = {}
+        # Журналы идущих загрузок: id -> добавленное объявление или None, если снято
+        self._journals: List[Dict[int, Optional[ListingEntry]]] = []
+
+    @staticmethod
+    def _keys(entry: ListingEntry):
+        return (
+            (None, None),
+            (entry.service, None),
+            (None, entry.duration),
+            (entry.service, entry.duration),
+        )
+
+    async def load(self, session_factory):
+        """Загружает все активные объявления из БД"""
+        entries: Dict[int, ListingEntry] = {}
+        query = select(
+            PhoneListing.id, PhoneListing.seller_id, PhoneListing.service,
+            PhoneListing.duration, PhoneListing.price, PhoneListing.created_at
+        ).where(PhoneListing.is_active == True)
+
+        journal: Dict[int, Optional[ListingEntry]] = {}
+        self._journals.append(journal)
+        try:
+            async with session_factory() as session:
+                result = await session.stream(query)
+                async for row in result:
+                    entries[row.id] = ListingEntry(*row)
+        finally:
+            self._journals.remove(journal)
+
+        # Снимок мог быть прочитан до изменений, сделанных во время загрузки
+        for listing_id, entry in journal.items():
+            if entry is None:
+                entries.pop(listing_id, None)
+            else:
+                entries[listing_id] = entry
+
+        books: Dict[Tuple[Optional[str], Optional[int]], _Book] = {}
+        for entry in entries.values():
+            for key in self._keys(entry):
+                book = books.setdefault(key, _Book())
+                book.by_price.append((entry.price, entry.id))
+                book.by_time.append((entry.created_at, entry.id))
+        for book in books.values():
+            book.by_price.sort()
+            book.by_time.sort()
+
+        self._entries, self._books = entries, books
+        self.loaded = True
+
+    def add(self, listing: PhoneListing):
+        if not listing.is_active:
+            return
+        entry = ListingEntry(
+            listing.id, listing.seller_id, listing.service,
+            listing.duration, listing.price, listing.created_at
+        )
+        for journal in self._journals:
+            journal[entry.id] = entry
+        if not self.loaded or entry.id in self._entries:
+            return
+        self._entries[entry.id] = entry
+        for key in self._keys(entry):
+            self._books.setdefault(key, _Book()).add(entry)
+
+    def remove(self, listing_id: int):
+        for journal in self._journals:
+            journal[listing_id] = None
+        entry = self._entries.pop(listing_id, None)
+        if entry is None:
+            return
+        for key in self._keys(entry):
+            book = self._books.get(key)
+            if book is not None:
+                book.remove(entry)
+
+    def get(self, listing_id: int) -> Optional[ListingEntry]:
+        return self._entries.get(listing_id)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def page(self, order: str, service: Optional[str] = None, duration: Optional[int] = None,
+             cursor: Optional[list] = None, limit: int = 5) -> List[ListingEntry]:
+        """Страница объявлений после курсора [ключ сортировки, id], как в database.listings"""
+        book = self._books.get((service, duration))
+        if not book:
+            return []
+
+        if order == "new":
+            view, descending = book.by_time, True
+            after = (datetime.fromisoformat(cursor[0]), cursor[1]) if cursor else None
+        else:
+            view, descending = book.by_price, order == "price_desc"
+            after = (cursor[0], cursor[1]) if cursor else None
+
+        if descending:
+            end = bisect_left(view, after) if after else len(view)
+            keys = view[max(0, end - limit):end][::-1]
+        else:
+            start = bisect_right(view, after) if after else 0
+            keys = view[start:start + limit]
+
+        return [self._entries[listing_id] for _, listing_id in keys]
+
+    def cheapest(self, service: Optional[str] = None,
+                 duration: Optional[int] = None) -> Optional[ListingEntry]:
+        book = self._books.get((service, duration))
+        if not book:
+            return None
+        return self._entries[book.by_price[0][1]]
+
+
+listing_index = ListingIndex()
@@ -0,0 +1,95 @@
+"""Постраничный просмотр активных объявлений.
+
+Страницы выбираются по ключу (keyset): вместо списка всех ID в состоянии
+хранится только порядок сортировки, фильтр и курсор - ключ сортировки и ID
+последнего показанного объявления. Если индекс объявлений в памяти загружен,
+страницы выбираются из него, иначе - из БД.
+"""
+from datetime import datetime
+from typing import List, Optional
+
+from sqlalchemy import select, update, and_, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .models import PhoneListing
+from .listing_index import listing_index
+
+LISTINGS_PAGE_SIZE = 5
+
+# Порядок сортировки -> (колонка, по убыванию)
+BROWSE_ORDERS = {
+    "price_asc": (PhoneListing.price, False),
+    "price_desc": (PhoneListing.price, True),
+    "new": (PhoneListing.created_at, True),
+}
+
+
+def listing_cursor(listing, order: str) -> list:
+    """Курсор в сериализуемом виде: [ключ сортировки, id]"""
+    if BROWSE_ORDERS[order][0] is PhoneListing.created_at:
+        return [listing.created_at.isoformat(), listing.id]
+    return [listing.price, listing.id]
+
+
+def listing_page_query(order: str, service: Optional[str] = None, cursor: Optional[list] = None,
+                       limit: int = LISTINGS_PAGE_SIZE, duration: Optional[int] = None):
+    column, descending = BROWSE_ORDERS[order]
+
+    conditions = [PhoneListing.is_active == True]
+    if service:
+        conditions.append(PhoneListing.service == service)
+    if duration:
+        conditions.append(PhoneListing.duration == duration)
+
+    if cursor:
+        key, last_id = cursor
+        if column is PhoneListing.created_at:
+            key = datetime.fromisoformat(key)
+        row, after = tuple_(column, PhoneListing.id), tuple_(key, last_id)
+        conditions.append(row < after if descending else row > after)
+
+    if descending:
+        ordering = (column.desc(), PhoneListing.id.desc())
+    else:
+        ordering = (column.asc(), PhoneListing.id.asc())
+
+    return select(PhoneListing).where(and_(*conditions)).order_by(*ordering).limit(limit)
+
+
+async def fetch_listing_page(session: AsyncSession, order: str, service: Optional[str] = None,
+                             cursor: Optional[list] = None, limit: int = LISTINGS_PAGE_SIZE,
+                             duration: Optional[int] = None) -> List[PhoneListing]:
+    result = await session.execute(listing_page_query(order, service, cursor, limit, duration))
+    return list(result.scalars().all())
+
+
+async def browse_listings(session: AsyncSession, order: str, service: Optional[str] = None,
+                          cursor: Optional[list] = None, limit: int = LISTINGS_PAGE_SIZE,
+                          duration: Optional[int] = None) -> list:
+    """Страница объявлений из индекса в памяти, а до его загрузки - из БД"""
+    if listing_index.loaded:
+        return listing_index.page(order, service, duration, cursor, limit)
+    return await fetch_listing_page(session, order, service, cursor, limit, duration)
+
+
+def expire_listings_statement(cutoff: datetime, limit: int):
+    """Снимает с продажи до limit самых старых активных объявлений, размещенных до cutoff.
+
+    Выборка идет по индексу (is_active, created_at) и останавливается на limit,
+    поэтому одна порция - короткая пишущая транзакция.
+    """
+    expired = (
+        select(PhoneListing.id)
+        .where(and_(PhoneListing.is_active == True, PhoneListing.created_at < cutoff))
+        .order_by(PhoneListing.created_at)
+        .limit(limit)
+    )
+    # is_active проверяется только в подзапросе: повтор условия снаружи
+    # SQLite выполняет по индексу is_active вместо первичного ключа
+    return (
+        update(PhoneListing)
+        .where(PhoneListing.id.in_(expired.scalar_subquery()))
+        .values(is_active=False)
+        .returning(PhoneListing.id)
+        .execution_options(synchronize_session=False)
+    )
@@ -0,0 +1,47 @@
+"""Пакетная загрузка сущностей по ID.
+
+Обработчик сначала отмечает нужные ID (want), затем одним вызовом load()
+загружает каждый тип сущностей одним запросом WHERE id IN (...), после чего
+берет объекты через get(). Число запросов не зависит от количества строк.
+"""
+from collections import defaultdict
+from typing import Dict, Iterable, Optional, Set, Type
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+# Ограничение на число параметров в одном IN, чтобы не упереться в лимит SQLite
+IN_CHUNK_SIZE = 500
+
+
+class BatchLoader:
+    def __init__(self, session: AsyncSession):
+        self.session = session
+        self._wanted: Dict[Type, Set[int]] = defaultdict(set)
+        self._loaded: Dict[Type, Dict[int, object]] = defaultdict(dict)
+
+    def want(self, model: Type, ids: Iterable[Optional[int]]) -> "BatchLoader":
+        loaded = self._loaded[model]
+        self._wanted[model].update(i for i in ids if i is not None and i not in loaded)
+        return self
+
+    async def load(self):
+        """Загружает все отмеченные сущности: один запрос на тип (и на каждые IN_CHUNK_SIZE ID)"""
+        wanted, self._wanted = self._wanted, defaultdict(set)
+        for model, ids in wanted.items():
+            ids = sorted(ids)
+            for start in range(0, len(ids), IN_CHUNK_SIZE):
+                chunk = ids[start:start + IN_CHUNK_SIZE]
+                result = await self.session.execute(select(model).where(model.id.in_(chunk)))
+                for obj in result.scalars():
+                    self._loaded[model][obj.id] = obj
+
+    def get(self, model: Type, entity_id: Optional[int]):
+        return self._loaded[model].get(entity_id)
+
+    async def fetch(self, model: Type, ids: Iterable[Optional[int]]) -> Dict[int, object]:
+        """Загружает сущности одного типа и возвращает словарь id -> объект"""
+        ids = [i for i in ids if i is not None]
+        self.want(model, ids)
+        await self.load()
+        return {i: self._loaded[model][i] for i in ids if i in self._loaded[model]}
@@ -0,0 +1,488 @@
+"""Версионированные миграции схемы БД.
+
+Миграции применяются по порядку из списка MIGRATIONS, номер последней
+примененной хранится в таблице schema_version. SQL выпущенной миграции не
+меняется: шаги с данными хранят свой текст запроса, а не берут его из
+текущего кода моделей. Запуск проверки планов горячих запросов:
+python -m database.migrations --explain
+Проверка обновления базы исходной схемы до текущей версии:
+python -m database.migrations --check-upgrade
+"""
+import asyncio
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta
+from typing import Callable, List, NamedTuple, Tuple
+
+from sqlalchemy import text, select, and_, or_, inspect
+from sqlalchemy.engine import Connection
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from .models import User, Transaction, Dispute, Review, LedgerEntry
+from .listings import listing_page_query, expire_listings_statement
+from .disputes import dispute_queue_query
+
+SCHEMA_VERSION_TABLE = "schema_version"
+
+
+class Migration(NamedTuple):
+    version: int
+    description: str
+    upgrade: Callable[[Connection], None]
+    # Онлайн-миграции (создание индексов) выполняются вне транзакции,
+    # чтобы на Postgres можно было использовать CREATE INDEX CONCURRENTLY
+    online: bool = False
+
+
+def create_indexes(*indexes: Tuple[str, str, Tuple[str, ...]]) -> Callable[[Connection], None]:
+    """Возвращает шаг миграции, создающий индексы, если их еще нет"""
+    def upgrade(conn: Connection) -> None:
+        concurrently = "CONCURRENTLY " if conn.dialect.name == "postgresql" else ""
+        for name, table, columns in indexes:
+            conn.exec_driver_sql(
+                f"CREATE INDEX {concurrently}IF NOT EXISTS {name} "
+                f"ON {table} ({', '.join(columns)})"
+            )
+    return upgrade
+
+
+def add_columns(table: str, *columns: Tuple[str, str]) -> Callable[[Connection], None]:
+    """Возвращает шаг миграции, добавляющий отсутствующие колонки (имя, DDL типа)"""
+    def upgrade(conn: Connection) -> None:
+        existing = {column["name"] for column in inspect(conn).get_columns(table)}
+        for name, ddl in columns:
+            if name not in existing:
+                conn.exec_driver_sql(f"ALTER TABLE {table} ADD COLUMN {name} {ddl}")
+    return upgrade
+
+
+def execute_sql(*statements: str) -> Callable[[Connection], None]:
+    """Возвращает шаг миграции, выполняющий SQL-запросы по порядку"""
+    def upgrade(conn: Connection) -> None:
+        for statement in statements:
+            conn.execute(text(statement))
+    return upgrade
+
+
+# Пересчет счетчиков на момент миграции 3: колонок rating_sum еще нет
+REBUILD_COUNTERS_V3 = """
+UPDATE users SET
+    sold_count = (SELECT COUNT(transactions.id) FROM transactions
+                  WHERE transactions.seller_id = users.id AND transactions.status = 'completed'),
+    bought_count = (SELECT COUNT(transactions.id) FROM transactions
+                    WHERE transactions.buyer_id = users.id AND transactions.status = 'completed'),
+    trade_volume = (SELECT COALESCE(SUM(transactions.amount), 0.0) FROM transactions
+                    WHERE (transactions.seller_id = users.id OR transactions.buyer_id = users.id)
+                    AND transactions.status = 'completed'),
+    reviews_count = (SELECT COUNT(reviews.id) FROM reviews WHERE reviews.reviewed_id = users.id)
+"""
+
+# Сумма и количество оценок; рейтинг считается вторым запросом по уже записанным значениям
+REBUILD_RATINGS_V4 = (
+    """
+UPDATE users SET
+    reviews_count = (SELECT COUNT(reviews.id) FROM reviews WHERE reviews.reviewed_id = users.id),
+    rating_sum = (SELECT COALESCE(SUM(reviews.rating), 0) FROM reviews WHERE reviews.reviewed_id = users.id)
+""",
+    """
+UPDATE users SET rating = CASE WHEN reviews_count > 0
+    THEN ROUND(CAST(rating_sum AS NUMERIC) / (reviews_count + 0.0), 1) ELSE 5.0 END
+""",
+)
+
+
+# Перенос баланса на момент миграции 5: 1 USDT = 1_000_000 minor units
+MIGRATE_BALANCE_V5 = """
+UPDATE users SET balance_minor = CAST(ROUND(COALESCE(balance, 0) * 1000000) AS INTEGER)
+"""
+
+# Проводки открытия баланса; время - параметр :created_at
+OPEN_LEDGER_V5 = """
+INSERT INTO ledger (user_id, amount_minor, balance_after_minor, kind, created_at)
+SELECT id, balance_minor, balance_minor, 'opening', :created_at FROM users WHERE balance_minor != 0
+"""
+
+
+def open_ledger(conn: Connection) -> None:
+    """Переносит баланс из старой колонки users.balance в снимок и журнал проводок"""
+    existing = {column["name"] for column in inspect(conn).get_columns("users")}
+    if "balance" in existing:
+        conn.execute(text(MIGRATE_BALANCE_V5))
+    conn.execute(text(OPEN_LEDGER_V5), {"created_at": datetime.utcnow()})
+
+
+# Сводки статистики на момент миграции 6: комиссия 5%, объем переводится в
+# minor units по часу/суткам. {table} - таблица сводок, остальные поля -
+# время события, усеченное до начала интервала (ROLLUP_BUCKETS_V6)
+REBUILD_ROLLUPS_V6 = """
+INSERT INTO {table} (bucket, new_users, new_listings, trades, completed_trades, volume_minor, fees_minor)
+SELECT bucket, SUM(new_users), SUM(new_listings), SUM(trades),
+       SUM(completed_trades), SUM(volume_minor), SUM(fees_minor)
+FROM (
+    SELECT {users} AS bucket, 1 AS new_users, 0 AS new_listings, 0 AS trades,
+           0 AS completed_trades, 0 AS volume_minor, 0 AS fees_minor
+    FROM users
+    UNION ALL
+    SELECT {listings}, 0, 1, 0, 0, 0, 0 FROM phone_listings
+    UNION ALL
+    SELECT {trades}, 0, 0, 1, 0, 0, 0 FROM transactions
+    UNION ALL
+    SELECT bucket, 0, 0, 0, completed_trades, volume_minor, CAST(ROUND(volume_minor * 0.05) AS BIGINT)
+    FROM (
+        SELECT {completed} AS bucket, COUNT(*) AS completed_trades,
+               CAST(ROUND(COALESCE(SUM(amount), 0) * 1000000) AS BIGINT) AS volume_minor
+        FROM transactions
+        WHERE status = 'completed'
+        GROUP BY 1
+    ) AS completed
+) AS events
+WHERE bucket IS NOT NULL
+GROUP BY bucket
+"""
+
+# Начало часа и суток; на SQLite - в формате, в котором SQLAlchemy хранит DateTime
+ROLLUP_BUCKETS_V6 = {
+    "sqlite": ("strftime('%Y-%m-%d %H:00:00.000000', {})", "strftime('%Y-%m-%d 00:00:00.000000', {})"),
+    "postgresql": ("date_trunc('hour', {})", "date_trunc('day', {})"),
+}
+
+
+def rebuild_rollups_v6(conn: Connection) -> None:
+    """Заполняет сводки из пользователей, объявлений и сделок"""
+    hour, day = ROLLUP_BUCKETS_V6[conn.dialect.name]
+    for table, truncate in (("stats_hourly", hour), ("stats_daily", day)):
+        conn.execute(text(f"DELETE FROM {table}"))
+        conn.execute(text(REBUILD_ROLLUPS_V6.format(
+            table=table,
+            users=truncate.format("registered_at"),
+            listings=truncate.format("created_at"),
+            trades=truncate.format("created_at"),
+            completed=truncate.format("COALESCE(completed_at, created_at)"),
+        )))
+
+
+def chain(*steps: Callable[[Connection], None]) -> Callable[[Connection], None]:
+    def upgrade(conn: Connection) -> None:
+        for step in steps:
+            step(conn)
+    return upgrade
+
+
+MIGRATIONS: List[Migration] = [
+    Migration(
+        1,
+        "Индексы для выборок объявлений, сделок, отзывов и споров",
+        create_indexes(
+            # Покупка: активные объявления по цене / по дате, выбор по сервису
+            ("ix_phone_listings_active_price", "phone_listings", ("is_active", "price")),
+            ("ix_phone_listings_active_created", "phone_listings", ("is_active", "created_at")),
+            ("ix_phone_listings_service_active_created", "phone_listings",
+             ("service", "is_active", "created_at")),
+            # Профиль, отзывы, споры: сделки покупателя и продавца по статусу
+            ("ix_transactions_buyer_status_completed", "transactions",
+             ("buyer_id", "status", "completed_at")),
+            ("ix_transactions_seller_status_completed", "transactions",
+             ("seller_id", "status", "completed_at")),
+            ("ix_transactions_created", "transactions", ("created_at",)),
+            ("ix_reviews_reviewed", "reviews", ("reviewed_id", "created_at")),
+            ("ix_reviews_transaction_reviewer", "reviews", ("transaction_id", "reviewer_id")),
+            ("ix_disputes_status_created", "disputes", ("status", "created_at")),
+            ("ix_disputes_initiator_created", "disputes", ("initiator_id", "created_at")),
+            ("ix_users_registered", "users", ("registered_at",)),
+        ),
+        online=True,
+    ),
+    Migration(
+        2,
+        "Индекс для поиска объявлений по длительности аренды",
+        create_indexes(
+            ("ix_phone_listings_duration_active_price", "phone_listings",
+             ("duration", "is_active", "price")),
+        ),
+        online=True,
+    ),
+    Migration(
+        3,
+        "Счетчики сделок и отзывов пользователя",
+        chain(
+            add_columns(
+                "users",
+                ("sold_count", "INTEGER NOT NULL DEFAULT 0"),
+                ("bought_count", "INTEGER NOT NULL DEFAULT 0"),
+                ("reviews_count", "INTEGER NOT NULL DEFAULT 0"),
+                ("trade_volume", "FLOAT NOT NULL DEFAULT 0"),
+            ),
+            execute_sql(REBUILD_COUNTERS_V3),
+        ),
+    ),
+    Migration(
+        4,
+        "Сумма оценок для инкрементального пересчета рейтинга",
+        chain(
+            add_columns("users", ("rating_sum", "INTEGER NOT NULL DEFAULT 0")),
+            execute_sql(*REBUILD_RATINGS_V4),
+        ),
+    ),
+    Migration(
+        5,
+        "Баланс в целых minor units и журнал проводок",
+        chain(
+            add_columns("users", ("balance_minor", "BIGINT NOT NULL DEFAULT 0")),
+            open_ledger,
+        ),
+    ),
+    Migration(
+        6,
+        "Почасовые и посуточные сводки статистики",
+        rebuild_rollups_v6,
+    ),
+    Migration(
+        7,
+        "Индекс outbox по чатам для отправки по одному сообщению на чат",
+        create_indexes(
+            ("ix_outbox_status_chat_id", "outbox", ("status", "chat_id", "id")),
+        ),
+        online=True,
+    ),
+]
+
+
+def _ensure_version_table(conn: Connection) -> int:
+    conn.exec_driver_sql(
+        f"CREATE TABLE IF NOT EXISTS {SCHEMA_VERSION_TABLE} ("
+        "version INTEGER PRIMARY KEY, "
+        "description VARCHAR NOT NULL, "
+        "applied_at TIMESTAMP NOT NULL)"
+    )
+    version = conn.exec_driver_sql(f"SELECT MAX(version) FROM {SCHEMA_VERSION_TABLE}").scalar()
+    return version or 0
+
+
+def _record_version(conn: Connection, migration: Migration) -> None:
+    conn.execute(
+        text(
+            f"INSERT INTO {SCHEMA_VERSION_TABLE} (version, description, applied_at) "
+            "VALUES (:version, :description, :applied_at)"
+        ),
+        {
+            "version": migration.version,
+            "description": migration.description,
+            "applied_at": datetime.utcnow(),
+        },
+    )
+
+
+async def get_schema_version(engine: AsyncEngine) -> int:
+    async with engine.begin() as conn:
+        return await conn.run_sync(_ensure_version_table)
+
+
+async def run_migrations(engine: AsyncEngine) -> int:
+    """Применяет все еще не примененные миграции и возвращает текущую версию схемы"""
+    current = await get_schema_version(engine)
+
+    for migration in MIGRATIONS:
+        if migration.version <= current:
+            continue
+
+        if migration.online and engine.dialect.name == "postgresql":
+            async with engine.connect() as conn:
+                conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+                await conn.run_sync(migration.upgrade)
+            async with engine.begin() as conn:
+                await conn.run_sync(_record_version, migration)
+        else:
+            async with engine.begin() as conn:
+                await conn.run_sync(migration.upgrade)
+                await conn.run_sync(_record_version, migration)
+
+        current = migration.version
+
+    return current
+
+
+def hot_queries() -> List[Tuple[str, object]]:
+    """Запросы, которые выполняются обработчиками на каждое нажатие кнопки"""
+    now = datetime.utcnow()
+    user_id = 1
+    return [
+        ("Покупка: сначала дешевые",
+         listing_page_query("price_asc", cursor=[5.0, 100])),
+        ("Покупка: сначала дорогие",
+         listing_page_query("price_desc", cursor=[5.0, 100])),
+        ("Покупка: сначала новые",
+         listing_page_query("new", cursor=[now.isoformat(), 100])),
+        ("Покупка: поиск по сервису",
+         listing_page_query("new", service="Telegram", cursor=[now.isoformat(), 100])),
+        ("Покупка: поиск по времени",
+         listing_page_query("price_asc", cursor=[5.0, 100], duration=4)),
+        ("Отзывы: сделки за 7 дней",
+         select(Transaction).where(and_(
+             or_(Transaction.buyer_id == user_id, Transaction.seller_id == user_id),
+             Transaction.status == "completed",
+             Transaction.completed_at >= now - timedelta(days=7)
+         ))),
+        ("Отзывы: уже оставленный отзыв",
+         select(Review).where(and_(
+             Review.transaction_id == 1,
+             Review.reviewer_id == user_id
+         ))),
+        ("Отзывы: отзывы о пользователе",
+         select(Review).where(Review.reviewed_id == user_id)),
+        ("Споры: активные сделки покупателя",
+         select(Transaction).where(and_(
+             Transaction.buyer_id == user_id,
+             Transaction.status == "pending"
+         ))),
+        ("Споры: мои споры",
+         select(Dispute).where(Dispute.initiator_id == user_id)
+         .order_by(Dispute.created_at.desc())),
+        ("Админ: очередь споров",
+         dispute_queue_query("after", 100)),
+        ("Админ: последние пользователи",
+         select(User).order_by(User.registered_at.desc()).limit(10)),
+        ("Админ: новые сделки за 24ч",
+         select(Transaction.id).where(Transaction.created_at >= now - timedelta(days=1))),
+        ("Очистка: устаревшие объявления",
+         expire_listings_statement(now - timedelta(days=3), 500)),
+    ]
+
+
+def _explain(conn: Connection) -> List[str]:
+    """Печатает EXPLAIN QUERY PLAN горячих запросов и возвращает те, что сканируют таблицу"""
+    scanning = []
+    for name, query in hot_queries():
+        compiled = query.compile(dialect=conn.dialect)
+        params = tuple(compiled.params[key] for key in compiled.positiontup)
+        plan = conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {compiled}", params).all()
+
+        print(f"-- {name}")
+        for row in plan:
+            detail = row[-1]
+            print(f"   {detail}")
+            # SCAN ... USING INDEX - обход индекса в нужном порядке, он останавливается на LIMIT
+            full_scan = detail.startswith("SCAN") and "USING" not in detail
+            if full_scan or "TEMP B-TREE" in detail:
+                scanning.append(name)
+    return scanning
+
+
+async def explain_hot_queries(engine: AsyncEngine) -> List[str]:
+    if engine.dialect.name != "sqlite":
+        raise RuntimeError("EXPLAIN QUERY PLAN поддерживается только для SQLite")
+    async with engine.connect() as conn:
+        return await conn.run_sync(_explain)
+
+
+# Схема до введения миграций (исходная версия models.py) и данные для проверки обновления
+BASELINE_SCHEMA = (
+    "CREATE TABLE users (id INTEGER NOT NULL PRIMARY KEY, telegram_id INTEGER UNIQUE, username VARCHAR, "
+    "phone_number VARCHAR, balance FLOAT, rating FLOAT, role VARCHAR(5), registered_at DATETIME)",
+    "CREATE TABLE phone_listings (id INTEGER NOT NULL PRIMARY KEY, seller_id INTEGER REFERENCES users (id), "
+    "service VARCHAR, duration INTEGER, price FLOAT, is_active BOOLEAN, created_at DATETIME)",
+    "CREATE TABLE transactions (id INTEGER NOT NULL PRIMARY KEY, buyer_id INTEGER REFERENCES users (id), "
+    "seller_id INTEGER REFERENCES users (id), listing_id INTEGER REFERENCES phone_listings (id), "
+    "amount FLOAT, status VARCHAR, created_at DATETIME, completed_at DATETIME)",
+    "CREATE TABLE disputes (id INTEGER NOT NULL PRIMARY KEY, transaction_id INTEGER REFERENCES transactions (id), "
+    "initiator_id INTEGER REFERENCES users (id), description VARCHAR, status VARCHAR, created_at DATETIME, "
+    "resolved_at DATETIME)",
+    "CREATE TABLE reviews (id INTEGER NOT NULL PRIMARY KEY, transaction_id INTEGER REFERENCES transactions (id), "
+    "reviewer_id INTEGER REFERENCES users (id), reviewed_id INTEGER REFERENCES users (id), rating INTEGER, "
+    "comment VARCHAR, created_at DATETIME)",
+    "INSERT INTO users VALUES (1, 11, 'seller', '+1', 12.5, 5.0, 'USER', '2024-01-01 00:00:00'), "
+    "(2, 22, 'buyer', '+2', 3.25, 5.0, 'USER', '2024-01-02 00:00:00'), "
+    "(3, 33, 'admin', '+3', 0, 5.0, 'ADMIN', '2024-01-03 00:00:00')",
+    "INSERT INTO phone_listings VALUES (1, 1, 'Telegram', 4, 2.0, 0, '2024-02-01 00:00:00'), "
+    "(2, 1, 'Google', 1, 3.0, 0, '2024-02-01 00:00:00'), (3, 2, 'Telegram', 12, 5.0, 1, '2024-02-02 00:00:00')",
+    "INSERT INTO transactions VALUES (1, 2, 1, 1, 2.0, 'completed', '2024-02-01 01:00:00', '2024-02-01 02:00:00'), "
+    "(2, 2, 1, 2, 3.0, 'completed', '2024-02-01 01:00:00', '2024-02-01 02:00:00')",
+    "INSERT INTO reviews VALUES (1, 1, 2, 1, 3, 'ok', '2024-02-01 03:00:00'), "
+    "(2, 2, 2, 1, 4, 'ok', '2024-02-01 03:00:00')",
+)
+
+# id пользователя -> ожидаемые значения после всех миграций
+BASELINE_EXPECTED = {
+    1: {"sold_count": 2, "bought_count": 0, "trade_volume": 5.0, "reviews_count": 2, "rating_sum": 7,
+        "rating": 3.5, "balance_minor": 12_500_000},
+    2: {"sold_count": 0, "bought_count": 2, "trade_volume": 5.0, "reviews_count": 0, "rating_sum": 0,
+        "rating": 5.0, "balance_minor": 3_250_000},
+}
+
+
+BASELINE_DAILY_STATS = [
+    ("2024-01-01 00:00:00.000000", 1, 0, 0, 0, 0, 0),
+    ("2024-01-02 00:00:00.000000", 1, 0, 0, 0, 0, 0),
+    ("2024-01-03 00:00:00.000000", 1, 0, 0, 0, 0, 0),
+    ("2024-02-01 00:00:00.000000", 0, 2, 2, 2, 5_000_000, 250_000),
+    ("2024-02-02 00:00:00.000000", 0, 1, 0, 0, 0, 0),
+]
+
+
+def _check_upgraded(conn: Connection) -> List[str]:
+    errors = []
+    for user_id, expected in BASELINE_EXPECTED.items():
+        row = conn.execute(select(User.__table__).where(User.id == user_id)).mappings().one()
+        for name, value in expected.items():
+            if row[name] != value:
+                errors.append(f"users.{name} (id={user_id}): {row[name]!r}, ожидалось {value!r}")
+    openings = conn.execute(select(LedgerEntry.user_id).order_by(LedgerEntry.user_id)).scalars().all()
+    if openings != [1, 2]:
+        errors.append(f"проводки открытия баланса: {openings}, ожидались [1, 2]")
+    # Сырые значения: bucket должен совпадать с форматом, в котором пишет record_stats
+    daily = [tuple(row) for row in conn.exec_driver_sql(
+        "SELECT bucket, new_users, new_listings, trades, completed_trades, volume_minor, fees_minor "
+        "FROM stats_daily ORDER BY bucket"
+    )]
+    if daily != BASELINE_DAILY_STATS:
+        errors.append(f"stats_daily: {daily}, ожидалось {BASELINE_DAILY_STATS}")
+    return errors
+
+
+async def check_upgrade() -> List[str]:
+    """Обновляет временную базу исходной схемы так же, как init_db, и сверяет данные"""
+    from .db import create_engine
+    from .models import Base
+
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_engine(f"sqlite+aiosqlite:///{os.path.join(directory, 'baseline.db')}", echo=False)
+        try:
+            async with engine.begin() as conn:
+                for statement in BASELINE_SCHEMA:
+                    await conn.exec_driver_sql(statement)
+            async with engine.begin() as conn:
+                await conn.run_sync(Base.metadata.create_all)
+            version = await run_migrations(engine)
+            if version != MIGRATIONS[-1].version:
+                return [f"версия схемы {version}, ожидалась {MIGRATIONS[-1].version}"]
+            async with engine.connect() as conn:
+                return await conn.run_sync(_check_upgraded)
+        finally:
+            await engine.dispose()
+
+
+async def _main(argv: List[str]) -> int:
+    if "--check-upgrade" in argv:
+        errors = await check_upgrade()
+        if errors:
+            print("❌ Обновление исходной схемы:\n  " + "\n  ".join(errors))
+            return 1
+        print(f"✅ База исходной схемы обновлена до версии {MIGRATIONS[-1].version}")
+        return 0
+
+    from .db import engine, init_db
+
+    await init_db()
+    print(f"Версия схемы: {await get_schema_version(engine)}")
+
+    if "--explain" in argv:
+        scanning = await explain_hot_queries(engine)
+        if scanning:
+            print("\n❌ Полное сканирование в запросах: " + ", ".join(sorted(set(scanning))))
+            return 1
+        print("\n✅ Все горячие запросы используют индексы")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(_main(sys.argv[1:])))
@@ -1,10 +1,13 @@
-from sqlalchemy import Column, Integer, String, Float, Boolean, ForeignKey, DateTime, Enum
+from sqlalchemy import Column, Integer, BigInteger, String, Float, Boolean, ForeignKey, DateTime, Enum, Index
 from sqlalchemy.ext.declarative import declarative_base
 from datetime import datetime
 import enum
 
 Base = declarative_base()
 
+# Суммы в ledger и balance_minor хранятся целыми миллионными долями USDT
+MINOR_UNITS = 1_000_000
+
 class UserRole(enum.Enum):
     USER = "user"
     ADMIN = "admin"
@@ -16,10 +19,21 @@ class User(Base):
     telegram_id = Column(Integer, unique=True)
     username = Column(String, nullable=True)
     phone_number = Column(String, nullable=True)
-    balance = Column(Float, default=0.0)
+    # Снимок баланса, поддерживаемый проводками ledger (см. database/ledger.py)
+    balance_minor = Column(BigInteger, default=0, nullable=False)
     rating = Column(Float, default=5.0)
     role = Column(Enum(UserRole), default=UserRole.USER)
     registered_at = Column(DateTime, default=datetime.utcnow)
+    # Счетчики для профиля (см. database/counters.py)
+    sold_count = Column(Integer, default=0)
+    bought_count = Column(Integer, default=0)
+    reviews_count = Column(Integer, default=0)
+    rating_sum = Column(Integer, default=0)  # рейтинг = rating_sum / reviews_count
+    trade_volume = Column(Float, default=0.0)
+
+    @property
+    def balance(self) -> float:
+        return (self.balance_minor or 0) / MINOR_UNITS
     
 class PhoneListing(Base):
     __tablename__ = 'phone_listings'
@@ -64,4 +78,104 @@ class Review(Base):
     reviewed_id = Column(Integer, ForeignKey('users.id'))
     rating = Column(Integer)  # от 1 до 5
     comment = Column(String)
-    created_at = Column(DateTime, default=datetime.utcnow) 
\ No newline at end of file
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class Deposit(Base):
+    __tablename__ = 'deposits'
+    
+    id = Column(Integer, primary_key=True)
+    invoice_id = Column(Integer, unique=True)  # ID инвойса CryptoBot, защищает от двойного зачисления
+    telegram_id = Column(Integer)
+    amount = Column(Float)
+    asset = Column(String)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class Broadcast(Base):
+    __tablename__ = 'broadcasts'
+    
+    id = Column(Integer, primary_key=True)
+    text = Column(String)
+    admin_chat_id = Column(Integer)
+    report_message_id = Column(Integer, nullable=True)  # сообщение с прогрессом у администратора
+    status = Column(String, default="running")  # running, completed
+    last_user_id = Column(Integer, default=0)  # рассылка продолжается с users.id > last_user_id
+    delivered = Column(Integer, default=0)
+    blocked = Column(Integer, default=0)
+    failed = Column(Integer, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    finished_at = Column(DateTime, nullable=True) 
+
+class LedgerEntry(Base):
+    """Проводка по балансу пользователя; строки только добавляются"""
+    __tablename__ = 'ledger'
+    __table_args__ = (Index('ix_ledger_user_id', 'user_id', 'id'),)
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    amount_minor = Column(BigInteger, nullable=False)  # + зачисление, - списание
+    balance_after_minor = Column(BigInteger, nullable=False)
+    kind = Column(String, nullable=False)  # deposit, purchase, refund, sale, withdrawal, ...
+    ref = Column(String, nullable=True)  # источник: listing:<id>, transaction:<id>, invoice:<id>, ...
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class LedgerCheckpoint(Base):
+    """Проверенный баланс пользователя по проводкам до entry_id включительно"""
+    __tablename__ = 'ledger_checkpoints'
+
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    balance_minor = Column(BigInteger, nullable=False)
+    entry_id = Column(Integer, nullable=False)
+    checked_at = Column(DateTime, default=datetime.utcnow)
+
+class _StatsRollup:
+    """Сводка событий платформы за интервал, начинающийся в bucket (UTC)"""
+    bucket = Column(DateTime, primary_key=True)
+    new_users = Column(Integer, default=0, nullable=False)
+    new_listings = Column(Integer, default=0, nullable=False)
+    trades = Column(Integer, default=0, nullable=False)  # созданные сделки
+    completed_trades = Column(Integer, default=0, nullable=False)
+    volume_minor = Column(BigInteger, default=0, nullable=False)  # объем завершенных сделок
+    fees_minor = Column(BigInteger, default=0, nullable=False)  # комиссия PLATFORM_FEE с объема
+
+class StatsHourly(_StatsRollup, Base):
+    __tablename__ = 'stats_hourly'
+
+class StatsDaily(_StatsRollup, Base):
+    __tablename__ = 'stats_daily'
+
+class OutboxMessage(Base):
+    """Уведомление, записанное в транзакции изменения; отправляется services/outbox.py"""
+    __tablename__ = 'outbox'
+    __table_args__ = (
+        Index('ix_outbox_status_id', 'status', 'id'),
+        # Первое ожидающее сообщение каждого чата и очередь чата (services/outbox.py)
+        Index('ix_outbox_status_chat_id', 'status', 'chat_id', 'id'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    chat_id = Column(Integer, nullable=False)
+    text = Column(String, nullable=False)
+    reply_markup = Column(String, nullable=True)  # JSON inline-клавиатуры
+    status = Column(String, default="pending", nullable=False)  # pending, delivered, failed
+    attempts = Column(Integer, default=0, nullable=False)
+    next_attempt_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    last_error = Column(String, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    delivered_at = Column(DateTime, nullable=True)
+
+class Withdrawal(Base):
+    """Вывод в CryptoBot; списание проведено в той же транзакции, что и создание записи"""
+    __tablename__ = 'withdrawals'
+    __table_args__ = (Index('ix_withdrawals_status_next', 'status', 'next_attempt_at'),)
+
+    id = Column(Integer, primary_key=True)
+    spend_id = Column(String, unique=True, nullable=False)  # повторы перевода идут с тем же spend_id
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    telegram_id = Column(Integer, nullable=False)
+    amount_minor = Column(BigInteger, nullable=False)
+    status = Column(String, default="pending", nullable=False)  # pending, completed, rejected, review
+    attempts = Column(Integer, default=0, nullable=False)  # попыток с неизвестным исходом
+    next_attempt_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    last_error = Column(String, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    finished_at = Column(DateTime, nullable=True)
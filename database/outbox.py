@@ -0,0 +1,41 @@
+"""Запись уведомлений в outbox.
+
+Обработчик не отправляет уведомления сам: enqueue() добавляет строку outbox
+в сессию, и она фиксируется тем же коммитом, что и изменение, о котором
+уведомление. Если транзакция откатилась, уведомления нет; если
+зафиксирована - оно будет отправлено, даже если процесс перезапустится.
+Отправкой занимается services/outbox.py.
+"""
+from typing import Callable, Optional
+
+from aiogram.types import InlineKeyboardMarkup
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .db import after_commit
+from .models import OutboxMessage
+
+# Сигнал отправителю в этом процессе: в outbox появились сообщения
+_wakeup: Optional[Callable[[], None]] = None
+
+
+def set_wakeup(callback: Optional[Callable[[], None]]):
+    global _wakeup
+    _wakeup = callback
+
+
+def _notify_sender():
+    if _wakeup is not None:
+        _wakeup()
+
+
+def enqueue(session: AsyncSession, chat_id: int, text: str,
+            reply_markup: Optional[InlineKeyboardMarkup] = None) -> OutboxMessage:
+    """Ставит уведомление в очередь в транзакции сессии"""
+    message = OutboxMessage(
+        chat_id=chat_id,
+        text=text,
+        reply_markup=reply_markup.model_dump_json(exclude_none=True) if reply_markup else None
+    )
+    session.add(message)
+    after_commit(session, _notify_sender)
+    return message
@@ -0,0 +1,171 @@
+"""Почасовые и посуточные сводки статистики платформы.
+
+События (регистрация, объявление, сделка, завершение сделки) учитываются
+в строках stats_hourly и stats_daily своего часа и суток. Изменения сессии
+накапливаются и записываются перед коммитом одним UPSERT на таблицу, в той же
+транзакции, что и само событие. Статистика за любой период складывается из
+посуточных строк целых суток и почасовых строк по краям периода.
+Пересчет из исходных таблиц: python -m database.rollups
+"""
+import asyncio
+from datetime import datetime, timedelta
+from typing import NamedTuple, Optional
+
+from sqlalchemy import event, select, delete, insert, func, and_, or_, union_all
+from sqlalchemy.engine import Connection
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from config import PLATFORM_FEE
+from .models import User, PhoneListing, Transaction, StatsHourly, StatsDaily
+from .ledger import to_minor
+
+COLUMNS = ("new_users", "new_listings", "trades", "completed_trades", "volume_minor", "fees_minor")
+ALL_TIME = datetime(1970, 1, 1)
+
+_PENDING = "stats_deltas"
+
+
+class StatsTotals(NamedTuple):
+    new_users: int = 0
+    new_listings: int = 0
+    trades: int = 0
+    completed_trades: int = 0
+    volume_minor: int = 0
+    fees_minor: int = 0
+
+
+def hour_start(moment: datetime) -> datetime:
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+
+def day_start(moment: datetime) -> datetime:
+    return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def platform_fee(volume_minor: int) -> int:
+    return round(volume_minor * PLATFORM_FEE)
+
+
+def record_stats(session: AsyncSession, at: Optional[datetime] = None, **deltas: int):
+    """Учитывает событие в сводках часа и суток момента at (по умолчанию - сейчас)"""
+    at = at or datetime.utcnow()
+    pending = session.info.setdefault(_PENDING, {})
+    for model, bucket in ((StatsHourly, hour_start(at)), (StatsDaily, day_start(at))):
+        row = pending.setdefault((model, bucket), dict.fromkeys(COLUMNS, 0))
+        for name, value in deltas.items():
+            row[name] += value
+
+
+def _upsert(model, dialect_name: str):
+    from .db import dialect_insert
+
+    statement = dialect_insert(model.__table__, dialect_name)
+    return statement.on_conflict_do_update(
+        index_elements=["bucket"],
+        set_={name: model.__table__.c[name] + statement.excluded[name] for name in COLUMNS}
+    )
+
+
+@event.listens_for(Session, "before_commit")
+def _write_pending_stats(session):
+    pending = session.info.pop(_PENDING, None)
+    if not pending:
+        return
+    dialect_name = session.get_bind().dialect.name
+    for model in (StatsHourly, StatsDaily):
+        rows = [{"bucket": bucket, **row} for (row_model, bucket), row in pending.items() if row_model is model]
+        session.execute(_upsert(model, dialect_name), rows)
+
+
+@event.listens_for(Session, "after_rollback")
+def _drop_pending_stats(session):
+    session.info.pop(_PENDING, None)
+
+
+def _sums(model, *conditions):
+    return select(*(model.__table__.c[name] for name in COLUMNS)).where(*conditions)
+
+
+async def window_totals(session: AsyncSession, start: datetime, end: Optional[datetime] = None) -> StatsTotals:
+    """Сумма сводок за [start, end) с точностью до часа; читает не больше (сутки + 48) строк"""
+    end = end or datetime.utcnow()
+    start = hour_start(start)
+    first_day = day_start(start) if start == day_start(start) else day_start(start) + timedelta(days=1)
+    last_day = day_start(end)
+
+    if first_day < last_day:
+        rows = union_all(
+            _sums(StatsDaily, StatsDaily.bucket >= first_day, StatsDaily.bucket < last_day),
+            _sums(StatsHourly, or_(
+                and_(StatsHourly.bucket >= start, StatsHourly.bucket < first_day),
+                and_(StatsHourly.bucket >= last_day, StatsHourly.bucket < end)
+            ))
+        ).subquery()
+    else:
+        rows = _sums(StatsHourly, StatsHourly.bucket >= start, StatsHourly.bucket < end).subquery()
+
+    totals = (await session.execute(
+        select(*(func.coalesce(func.sum(rows.c[name]), 0) for name in COLUMNS))
+    )).one()
+    return StatsTotals(*(int(value) for value in totals))
+
+
+def _bucket(column, period: str, dialect_name: str):
+    if dialect_name == "postgresql":
+        return func.date_trunc(period, column)
+    return func.strftime("%Y-%m-%d %H:00:00" if period == "hour" else "%Y-%m-%d 00:00:00", column)
+
+
+def rebuild_rollups(conn: Connection) -> None:
+    """Пересчитывает сводки из пользователей, объявлений и сделок"""
+    completed_at = func.coalesce(Transaction.completed_at, Transaction.created_at)
+    # Удаление первым: дальнейшие выборки идут уже под блокировкой записи
+    conn.execute(delete(StatsHourly))
+    conn.execute(delete(StatsDaily))
+
+    for model, period in ((StatsHourly, "hour"), (StatsDaily, "day")):
+        rows = {}
+
+        def add(bucket, **values):
+            if bucket is None:
+                return
+            if not isinstance(bucket, datetime):
+                bucket = datetime.fromisoformat(bucket)
+            row = rows.setdefault(bucket, {"bucket": bucket, **dict.fromkeys(COLUMNS, 0)})
+            for name, value in values.items():
+                row[name] += value
+
+        for name, column in (("new_users", User.registered_at),
+                             ("new_listings", PhoneListing.created_at),
+                             ("trades", Transaction.created_at)):
+            bucket = _bucket(column, period, conn.dialect.name)
+            for value, count in conn.execute(select(bucket, func.count()).group_by(bucket)):
+                add(value, **{name: count})
+
+        bucket = _bucket(completed_at, period, conn.dialect.name)
+        query = (
+            select(bucket, func.count(), func.coalesce(func.sum(Transaction.amount), 0))
+            .where(Transaction.status == "completed")
+        )
+        for value, count, volume in conn.execute(query.group_by(bucket)):
+            volume_minor = to_minor(volume)
+            add(value, completed_trades=count, volume_minor=volume_minor, fees_minor=platform_fee(volume_minor))
+
+        if rows:
+            conn.execute(insert(model), list(rows.values()))
+
+
+async def _main():
+    from .db import engine, read_engine, init_db
+
+    await init_db()
+    async with engine.begin() as conn:
+        await conn.run_sync(rebuild_rollups)
+    await engine.dispose()
+    await read_engine.dispose()
+    print("✅ Сводки статистики пересчитаны")
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
@@ -0,0 +1,68 @@
+"""Покупка объявления, безопасная при одновременных покупателях.
+
+Проверки не выполняются в Python по прочитанным строкам, а входят в условия
+UPDATE, поэтому две одновременные покупки одного объявления не могут обе
+пройти, а списания с баланса не теряются:
+
+1. объявление снимается, только если оно еще активно (UPDATE ... WHERE
+   is_active ... RETURNING);
+2. средства списываются проводкой журнала, только если их хватает (UPDATE
+   ... WHERE balance_minor >= price); если не хватает, объявление
+   возвращается в продажу в той же транзакции - строка объявления
+   заблокирована нами до коммита;
+3. создается сделка.
+
+Все шаги выполняются в транзакции сессии и фиксируются одним коммитом.
+"""
+from typing import NamedTuple, Optional
+
+from sqlalchemy import update, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .models import User, PhoneListing, Transaction
+from .ledger import post, to_minor, from_minor, PURCHASE
+from .rollups import record_stats
+
+PURCHASED = "purchased"
+UNAVAILABLE = "unavailable"
+INSUFFICIENT_FUNDS = "insufficient_funds"
+
+
+class PurchaseResult(NamedTuple):
+    status: str
+    listing: Optional[PhoneListing] = None
+    transaction: Optional[Transaction] = None
+    balance: Optional[float] = None  # баланс покупателя после попытки
+
+
+async def purchase_listing(session: AsyncSession, listing_id: int, buyer_id: int) -> PurchaseResult:
+    listing = (await session.execute(
+        update(PhoneListing)
+        .where(PhoneListing.id == listing_id, PhoneListing.is_active == True)
+        .values(is_active=False)
+        .returning(PhoneListing)
+    )).scalar_one_or_none()
+    if listing is None:
+        return PurchaseResult(UNAVAILABLE)
+
+    balance = await post(
+        session, buyer_id, -to_minor(listing.price), PURCHASE, f"listing:{listing_id}", require_funds=True
+    )
+    if balance is None:
+        await session.execute(
+            update(PhoneListing).where(PhoneListing.id == listing_id).values(is_active=True)
+        )
+        balance = await session.scalar(select(User.balance_minor).where(User.id == buyer_id))
+        return PurchaseResult(INSUFFICIENT_FUNDS, listing, balance=from_minor(balance or 0))
+
+    transaction = Transaction(
+        buyer_id=buyer_id,
+        seller_id=listing.seller_id,
+        listing_id=listing_id,
+        amount=listing.price,
+        status="pending"
+    )
+    session.add(transaction)
+    record_stats(session, trades=1)
+    await session.flush()
+    return PurchaseResult(PURCHASED, listing, transaction, from_minor(balance))
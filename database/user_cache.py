@@ -0,0 +1,132 @@
+"""Кэш пользователей по telegram_id.
+
+Почти каждое обновление начинается с поиска пользователя. Кэш хранит снимки
+строк users (и отметку "не зарегистрирован") в ограниченном LRU на
+USER_CACHE_TTL секунд. Снимок подключается к сессии обновления без запроса к
+БД, поэтому изменения пользователя в обработчике сохраняются как обычно.
+Запись сбрасывается, когда пользователь меняется через ORM (регистрация,
+баланс); после массовых UPDATE (рейтинг, счетчики, пополнение) нужно вызвать
+invalidate_users(). Изменения из других процессов видны не позже чем через TTL,
+поэтому операции со средствами перечитывают баланс из БД.
+"""
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from sqlalchemy import event, inspect, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, make_transient_to_detached
+
+from config import USER_CACHE_SIZE, USER_CACHE_TTL
+from .models import User
+
+# Отметка "пользователь не зарегистрирован"
+_MISSING = object()
+
+
+class UserCache:
+    def __init__(self, maxsize: int = USER_CACHE_SIZE, ttl: float = USER_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # telegram_id -> (истекает, снимок колонок или _MISSING)
+        self._entries: "OrderedDict[int, tuple]" = OrderedDict()
+        # users.id -> telegram_id, для сброса по первичному ключу
+        self._telegram_ids: Dict[int, int] = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _snapshot(user: User) -> dict:
+        return {attr.key: getattr(user, attr.key) for attr in inspect(User).column_attrs}
+
+    def _store(self, telegram_id: int, value):
+        if self.maxsize <= 0:
+            return
+        self._entries[telegram_id] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(telegram_id)
+        if value is not _MISSING:
+            self._telegram_ids[value["id"]] = telegram_id
+        while len(self._entries) > self.maxsize:
+            old_id, (_, old_value) = self._entries.popitem(last=False)
+            if old_value is not _MISSING:
+                self._telegram_ids.pop(old_value["id"], None)
+
+    def _lookup(self, telegram_id: int):
+        entry = self._entries.get(telegram_id)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires < time.monotonic():
+            self.invalidate(telegram_id)
+            return None
+        self._entries.move_to_end(telegram_id)
+        return value
+
+    async def resolve(self, session: AsyncSession, telegram_id: int) -> Optional[User]:
+        """Пользователь по telegram_id, подключенный к сессии; None - не зарегистрирован"""
+        value = self._lookup(telegram_id)
+        if value is not None:
+            self.hits += 1
+            if value is _MISSING:
+                return None
+            user = User(**value)
+            make_transient_to_detached(user)
+            return await session.merge(user, load=False)
+
+        self.misses += 1
+        user = await session.scalar(select(User).where(User.telegram_id == telegram_id))
+        self._store(telegram_id, self._snapshot(user) if user else _MISSING)
+        return user
+
+    def invalidate(self, telegram_id: int):
+        entry = self._entries.pop(telegram_id, None)
+        if entry is not None and entry[1] is not _MISSING:
+            self._telegram_ids.pop(entry[1]["id"], None)
+
+    def invalidate_id(self, *user_ids: int):
+        """Сбрасывает записи по users.id"""
+        for user_id in user_ids:
+            telegram_id = self._telegram_ids.get(user_id)
+            if telegram_id is not None:
+                self.invalidate(telegram_id)
+
+    def clear(self):
+        self._entries.clear()
+        self._telegram_ids.clear()
+
+    def stats(self) -> dict:
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+user_cache = UserCache()
+
+
+def invalidate_users(session: AsyncSession, *user_ids: int):
+    """Сбрасывает кэш после массового UPDATE пользователей по users.id (сейчас и после коммита)"""
+    user_cache.invalidate_id(*user_ids)
+    session.info.setdefault("changed_user_ids", set()).update(user_ids)
+
+
+@event.listens_for(Session, "after_flush")
+def _invalidate_flushed_users(session, flush_context):
+    changed = session.info.setdefault("changed_users", set())
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, User):
+            telegram_id = inspect(obj).dict.get("telegram_id")
+            if telegram_id is not None:
+                changed.add(telegram_id)
+                user_cache.invalidate(telegram_id)
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_committed_users(session):
+    # Повторно: параллельное обновление могло закэшировать строку до коммита
+    for telegram_id in session.info.pop("changed_users", ()):
+        user_cache.invalidate(telegram_id)
+    user_cache.invalidate_id(*session.info.pop("changed_user_ids", ()))
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_changed_users(session):
+    session.info.pop("changed_users", None)
+    session.info.pop("changed_user_ids", None)
@@ -2,11 +2,21 @@ from aiogram import Router, F, types
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
-from database.db import get_session
+from sqlalchemy.ext.asyncio import AsyncSession
 from database.models import User, Transaction, Dispute, PhoneListing, Review
 from datetime import datetime, timedelta
 from sqlalchemy import select, and_, or_, func
+from database.ledger import post, to_minor, from_minor, ADJUSTMENT
+from database.rollups import window_totals, ALL_TIME
+from database.disputes import fetch_dispute_page, fetch_dispute, AFTER, BEFORE, FROM
+from database.outbox import enqueue
+from aiogram.filters import Command, CommandObject, StateFilter
+from aiogram.exceptions import TelegramBadRequest
+from handlers.disputes import get_admin_dispute_keyboard
+from services.broadcast import create_broadcast
+from services.metrics import collect_snapshot, summarize, BACKGROUND
 from config import ADMIN_IDS
+from services.text_router import text_router
 
 router = Router()
 
@@ -21,7 +31,7 @@ def get_admin_keyboard():
             [KeyboardButton(text="📊 Статистика"), KeyboardButton(text="👥 Пользователи")],
             [KeyboardButton(text="💰 Управление балансами"), KeyboardButton(text="⚠️ Активные споры")],
             [KeyboardButton(text="📢 Сделать объявление"), KeyboardButton(text="🔒 Заблокировать пользователя")],
-            [KeyboardButton(text="❌ Выйти из панели админа")]
+            [KeyboardButton(text="📈 Метрики"), KeyboardButton(text="❌ Выйти из панели админа")]
         ],
         resize_keyboard=True
     )
@@ -30,7 +40,7 @@ def get_admin_keyboard():
 async def check_admin(user_id: int) -> bool:
     return user_id in ADMIN_IDS
 
-@router.message(lambda message: message.text == "🔑 Панель администратора")
+@text_router.button("🔑 Панель администратора")
 async def show_admin_panel(message: types.Message):
     if not await check_admin(message.from_user.id):
         await message.answer("❌ У вас нет прав администратора!")
@@ -42,67 +52,162 @@ async def show_admin_panel(message: types.Message):
         reply_markup=get_admin_keyboard()
     )
 
-@router.message(lambda message: message.text == "📊 Статистика")
-async def show_statistics(message: types.Message):
+# Периоды статистики: ключ callback -> (подпись, длительность; None - за все время)
+STATS_WINDOWS = {
+    "24h": ("24 часа", timedelta(days=1)),
+    "7d": ("7 дней", timedelta(days=7)),
+    "30d": ("30 дней", timedelta(days=30)),
+    "all": ("все время", None),
+}
+# Наибольший период /stats N, дней
+STATS_MAX_DAYS = 3650
+
+def get_stats_keyboard():
+    return InlineKeyboardMarkup(
+        inline_keyboard=[[
+            InlineKeyboardButton(text=label, callback_data=f"stats_{key}")
+            for key, (label, _) in STATS_WINDOWS.items()
+        ]]
+    )
+
+async def render_statistics(reader: AsyncSession, start: datetime, end: datetime, label: str) -> str:
+    """Текст статистики за [start, end) по сводкам database/rollups.py"""
+    window = await window_totals(reader, start, end)
+    overall = await window_totals(reader, ALL_TIME, end)
+    active_listings = await reader.scalar(
+        select(func.count(PhoneListing.id)).where(PhoneListing.is_active == True)
+    )
+    
+    return (
+        "📊 Статистика платформы\n\n"
+        f"👥 Всего пользователей: {overall.new_users}\n"
+        f"📱 Активных объявлений: {active_listings}\n\n"
+        f"За {label}:\n"
+        f"🆕 Новых пользователей: {window.new_users}\n"
+        f"📱 Новых объявлений: {window.new_listings}\n"
+        f"💰 Новых сделок: {window.trades}\n"
+        f"✅ Завершенных сделок: {window.completed_trades}\n"
+        f"💵 Объем сделок: {from_minor(window.volume_minor):.2f} USDT\n"
+        f"📈 Заработок платформы: {from_minor(window.fees_minor):.2f} USDT"
+    )
+
+def parse_stats_window(args: str):
+    """Период из аргументов /stats: "N" - последние N дней, "ДД.ММ.ГГГГ ДД.ММ.ГГГГ" - даты включительно"""
+    now = datetime.utcnow()
+    parts = (args or "").split()
+    if not parts:
+        return now - timedelta(days=1), now, "24 часа"
+    if len(parts) == 1:
+        days = int(parts[0])
+        if not 1 <= days <= STATS_MAX_DAYS:
+            raise ValueError(f"days out of range: {days}")
+        return now - timedelta(days=days), now, f"{days} дн."
+    start = datetime.strptime(parts[0], "%d.%m.%Y")
+    end = datetime.strptime(parts[1], "%d.%m.%Y") + timedelta(days=1)
+    if start >= end:
+        raise ValueError("empty window")
+    return start, min(end, now), f"{parts[0]} - {parts[1]}"
+
+@text_router.button("📊 Статистика")
+async def show_statistics(message: types.Message, reader: AsyncSession):
     if not await check_admin(message.from_user.id):
         return
     
-    async with await get_session() as session:
-        # Общая статистика
-        users_count = await session.scalar(select(func.count(User.id)))
-        active_listings = await session.scalar(
-            select(func.count(PhoneListing.id)).where(PhoneListing.is_active == True)
-        )
-        
-        # Статистика за последние 24 часа
-        day_ago = datetime.utcnow() - timedelta(days=1)
-        new_users = await session.scalar(
-            select(func.count(User.id)).where(User.registered_at >= day_ago)
-        )
-        new_transactions = await session.scalar(
-            select(func.count(Transaction.id)).where(Transaction.created_at >= day_ago)
-        )
-        
-        # Финансовая статистика
-        total_volume = await session.scalar(
-            select(func.sum(Transaction.amount)).where(Transaction.status == "completed")
-        )
-        platform_earnings = total_volume * (5 / 100) if total_volume else 0
-        
+    now = datetime.utcnow()
+    await message.answer(
+        await render_statistics(reader, now - timedelta(days=1), now, "24 часа"),
+        reply_markup=get_stats_keyboard()
+    )
+
+@router.callback_query(lambda c: c.data.startswith("stats_"))
+async def switch_statistics_window(callback: types.CallbackQuery, reader: AsyncSession):
+    if not await check_admin(callback.from_user.id):
+        await callback.answer("❌ У вас нет прав администратора!")
+        return
+    
+    window = STATS_WINDOWS.get(callback.data[len("stats_"):])
+    if window is None:
+        await callback.answer()
+        return
+    label, duration = window
+    now = datetime.utcnow()
+    start = now - duration if duration else ALL_TIME
+    
+    await edit_admin_message(callback, await render_statistics(reader, start, now, label), get_stats_keyboard())
+    await callback.answer()
+
+@router.message(Command("stats"))
+async def show_statistics_window(message: types.Message, command: CommandObject, reader: AsyncSession):
+    if not await check_admin(message.from_user.id):
+        return
+    
+    try:
+        start, end, label = parse_stats_window(command.args)
+    except (ValueError, OverflowError):
         await message.answer(
-            "📊 Статистика платформы\n\n"
-            f"👥 Всего пользователей: {users_count}\n"
-            f"📱 Активных объявлений: {active_listings}\n"
-            f"🆕 Новых пользователей за 24ч: {new_users}\n"
-            f"💰 Новых сделок за 24ч: {new_transactions}\n"
-            f"💵 Общий объем сделок: {total_volume:.2f} USDT\n"
-            f"📈 Заработок платформы: {platform_earnings:.2f} USDT"
+            f"❌ Формат: /stats [дней, 1-{STATS_MAX_DAYS}] или /stats ДД.ММ.ГГГГ ДД.ММ.ГГГГ"
         )
+        return
+    
+    await message.answer(await render_statistics(reader, start, end, label))
+
+# Обработчиков в сводке метрик (самые затратные по суммарному времени)
+METRICS_TOP = 15
 
-@router.message(lambda message: message.text == "👥 Пользователи")
-async def show_users(message: types.Message):
+def render_metrics(snapshot: dict) -> str:
+    """Текст сводки по метрикам обработчиков services/metrics.py"""
+    rows = summarize(snapshot)
+    if not rows:
+        return "📈 Метрик пока нет: с запуска не обработано ни одного обновления."
+    
+    updates = sum(row["updates"] for row in rows)
+    errors = sum(m["errors"] for m in snapshot["handlers"].values())
+    background = sum(calls for handler, _, calls, _ in snapshot["api"] if handler == BACKGROUND)
+    text = (
+        "📈 Метрики обработчиков с запуска\n\n"
+        f"Обновлений: {updates}, ошибок: {errors / updates:.1%}\n"
+        f"Запросов к Bot API вне обновлений: {background}\n"
+    )
+    for row in rows[:METRICS_TOP]:
+        text += (
+            f"\n{row['handler']}\n"
+            f"  {row['updates']} обн., ошибок {row['error_rate']:.1%}, "
+            f"p50 {row['p50'] * 1000:.0f} мс, p95 {row['p95'] * 1000:.0f} мс\n"
+            f"  SQL: {row['queries']:.1f} запр., {row['query_time'] * 1000:.1f} мс; "
+            f"Bot API: {row['api_calls']:.1f} запр.\n"
+        )
+    return text
+
+@text_router.button("📈 Метрики")
+async def show_metrics(message: types.Message):
     if not await check_admin(message.from_user.id):
         return
     
-    async with await get_session() as session:
-        query = select(User).order_by(User.registered_at.desc()).limit(10)
-        result = await session.execute(query)
-        users = result.scalars().all()
-        
-        response = "👥 Последние 10 пользователей:\n\n"
-        for user in users:
-            response += (
-                f"ID: {user.telegram_id}\n"
-                f"Username: @{user.username or 'Нет'}\n"
-                f"Баланс: {user.balance} USDT\n"
-                f"Рейтинг: ⭐️ {user.rating}\n"
-                f"Регистрация: {user.registered_at.strftime('%d.%m.%Y %H:%M')}\n"
-                "➖➖➖➖➖➖➖➖➖➖\n"
-            )
-        
-        await message.answer(response)
+    await message.answer(render_metrics(await collect_snapshot()))
+
+@text_router.button("👥 Пользователи")
+async def show_users(message: types.Message, reader: AsyncSession):
+    if not await check_admin(message.from_user.id):
+        return
+    
+    query = select(User).order_by(User.registered_at.desc()).limit(10)
+    result = await reader.execute(query)
+    users = result.scalars().all()
+    
+    response = "👥 Последние 10 пользователей:\n\n"
+    for user in users:
+        response += (
+            f"ID: {user.telegram_id}\n"
+            f"Username: @{user.username or 'Нет'}\n"
+            f"Баланс: {user.balance} USDT\n"
+            f"Рейтинг: ⭐️ {user.rating}\n"
+            f"Регистрация: {user.registered_at.strftime('%d.%m.%Y %H:%M')}\n"
+            "➖➖➖➖➖➖➖➖➖➖\n"
+        )
+    
+    await message.answer(response)
 
-@router.message(lambda message: message.text == "💰 Управление балансами")
+@text_router.button("💰 Управление балансами")
 async def manage_balance_start(message: types.Message, state: FSMContext):
     if not await check_admin(message.from_user.id):
         return
@@ -116,8 +221,8 @@ async def manage_balance_start(message: types.Message, state: FSMContext):
         )
     )
 
-@router.message(AdminStates.waiting_for_user_id)
-async def process_user_id(message: types.Message, state: FSMContext):
+@router.message(StateFilter(AdminStates.waiting_for_user_id))
+async def process_user_id(message: types.Message, state: FSMContext, session: AsyncSession):
     if message.text == "❌ Отмена":
         await state.clear()
         await message.answer(
@@ -127,25 +232,25 @@ async def process_user_id(message: types.Message, state: FSMContext):
         return
     
     try:
-        user_id = int(message.text)
-        async with await get_session() as session:
-            user = await session.get(User, user_id)
-            if not user:
-                await message.answer("❌ Пользователь не найден!")
-                return
-            
-            await state.update_data(user_id=user_id)
-            await state.set_state(AdminStates.entering_balance)
-            
-            await message.answer(
-                f"Текущий баланс пользователя: {user.balance} USDT\n"
-                "Введите новый баланс:"
-            )
+        # Администратор вводит Telegram ID (его показывает список пользователей)
+        telegram_id = int(message.text)
+        user = await session.scalar(select(User).where(User.telegram_id == telegram_id))
+        if not user:
+            await message.answer("❌ Пользователь не найден!")
+            return
+        
+        await state.update_data(user_id=user.id)
+        await state.set_state(AdminStates.entering_balance)
+        
+        await message.answer(
+            f"Текущий баланс пользователя: {user.balance} USDT\n"
+            "Введите новый баланс:"
+        )
     except:
         await message.answer("❌ Введите корректный ID пользователя!")
 
-@router.message(AdminStates.entering_balance)
-async def process_new_balance(message: types.Message, state: FSMContext):
+@router.message(StateFilter(AdminStates.entering_balance))
+async def process_new_balance(message: types.Message, state: FSMContext, session: AsyncSession):
     if message.text == "❌ Отмена":
         await state.clear()
         await message.answer(
@@ -159,60 +264,122 @@ async def process_new_balance(message: types.Message, state: FSMContext):
         data = await state.get_data()
         user_id = data['user_id']
         
-        async with await get_session() as session:
-            user = await session.get(User, user_id)
-            old_balance = user.balance
-            user.balance = new_balance
-            await session.commit()
-            
-            await message.answer(
-                f"✅ Баланс пользователя обновлен!\n"
-                f"Старый баланс: {old_balance} USDT\n"
-                f"Новый баланс: {new_balance} USDT",
-                reply_markup=get_admin_keyboard()
-            )
-            
-            # Уведомляем пользователя
-            await message.bot.send_message(
-                user.telegram_id,
-                f"💰 Ваш баланс был изменен администратором\n"
-                f"Новый баланс: {new_balance} USDT"
-            )
+        user = await session.get(User, user_id, populate_existing=True)
+        old_balance = user.balance
+        # Изменение записывается проводкой на разницу с текущим балансом
+        balance = await post(
+            session, user.id, to_minor(new_balance) - user.balance_minor, ADJUSTMENT,
+            f"admin:{message.from_user.id}"
+        )
+        new_balance = from_minor(balance)
+        
+        # Уведомляем пользователя; уведомление фиксируется вместе с проводкой до ответа
+        enqueue(
+            session,
+            user.telegram_id,
+            f"💰 Ваш баланс был изменен администратором\n"
+            f"Новый баланс: {new_balance} USDT"
+        )
+        
+        await message.answer(
+            f"✅ Баланс пользователя обновлен!\n"
+            f"Старый баланс: {old_balance} USDT\n"
+            f"Новый баланс: {new_balance} USDT",
+            reply_markup=get_admin_keyboard()
+        )
     except:
         await message.answer("❌ Введите корректную сумму!")
     
     await state.clear()
 
-@router.message(lambda message: message.text == "⚠️ Активные споры")
-async def show_active_disputes(message: types.Message):
+# Длина описания спора в списке; полностью оно видно в карточке спора
+DISPUTE_PREVIEW_LENGTH = 200
+
+def format_dispute(row, preview: bool = False) -> str:
+    description = row.description or ""
+    if preview and len(description) > DISPUTE_PREVIEW_LENGTH:
+        description = description[:DISPUTE_PREVIEW_LENGTH] + "…"
+    return (
+        f"⚠️ Спор #{row.id}\n"
+        f"Покупатель: @{row.buyer_username or row.buyer_telegram_id}\n"
+        f"Продавец: @{row.seller_username or row.seller_telegram_id}\n"
+        f"Сумма: {row.amount} USDT\n"
+        f"Описание: {description}\n"
+        f"Создан: {row.created_at.strftime('%d.%m.%Y %H:%M')}"
+    )
+
+def render_dispute_page(page):
+    """Текст и клавиатура страницы очереди споров"""
+    text = "⚠️ Активные споры\n\n" + "\n➖➖➖➖➖➖➖➖➖➖\n".join(
+        format_dispute(row, preview=True) for row in page.rows
+    )
+    keyboard = [[
+        InlineKeyboardButton(text=f"#{row.id}", callback_data=f"dispute_view_{row.id}")
+        for row in page.rows
+    ]]
+    navigation = []
+    if page.has_prev:
+        navigation.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=f"disputes_{BEFORE}_{page.rows[0].id}"))
+    if page.has_next:
+        navigation.append(InlineKeyboardButton(text="➡️ Далее", callback_data=f"disputes_{AFTER}_{page.rows[-1].id}"))
+    if navigation:
+        keyboard.append(navigation)
+    return text, InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+async def edit_admin_message(callback: types.CallbackQuery, text: str, reply_markup=None):
+    try:
+        await callback.message.edit_text(text, reply_markup=reply_markup)
+    except TelegramBadRequest:
+        # Сообщение не изменилось
+        pass
+
+@text_router.button("⚠️ Активные споры")
+async def show_active_disputes(message: types.Message, reader: AsyncSession):
     if not await check_admin(message.from_user.id):
         return
     
-    async with await get_session() as session:
-        query = select(Dispute).where(Dispute.status == "open")
-        result = await session.execute(query)
-        disputes = result.scalars().all()
-        
-        if not disputes:
-            await message.answer("✅ Активных споров нет!")
-            return
-        
-        for dispute in disputes:
-            transaction = await session.get(Transaction, dispute.transaction_id)
-            buyer = await session.get(User, transaction.buyer_id)
-            seller = await session.get(User, transaction.seller_id)
-            
-            await message.answer(
-                f"⚠️ Спор #{dispute.id}\n\n"
-                f"Покупатель: @{buyer.username or buyer.telegram_id}\n"
-                f"Продавец: @{seller.username or seller.telegram_id}\n"
-                f"Сумма: {transaction.amount} USDT\n"
-                f"Описание: {dispute.description}\n"
-                f"Создан: {dispute.created_at.strftime('%d.%m.%Y %H:%M')}",
-                reply_markup=get_admin_dispute_keyboard(dispute.id)
-            )
+    page = await fetch_dispute_page(reader)
+    if not page.rows:
+        await message.answer("✅ Активных споров нет!")
+        return
+    
+    text, keyboard = render_dispute_page(page)
+    await message.answer(text, reply_markup=keyboard)
+
+@router.callback_query(lambda c: c.data.startswith("disputes_"))
+async def turn_disputes_page(callback: types.CallbackQuery, reader: AsyncSession):
+    if not await check_admin(callback.from_user.id):
+        await callback.answer("❌ У вас нет прав администратора!")
+        return
+    
+    _, direction, cursor_id = callback.data.split("_")
+    page = await fetch_dispute_page(reader, direction, int(cursor_id))
+    if not page.rows:
+        await edit_admin_message(callback, "✅ Активных споров нет!", None)
+    else:
+        await edit_admin_message(callback, *render_dispute_page(page))
+    await callback.answer()
+
+@router.callback_query(lambda c: c.data.startswith("dispute_view_"))
+async def show_dispute_card(callback: types.CallbackQuery, reader: AsyncSession):
+    if not await check_admin(callback.from_user.id):
+        await callback.answer("❌ У вас нет прав администратора!")
+        return
+    
+    dispute_id = int(callback.data.split("_")[2])
+    row = await fetch_dispute(reader, dispute_id)
+    if not row or row.status != "open":
+        await callback.answer("❌ Спор уже закрыт или не существует!")
+        return
+    
+    keyboard = get_admin_dispute_keyboard(dispute_id)
+    keyboard.inline_keyboard.append([
+        InlineKeyboardButton(text="⬅️ К списку", callback_data=f"disputes_{FROM}_{dispute_id}")
+    ])
+    await edit_admin_message(callback, format_dispute(row), keyboard)
+    await callback.answer()
 
-@router.message(lambda message: message.text == "📢 Сделать объявление")
+@text_router.button("📢 Сделать объявление")
 async def start_announcement(message: types.Message, state: FSMContext):
     if not await check_admin(message.from_user.id):
         return
@@ -226,7 +393,7 @@ async def start_announcement(message: types.Message, state: FSMContext):
         )
     )
 
-@router.message(AdminStates.entering_announcement)
+@router.message(StateFilter(AdminStates.entering_announcement))
 async def process_announcement(message: types.Message, state: FSMContext):
     if message.text == "❌ Отмена":
         await state.clear()
@@ -236,30 +403,16 @@ async def process_announcement(message: types.Message, state: FSMContext):
         )
         return
     
-    async with await get_session() as session:
-        query = select(User)
-        result = await session.execute(query)
-        users = result.scalars().all()
-        
-        sent_count = 0
-        for user in users:
-            try:
-                await message.bot.send_message(
-                    user.telegram_id,
-                    f"📢 Объявление от администрации:\n\n{message.text}"
-                )
-                sent_count += 1
-            except:
-                continue
-        
-        await message.answer(
-            f"✅ Объявление отправлено {sent_count} пользователям!",
-            reply_markup=get_admin_keyboard()
-        )
-    
+    # Рассылка идет в фоне, прогресс приходит отдельным сообщением
+    broadcast = await create_broadcast(message.bot, message.chat.id, message.text)
     await state.clear()
+    
+    await message.answer(
+        f"✅ Рассылка #{broadcast.id} запущена!",
+        reply_markup=get_admin_keyboard()
+    )
 
-@router.message(lambda message: message.text == "🔒 Заблокировать пользователя")
+@text_router.button("🔒 Заблокировать пользователя")
 async def block_user_start(message: types.Message, state: FSMContext):
     if not await check_admin(message.from_user.id):
         return
@@ -270,7 +423,7 @@ async def block_user_start(message: types.Message, state: FSMContext):
         reply_markup=get_admin_keyboard()
     )
 
-@router.message(lambda message: message.text == "❌ Выйти из панели админа")
+@text_router.button("❌ Выйти из панели админа")
 async def exit_admin_panel(message: types.Message):
     if not await check_admin(message.from_user.id):
         return
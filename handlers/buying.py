@@ -1,11 +1,15 @@
-from aiogram import Router, F, types
+from aiogram import Router, types
+from aiogram.filters import StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
-from database.db import get_session
-from database.models import User, PhoneListing, Transaction
-from datetime import datetime
-from sqlalchemy import select, and_
+from database.db import after_commit
+from sqlalchemy.ext.asyncio import AsyncSession
+from database.models import User
+from database.listings import browse_listings, listing_cursor
+from database.listing_index import listing_index
+from database.trades import purchase_listing, UNAVAILABLE, INSUFFICIENT_FUNDS
+from services.text_router import text_router
 
 router = Router()
 
@@ -37,23 +41,21 @@ def get_listing_keyboard(listing_id: int):
     )
     return keyboard
 
-@router.message(F.text == "🛒 Купить номер")
-async def start_buying(message: types.Message, state: FSMContext):
-    async with await get_session() as session:
-        user = await session.get(User, message.from_user.id)
-        if not user:
-            await message.answer(
-                "❌ Вы не зарегистрированы!\n"
-                "Пожалуйста, пройдите регистрацию сначала."
-            )
-            return
+@text_router.button("🛒 Купить номер")
+async def start_buying(message: types.Message, state: FSMContext, user: User):
+    if not user:
+        await message.answer(
+            "❌ Вы не зарегистрированы!\n"
+            "Пожалуйста, пройдите регистрацию сначала."
+        )
+        return
 
     await message.answer(
         "🔍 Выберите способ поиска номера:",
         reply_markup=get_filter_keyboard()
     )
 
-@router.message(F.text == "🔍 Поиск по сервису")
+@text_router.button("🔍 Поиск по сервису")
 async def search_by_service(message: types.Message, state: FSMContext):
     from handlers.selling import get_services_keyboard
     await state.set_state(BuyPhoneStates.choosing_service)
@@ -62,8 +64,40 @@ async def search_by_service(message: types.Message, state: FSMContext):
         reply_markup=get_services_keyboard()
     )
 
-@router.message(BuyPhoneStates.choosing_service)
-async def process_service_choice(message: types.Message, state: FSMContext):
+@text_router.button("⏰ Поиск по времени")
+async def search_by_duration(message: types.Message, state: FSMContext):
+    from handlers.selling import get_duration_keyboard
+    await state.set_state(BuyPhoneStates.choosing_duration)
+    await message.answer(
+        "⏰ Выберите длительность аренды:",
+        reply_markup=get_duration_keyboard()
+    )
+
+@router.message(StateFilter(BuyPhoneStates.choosing_duration))
+async def process_duration_choice(message: types.Message, state: FSMContext, reader: AsyncSession):
+    from config import RENTAL_PERIODS
+
+    if message.text == "❌ Отмена":
+        await state.clear()
+        from handlers.common import get_main_keyboard
+        await message.answer("Операция отменена.", reply_markup=get_main_keyboard())
+        return
+
+    try:
+        duration = int(message.text.split()[1])
+        if duration not in RENTAL_PERIODS:
+            raise ValueError
+    except:
+        await message.answer("❌ Пожалуйста, выберите длительность из предложенных вариантов.")
+        return
+
+    await start_browsing(
+        message, state, reader, order="price_asc", duration=duration,
+        empty_text="😕 К сожалению, сейчас нет номеров с такой длительностью аренды."
+    )
+
+@router.message(StateFilter(BuyPhoneStates.choosing_service))
+async def process_service_choice(message: types.Message, state: FSMContext, reader: AsyncSession):
     from handlers.selling import available_services
     
     if message.text == "❌ Отмена":
@@ -76,141 +110,108 @@ async def process_service_choice(message: types.Message, state: FSMContext):
         await message.answer("❌ Пожалуйста, выберите сервис из списка.")
         return
 
-    async with await get_session() as session:
-        query = select(PhoneListing).where(
-            and_(
-                PhoneListing.service == message.text,
-                PhoneListing.is_active == True
-            )
-        ).order_by(PhoneListing.created_at.desc())
-        
-        result = await session.execute(query)
-        listings = result.scalars().all()
-
-        if not listings:
-            await message.answer(
-                "😕 К сожалению, сейчас нет доступных номеров для этого сервиса.\n"
-                "Попробуйте позже или выберите другой сервис."
-            )
-            return
-
-        await state.update_data(current_listing_index=0, listings=[listing.id for listing in listings])
-        await show_listing(message, state, listings[0])
-
-async def show_listing(message: types.Message, state: FSMContext, listing: PhoneListing):
-    async with await get_session() as session:
-        seller = await session.get(User, listing.seller_id)
-        
-        await message.answer(
-            f"📱 Номер для {listing.service}\n\n"
-            f"⏰ Длительность: {listing.duration} час(ов)\n"
-            f"💰 Цена: {listing.price} USDT\n"
-            f"👤 Продавец: {seller.username or 'Аноним'}\n"
-            f"⭐️ Рейтинг продавца: {seller.rating}\n"
-            f"📅 Размещено: {listing.created_at.strftime('%d.%m.%Y %H:%M')}",
-            reply_markup=get_listing_keyboard(listing.id)
-        )
+    await start_browsing(
+        message, state, reader, order="new", service=message.text,
+        empty_text="😕 К сожалению, сейчас нет доступных номеров для этого сервиса.\n"
+                   "Попробуйте позже или выберите другой сервис."
+    )
+
+async def start_browsing(message: types.Message, state: FSMContext, reader: AsyncSession, order: str,
+                         service: str = None, duration: int = None,
+                         empty_text: str = "😕 Сейчас нет доступных предложений."):
+    """Показывает первое объявление выборки и сохраняет в состоянии только курсор"""
+    listings = await browse_listings(reader, order, service, duration=duration, limit=1)
+
+    if not listings:
+        await message.answer(empty_text)
+        return
+
+    # В состоянии: параметры выборки и курсор последнего показанного объявления
+    await state.set_state(BuyPhoneStates.viewing_listings)
+    await state.update_data(
+        browse={"order": order, "service": service, "duration": duration},
+        cursor=listing_cursor(listings[0], order)
+    )
+    await show_listing(message, reader, listings[0])
+
+async def show_listing(message: types.Message, reader: AsyncSession, listing):
+    seller = await reader.get(User, listing.seller_id)
+    
+    await message.answer(
+        f"📱 Номер для {listing.service}\n\n"
+        f"⏰ Длительность: {listing.duration} час(ов)\n"
+        f"💰 Цена: {listing.price} USDT\n"
+        f"👤 Продавец: {seller.username or 'Аноним'}\n"
+        f"⭐️ Рейтинг продавца: {seller.rating}\n"
+        f"📅 Размещено: {listing.created_at.strftime('%d.%m.%Y %H:%M')}",
+        reply_markup=get_listing_keyboard(listing.id)
+    )
 
 @router.callback_query(lambda c: c.data.startswith('buy_'))
-async def process_buy(callback: types.CallbackQuery, state: FSMContext):
+async def process_buy(callback: types.CallbackQuery, state: FSMContext, session: AsyncSession, user: User):
     listing_id = int(callback.data.split('_')[1])
     
-    async with await get_session() as session:
-        listing = await session.get(PhoneListing, listing_id)
-        buyer = await session.get(User, callback.from_user.id)
-        
-        if not listing or not listing.is_active:
-            await callback.message.answer("❌ Это предложение уже недоступно.")
-            return
-        
-        if buyer.balance < listing.price:
-            await callback.message.answer(
-                "❌ Недостаточно средств на балансе!\n"
-                f"Необходимо: {listing.price} USDT\n"
-                f"На балансе: {buyer.balance} USDT\n\n"
-                "Пополните баланс и попробуйте снова."
-            )
-            return
-        
-        # Создаем транзакцию
-        transaction = Transaction(
-            buyer_id=buyer.id,
-            seller_id=listing.seller_id,
-            listing_id=listing_id,
-            amount=listing.price,
-            status="pending"
-        )
-        
-        # Обновляем статус объявления
-        listing.is_active = False
-        
-        # Блокируем средства покупателя
-        buyer.balance -= listing.price
-        
-        session.add(transaction)
-        await session.commit()
-        
+    if not user:
+        await callback.message.answer("❌ Вы не зарегистрированы!")
+        return
+    
+    # Снятие объявления, списание средств и создание сделки - условными UPDATE в одной транзакции
+    result = await purchase_listing(session, listing_id, user.id)
+    
+    if result.status == UNAVAILABLE:
+        listing_index.remove(listing_id)
+        await callback.message.answer("❌ Это предложение уже недоступно.")
+        return
+    
+    listing = result.listing
+    if result.status == INSUFFICIENT_FUNDS:
         await callback.message.answer(
-            "✅ Покупка успешно совершена!\n\n"
-            f"📱 Сервис: {listing.service}\n"
-            f"⏰ Длительность: {listing.duration} час(ов)\n"
-            f"💰 Сумма: {listing.price} USDT\n\n"
-            "⚠️ Если продавец не предоставит доступ или будет мешать использованию номера, "
-            "вы можете открыть спор, нажав кнопку в своем профиле."
+            "❌ Недостаточно средств на балансе!\n"
+            f"Необходимо: {listing.price} USDT\n"
+            f"На балансе: {result.balance} USDT\n\n"
+            "Пополните баланс и попробуйте снова."
         )
+        return
+    
+    after_commit(session, lambda: listing_index.remove(listing_id))
+    
+    await callback.message.answer(
+        "✅ Покупка успешно совершена!\n\n"
+        f"📱 Сервис: {listing.service}\n"
+        f"⏰ Длительность: {listing.duration} час(ов)\n"
+        f"💰 Сумма: {listing.price} USDT\n\n"
+        "⚠️ Если продавец не предоставит доступ или будет мешать использованию номера, "
+        "вы можете открыть спор, нажав кнопку в своем профиле."
+    )
 
 @router.callback_query(lambda c: c.data == 'next_listing')
-async def show_next_listing(callback: types.CallbackQuery, state: FSMContext):
+async def show_next_listing(callback: types.CallbackQuery, state: FSMContext, reader: AsyncSession):
     data = await state.get_data()
-    current_index = data.get('current_listing_index', 0)
-    listings = data.get('listings', [])
-    
-    if current_index + 1 >= len(listings):
+    browse = data.get('browse')
+    if not browse:
         await callback.answer("Это последнее предложение в списке.")
         return
-    
-    current_index += 1
-    await state.update_data(current_listing_index=current_index)
-    
-    async with await get_session() as session:
-        listing = await session.get(PhoneListing, listings[current_index])
-        if listing:
-            await show_listing(callback.message, state, listing)
-
-@router.message(F.text == "💰 Сначала дешевые")
-async def sort_by_price_asc(message: types.Message, state: FSMContext):
-    async with await get_session() as session:
-        query = select(PhoneListing).where(
-            PhoneListing.is_active == True
-        ).order_by(PhoneListing.price.asc())
-        
-        await process_sorted_listings(message, state, session, query)
-
-@router.message(F.text == "💰 Сначала дорогие")
-async def sort_by_price_desc(message: types.Message, state: FSMContext):
-    async with await get_session() as session:
-        query = select(PhoneListing).where(
-            PhoneListing.is_active == True
-        ).order_by(PhoneListing.price.desc())
-        
-        await process_sorted_listings(message, state, session, query)
-
-@router.message(F.text == "🔄 Сначала новые")
-async def sort_by_date(message: types.Message, state: FSMContext):
-    async with await get_session() as session:
-        query = select(PhoneListing).where(
-            PhoneListing.is_active == True
-        ).order_by(PhoneListing.created_at.desc())
-        
-        await process_sorted_listings(message, state, session, query)
-
-async def process_sorted_listings(message: types.Message, state: FSMContext, session, query):
-    result = await session.execute(query)
-    listings = result.scalars().all()
-    
+
+    listings = await browse_listings(
+        reader, browse['order'], browse['service'], data.get('cursor'),
+        limit=1, duration=browse.get('duration')
+    )
+
     if not listings:
-        await message.answer("😕 Сейчас нет доступных предложений.")
+        await callback.answer("Это последнее предложение в списке.")
         return
-    
-    await state.update_data(current_listing_index=0, listings=[listing.id for listing in listings])
-    await show_listing(message, state, listings[0]) 
\ No newline at end of file
+
+    await state.update_data(cursor=listing_cursor(listings[0], browse['order']))
+    await show_listing(callback.message, reader, listings[0])
+
+@text_router.button("💰 Сначала дешевые")
+async def sort_by_price_asc(message: types.Message, state: FSMContext, reader: AsyncSession):
+    await start_browsing(message, state, reader, order="price_asc")
+
+@text_router.button("💰 Сначала дорогие")
+async def sort_by_price_desc(message: types.Message, state: FSMContext, reader: AsyncSession):
+    await start_browsing(message, state, reader, order="price_desc")
+
+@text_router.button("🔄 Сначала новые")
+async def sort_by_date(message: types.Message, state: FSMContext, reader: AsyncSession):
+    await start_browsing(message, state, reader, order="new")
@@ -1,12 +1,18 @@
-from aiogram import Router, F, types
+from aiogram import Router, types
+from aiogram.filters import StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
-from database.db import get_session
-from database.models import User, Transaction, Dispute
+from sqlalchemy.ext.asyncio import AsyncSession
+from database.models import User, Transaction, Dispute, PhoneListing
+from database.counters import record_trade_completed
+from database.ledger import post, to_minor, REFUND, SALE
+from database.loader import BatchLoader
+from database.outbox import enqueue
 from datetime import datetime
-from sqlalchemy import select, and_
+from sqlalchemy import select, update, and_
 from config import ADMIN_IDS
+from services.text_router import text_router
 
 router = Router()
 
@@ -43,55 +49,58 @@ def get_admin_dispute_keyboard(dispute_id: int):
     )
     return keyboard
 
-@router.message(F.text == "⚠️ Споры")
-async def show_dispute_menu(message: types.Message):
-    async with await get_session() as session:
-        user = await session.get(User, message.from_user.id)
-        if not user:
-            await message.answer("❌ Вы не зарегистрированы!")
-            return
-        
-        await message.answer(
-            "🔍 Выберите действие:",
-            reply_markup=get_dispute_keyboard()
-        )
+@text_router.button("⚠️ Споры")
+async def show_dispute_menu(message: types.Message, user: User):
+    if not user:
+        await message.answer("❌ Вы не зарегистрированы!")
+        return
+    
+    await message.answer(
+        "🔍 Выберите действие:",
+        reply_markup=get_dispute_keyboard()
+    )
 
-@router.message(F.text == "📝 Открыть спор")
-async def start_dispute(message: types.Message, state: FSMContext):
-    async with await get_session() as session:
-        # Получаем активные транзакции пользователя
-        query = select(Transaction).where(
-            and_(
-                Transaction.buyer_id == message.from_user.id,
-                Transaction.status == "pending"
-            )
+@text_router.button("📝 Открыть спор")
+async def start_dispute(message: types.Message, state: FSMContext, session: AsyncSession, user: User):
+    if not user:
+        await message.answer("❌ Вы не зарегистрированы!")
+        return
+    
+    # Получаем активные транзакции пользователя
+    query = select(Transaction).where(
+        and_(
+            Transaction.buyer_id == user.id,
+            Transaction.status == "pending"
         )
-        result = await session.execute(query)
-        transactions = result.scalars().all()
-        
-        if not transactions:
-            await message.answer(
-                "❌ У вас нет активных сделок, по которым можно открыть спор."
-            )
-            return
-        
-        # Создаем клавиатуру с транзакциями
-        keyboard = []
-        for tx in transactions:
-            listing = await session.get(PhoneListing, tx.listing_id)
-            keyboard.append([
-                KeyboardButton(text=f"📱 {listing.service} - {tx.amount} USDT (ID: {tx.id})")
-            ])
-        keyboard.append([KeyboardButton(text="❌ Отмена")])
-        
-        await state.set_state(DisputeStates.entering_description)
+    )
+    result = await session.execute(query)
+    transactions = result.scalars().all()
+    
+    if not transactions:
         await message.answer(
-            "📝 Выберите сделку, по которой хотите открыть спор:",
-            reply_markup=ReplyKeyboardMarkup(keyboard=keyboard, resize_keyboard=True)
+            "❌ У вас нет активных сделок, по которым можно открыть спор."
         )
+        return
+    
+    # Создаем клавиатуру с транзакциями
+    listings = await BatchLoader(session).fetch(PhoneListing, [tx.listing_id for tx in transactions])
 
-@router.message(DisputeStates.entering_description)
-async def process_dispute_description(message: types.Message, state: FSMContext):
+    keyboard = []
+    for tx in transactions:
+        listing = listings[tx.listing_id]
+        keyboard.append([
+            KeyboardButton(text=f"📱 {listing.service} - {tx.amount} USDT (ID: {tx.id})")
+        ])
+    keyboard.append([KeyboardButton(text="❌ Отмена")])
+    
+    await state.set_state(DisputeStates.entering_description)
+    await message.answer(
+        "📝 Выберите сделку, по которой хотите открыть спор:",
+        reply_markup=ReplyKeyboardMarkup(keyboard=keyboard, resize_keyboard=True)
+    )
+
+@router.message(StateFilter(DisputeStates.entering_description))
+async def process_dispute_description(message: types.Message, state: FSMContext, session: AsyncSession, user: User):
     if message.text == "❌ Отмена":
         await state.clear()
         from handlers.common import get_main_keyboard
@@ -104,157 +113,173 @@ async def process_dispute_description(message: types.Message, state: FSMContext)
         await message.answer("❌ Пожалуйста, выберите сделку из списка.")
         return
     
-    async with await get_session() as session:
-        transaction = await session.get(Transaction, tx_id)
-        if not transaction:
-            await message.answer("❌ Сделка не найдена.")
-            return
-        
-        # Создаем новый спор
-        dispute = Dispute(
-            transaction_id=tx_id,
-            initiator_id=message.from_user.id,
-            description=message.text,
-            status="open"
+    transaction = await session.get(Transaction, tx_id)
+    if not transaction or not user or transaction.buyer_id != user.id:
+        await message.answer("❌ Сделка не найдена.")
+        return
+    
+    # Создаем новый спор
+    dispute = Dispute(
+        transaction_id=tx_id,
+        initiator_id=user.id,
+        description=message.text,
+        status="open"
+    )
+    session.add(dispute)
+    
+    # Обновляем статус транзакции
+    transaction.status = "disputed"
+    
+    # ID спора нужен для кнопок администратора
+    await session.flush()
+    
+    # Уведомления администраторам отправятся из outbox после коммита
+    for admin_id in ADMIN_IDS:
+        enqueue(
+            session,
+            admin_id,
+            f"⚠️ Открыт новый спор!\n\n"
+            f"ID транзакции: {tx_id}\n"
+            f"Покупатель: {message.from_user.username or message.from_user.id}\n"
+            f"Описание: {message.text}",
+            reply_markup=get_admin_dispute_keyboard(dispute.id)
         )
-        session.add(dispute)
-        
-        # Обновляем статус транзакции
-        transaction.status = "disputed"
-        
-        await session.commit()
-        
-        # Уведомляем администраторов
-        for admin_id in ADMIN_IDS:
-            try:
-                await message.bot.send_message(
-                    admin_id,
-                    f"⚠️ Открыт новый спор!\n\n"
-                    f"ID транзакции: {tx_id}\n"
-                    f"Покупатель: {message.from_user.username or message.from_user.id}\n"
-                    f"Описание: {message.text}",
-                    reply_markup=get_admin_dispute_keyboard(dispute.id)
-                )
-            except:
-                continue
+    
+    await state.clear()
+    from handlers.common import get_main_keyboard
+    
+    await message.answer(
+        "✅ Спор успешно открыт!\n"
+        "Администратор рассмотрит вашу заявку в ближайшее время.",
+        reply_markup=get_main_keyboard()
+    )
+
+@text_router.button("📋 Мои споры")
+async def show_my_disputes(message: types.Message, session: AsyncSession, user: User):
+    if not user:
+        await message.answer("❌ Вы не зарегистрированы!")
+        return
+    
+    # Получаем все споры пользователя
+    query = select(Dispute).where(
+        Dispute.initiator_id == user.id
+    ).order_by(Dispute.created_at.desc())
+    
+    result = await session.execute(query)
+    disputes = result.scalars().all()
+    
+    if not disputes:
+        await message.answer("У вас нет открытых споров.")
+        return
+    
+    loader = BatchLoader(session)
+    transactions = await loader.fetch(Transaction, [d.transaction_id for d in disputes])
+    listings = await loader.fetch(PhoneListing, [tx.listing_id for tx in transactions.values()])
+
+    for dispute in disputes:
+        transaction = transactions[dispute.transaction_id]
+        listing = listings[transaction.listing_id]
         
-        await state.clear()
-        from handlers.common import get_main_keyboard
+        status_emoji = {
+            "open": "🔴",
+            "resolved": "✅",
+            "closed": "⚫️"
+        }
         
         await message.answer(
-            "✅ Спор успешно открыт!\n"
-            "Администратор рассмотрит вашу заявку в ближайшее время.",
-            reply_markup=get_main_keyboard()
+            f"{status_emoji.get(dispute.status, '❓')} Спор #{dispute.id}\n\n"
+            f"📱 Сервис: {listing.service}\n"
+            f"💰 Сумма: {transaction.amount} USDT\n"
+            f"📅 Создан: {dispute.created_at.strftime('%d.%m.%Y %H:%M')}\n"
+            f"📝 Статус: {dispute.status}\n"
+            f"ℹ️ Описание: {dispute.description}"
         )
 
-@router.message(F.text == "📋 Мои споры")
-async def show_my_disputes(message: types.Message):
-    async with await get_session() as session:
-        # Получаем все споры пользователя
-        query = select(Dispute).where(
-            Dispute.initiator_id == message.from_user.id
-        ).order_by(Dispute.created_at.desc())
-        
-        result = await session.execute(query)
-        disputes = result.scalars().all()
-        
-        if not disputes:
-            await message.answer("У вас нет открытых споров.")
-            return
-        
-        for dispute in disputes:
-            transaction = await session.get(Transaction, dispute.transaction_id)
-            listing = await session.get(PhoneListing, transaction.listing_id)
-            
-            status_emoji = {
-                "open": "🔴",
-                "resolved": "✅",
-                "closed": "⚫️"
-            }
-            
-            await message.answer(
-                f"{status_emoji.get(dispute.status, '❓')} Спор #{dispute.id}\n\n"
-                f"📱 Сервис: {listing.service}\n"
-                f"💰 Сумма: {transaction.amount} USDT\n"
-                f"📅 Создан: {dispute.created_at.strftime('%d.%m.%Y %H:%M')}\n"
-                f"📝 Статус: {dispute.status}\n"
-                f"ℹ️ Описание: {dispute.description}"
-            )
-
 @router.callback_query(lambda c: c.data.startswith('resolve_'))
-async def resolve_dispute(callback: types.CallbackQuery):
+async def resolve_dispute(callback: types.CallbackQuery, session: AsyncSession):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer("❌ У вас нет прав администратора!")
         return
     
     action, dispute_id = callback.data.split('_')[1:]
     dispute_id = int(dispute_id)
+    if action not in ("buyer", "seller"):
+        return
     
-    async with await get_session() as session:
-        dispute = await session.get(Dispute, dispute_id)
-        if not dispute or dispute.status != "open":
-            await callback.answer("❌ Спор уже закрыт или не существует!")
-            return
+    # Спор закрывается условным UPDATE: при повторном нажатии или двух
+    # администраторах деньги проводит только тот, кто сменил статус
+    transaction_id = (await session.execute(
+        update(Dispute)
+        .where(Dispute.id == dispute_id, Dispute.status == "open")
+        .values(status="resolved", resolved_at=datetime.utcnow())
+        .returning(Dispute.transaction_id)
+    )).scalar_one_or_none()
+    if transaction_id is None:
+        await callback.answer("❌ Спор уже закрыт или не существует!")
+        return
+    
+    transaction = await session.get(Transaction, transaction_id)
+    # populate_existing: баланс не берется из кэшированного объекта администратора
+    buyer = await session.get(User, transaction.buyer_id, populate_existing=True)
+    seller = await session.get(User, transaction.seller_id, populate_existing=True)
+    
+    if action == "buyer":
+        # Возвращаем средства покупателю
+        await post(session, buyer.id, to_minor(transaction.amount), REFUND, f"transaction:{transaction.id}")
+        transaction.status = "refunded"
+        
+        # Уведомляем покупателя
+        enqueue(
+            session,
+            buyer.telegram_id,
+            f"✅ Ваш спор #{dispute_id} разрешен!\n"
+            f"💰 Сумма {transaction.amount} USDT возвращена на ваш баланс."
+        )
         
-        transaction = await session.get(Transaction, dispute.transaction_id)
-        buyer = await session.get(User, transaction.buyer_id)
-        seller = await session.get(User, transaction.seller_id)
+        # Ответ уходит после коммита (CommitBeforeRequest)
+        await callback.message.edit_text(
+            f"✅ Спор #{dispute_id} разрешен в пользу покупателя\n"
+            f"💰 Сумма {transaction.amount} USDT возвращена покупателю."
+        )
         
-        if action == "buyer":
-            # Возвращаем средства покупателю
-            buyer.balance += transaction.amount
-            transaction.status = "refunded"
-            dispute.status = "resolved"
-            
-            await callback.message.edit_text(
-                f"✅ Спор #{dispute_id} разрешен в пользу покупателя\n"
-                f"💰 Сумма {transaction.amount} USDT возвращена покупателю."
-            )
-            
-            # Уведомляем покупателя
-            await callback.bot.send_message(
-                buyer.telegram_id,
-                f"✅ Ваш спор #{dispute_id} разрешен!\n"
-                f"💰 Сумма {transaction.amount} USDT возвращена на ваш баланс."
-            )
-            
-        elif action == "seller":
-            # Передаем средства продавцу
-            seller.balance += transaction.amount
-            transaction.status = "completed"
-            dispute.status = "resolved"
-            
-            await callback.message.edit_text(
-                f"✅ Спор #{dispute_id} разрешен в пользу продавца\n"
-                f"💰 Сумма {transaction.amount} USDT передана продавцу."
-            )
-            
-            # Уведомляем продавца
-            await callback.bot.send_message(
-                seller.telegram_id,
-                f"✅ Спор по сделке разрешен в вашу пользу!\n"
-                f"💰 Сумма {transaction.amount} USDT зачислена на ваш баланс."
-            )
+    elif action == "seller":
+        # Передаем средства продавцу
+        await post(session, seller.id, to_minor(transaction.amount), SALE, f"transaction:{transaction.id}")
+        transaction.status = "completed"
+        transaction.completed_at = datetime.utcnow()
+        await record_trade_completed(session, transaction)
+        
+        # Уведомляем продавца
+        enqueue(
+            session,
+            seller.telegram_id,
+            f"✅ Спор по сделке разрешен в вашу пользу!\n"
+            f"💰 Сумма {transaction.amount} USDT зачислена на ваш баланс."
+        )
         
-        await session.commit()
+        await callback.message.edit_text(
+            f"✅ Спор #{dispute_id} разрешен в пользу продавца\n"
+            f"💰 Сумма {transaction.amount} USDT передана продавцу."
+        )
 
 @router.callback_query(lambda c: c.data.startswith('close_dispute_'))
-async def close_dispute(callback: types.CallbackQuery):
+async def close_dispute(callback: types.CallbackQuery, session: AsyncSession):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer("❌ У вас нет прав администратора!")
         return
     
     dispute_id = int(callback.data.split('_')[2])
     
-    async with await get_session() as session:
-        dispute = await session.get(Dispute, dispute_id)
-        if not dispute or dispute.status != "open":
-            await callback.answer("❌ Спор уже закрыт или не существует!")
-            return
-        
-        dispute.status = "closed"
-        await session.commit()
-        
-        await callback.message.edit_text(
-            f"⚫️ Спор #{dispute_id} закрыт администратором."
-        ) 
\ No newline at end of file
+    closed = (await session.execute(
+        update(Dispute)
+        .where(Dispute.id == dispute_id, Dispute.status == "open")
+        .values(status="closed", resolved_at=datetime.utcnow())
+        .returning(Dispute.id)
+    )).scalar_one_or_none()
+    if closed is None:
+        await callback.answer("❌ Спор уже закрыт или не существует!")
+        return
+    
+    await callback.message.edit_text(
+        f"⚫️ Спор #{dispute_id} закрыт администратором."
+    ) 
\ No newline at end of file
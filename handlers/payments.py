@@ -1,12 +1,16 @@
 from aiogram import Router, F, types
+from aiogram.filters import StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
-from database.db import get_session
+from sqlalchemy.ext.asyncio import AsyncSession
 from database.models import User, Transaction
+from database.ledger import to_minor
 from datetime import datetime
-import aiohttp
-from config import CRYPTO_BOT_TOKEN, MIN_WITHDRAWAL
+from config import MIN_WITHDRAWAL
+from services.cryptopay import crypto_pay, CryptoPayError
+from services.withdrawals import open_withdrawal, send_transfer, settle_withdrawal, COMPLETED, REJECTED
+from services.text_router import text_router
 
 router = Router()
 
@@ -24,55 +28,31 @@ def get_payment_keyboard():
     )
     return keyboard
 
-async def create_invoice(amount: float) -> dict:
-    """Создает инвойс в CryptoBot"""
-    url = f"https://pay.crypt.bot/api/createInvoice"
-    headers = {"Crypto-Pay-API-Token": CRYPTO_BOT_TOKEN}
-    params = {
-        "asset": "USDT",
-        "amount": str(amount),
-        "description": "Пополнение баланса в ROXORT SMS",
-        "paid_btn_name": "back",
-        "paid_btn_url": "https://t.me/roxort_bot"
-    }
-    
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, headers=headers, json=params) as response:
-            return await response.json()
-
-async def create_transfer(user_id: int, amount: float) -> dict:
-    """Создает перевод в CryptoBot"""
-    url = f"https://pay.crypt.bot/api/transfer"
-    headers = {"Crypto-Pay-API-Token": CRYPTO_BOT_TOKEN}
-    params = {
-        "user_id": user_id,
-        "asset": "USDT",
-        "amount": str(amount),
-        "spend_id": f"withdrawal_{datetime.utcnow().timestamp()}"
-    }
-    
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, headers=headers, json=params) as response:
-            return await response.json()
+async def create_invoice(amount: float, telegram_id: int) -> dict:
+    """Создает инвойс в CryptoBot; payload с ID пользователя вернется в вебхуке об оплате"""
+    try:
+        return await crypto_pay.create_invoice(amount, payload=str(telegram_id))
+    except CryptoPayError:
+        return {"ok": False}
 
-@router.message(lambda message: message.text in ["💰 Баланс", "💳 Пополнить", "💸 Вывести"])
-async def show_payment_menu(message: types.Message):
+@text_router.button("💰 Баланс", "💳 Пополнить", "💸 Вывести", "💸 Вывести средства")
+async def show_payment_menu(message: types.Message, state: FSMContext, session: AsyncSession, user: User):
     if message.text == "💰 Баланс":
-        async with await get_session() as session:
-            user = await session.get(User, message.from_user.id)
-            if not user:
-                await message.answer("❌ Вы не зарегистрированы!")
-                return
-            
-            await message.answer(
-                f"💰 Ваш текущий баланс: {user.balance} USDT\n\n"
-                "Выберите действие:",
-                reply_markup=get_payment_keyboard()
-            )
+        if not user:
+            await message.answer("❌ Вы не зарегистрированы!")
+            return
+        
+        # Пополнение могло пройти в другом процессе - баланс берем из БД
+        await session.refresh(user, ["balance_minor"])
+        await message.answer(
+            f"💰 Ваш текущий баланс: {user.balance} USDT\n\n"
+            "Выберите действие:",
+            reply_markup=get_payment_keyboard()
+        )
     else:
-        await process_payment_action(message)
+        await process_payment_action(message, state, session, user)
 
-async def process_payment_action(message: types.Message):
+async def process_payment_action(message: types.Message, state: FSMContext, session: AsyncSession, user: User):
     if message.text == "💳 Пополнить":
         await message.answer(
             "Введите сумму пополнения в USDT (минимум 1 USDT):",
@@ -81,28 +61,31 @@ async def process_payment_action(message: types.Message):
                 resize_keyboard=True
             )
         )
-        await PaymentStates.entering_deposit_amount.set()
+        await state.set_state(PaymentStates.entering_deposit_amount)
     
-    elif message.text == "💸 Вывести":
-        async with await get_session() as session:
-            user = await session.get(User, message.from_user.id)
-            if user.balance < MIN_WITHDRAWAL:
-                await message.answer(
-                    f"❌ Минимальная сумма для вывода: {MIN_WITHDRAWAL} USDT\n"
-                    f"На вашем балансе: {user.balance} USDT"
-                )
-                return
-            
+    elif message.text in ("💸 Вывести", "💸 Вывести средства"):
+        if not user:
+            await message.answer("❌ Вы не зарегистрированы!")
+            return
+        
+        await session.refresh(user, ["balance_minor"])
+        if user.balance < MIN_WITHDRAWAL:
             await message.answer(
-                f"Введите сумму вывода в USDT (минимум {MIN_WITHDRAWAL} USDT):",
-                reply_markup=ReplyKeyboardMarkup(
-                    keyboard=[[KeyboardButton(text="❌ Отмена")]],
-                    resize_keyboard=True
-                )
+                f"❌ Минимальная сумма для вывода: {MIN_WITHDRAWAL} USDT\n"
+                f"На вашем балансе: {user.balance} USDT"
             )
-            await PaymentStates.entering_withdrawal_amount.set()
+            return
+        
+        await message.answer(
+            f"Введите сумму вывода в USDT (минимум {MIN_WITHDRAWAL} USDT):",
+            reply_markup=ReplyKeyboardMarkup(
+                keyboard=[[KeyboardButton(text="❌ Отмена")]],
+                resize_keyboard=True
+            )
+        )
+        await state.set_state(PaymentStates.entering_withdrawal_amount)
 
-@router.message(PaymentStates.entering_deposit_amount)
+@router.message(StateFilter(PaymentStates.entering_deposit_amount))
 async def process_deposit_amount(message: types.Message, state: FSMContext):
     if message.text == "❌ Отмена":
         await state.clear()
@@ -119,7 +102,7 @@ async def process_deposit_amount(message: types.Message, state: FSMContext):
         return
     
     # Создаем инвойс через CryptoBot
-    invoice = await create_invoice(amount)
+    invoice = await create_invoice(amount, message.from_user.id)
     
     if invoice.get("ok"):
         pay_url = invoice["result"]["pay_url"]
@@ -140,8 +123,8 @@ async def process_deposit_amount(message: types.Message, state: FSMContext):
     from handlers.common import get_main_keyboard
     await message.answer("Выберите действие:", reply_markup=get_main_keyboard())
 
-@router.message(PaymentStates.entering_withdrawal_amount)
-async def process_withdrawal_amount(message: types.Message, state: FSMContext):
+@router.message(StateFilter(PaymentStates.entering_withdrawal_amount))
+async def process_withdrawal_amount(message: types.Message, state: FSMContext, session: AsyncSession, user: User):
     if message.text == "❌ Отмена":
         await state.clear()
         from handlers.common import get_main_keyboard
@@ -156,55 +139,44 @@ async def process_withdrawal_amount(message: types.Message, state: FSMContext):
         await message.answer(f"❌ Пожалуйста, введите корректную сумму (минимум {MIN_WITHDRAWAL} USDT)")
         return
     
-    async with await get_session() as session:
-        user = await session.get(User, message.from_user.id)
-        if amount > user.balance:
-            await message.answer(
-                "❌ Недостаточно средств на балансе!\n"
-                f"Запрошено: {amount} USDT\n"
-                f"Доступно: {user.balance} USDT"
-            )
-            return
-        
-        # Создаем перевод через CryptoBot
-        transfer = await create_transfer(user.telegram_id, amount)
-        
-        if transfer.get("ok"):
-            # Уменьшаем баланс пользователя
-            user.balance -= amount
-            await session.commit()
-            
-            await message.answer(
-                "✅ Средства успешно выведены!\n\n"
-                f"Сумма: {amount} USDT\n"
-                f"Новый баланс: {user.balance} USDT"
-            )
-        else:
-            await message.answer("❌ Произошла ошибка при выводе средств. Попробуйте позже.")
+    # spend_id привязан к сообщению с суммой, поэтому повторная обработка
+    # того же сообщения не приведет к двойной выплате в CryptoBot
+    spend_id = f"withdrawal_{user.id}_{message.message_id}"
+    
+    # Списываем до перевода условным UPDATE: два одновременных вывода не уведут баланс в минус
+    withdrawal = await open_withdrawal(session, user, to_minor(amount), spend_id)
+    if withdrawal is None:
+        await session.refresh(user, ["balance_minor"])
+        await message.answer(
+            "❌ Недостаточно средств на балансе!\n"
+            f"Запрошено: {amount} USDT\n"
+            f"Доступно: {user.balance} USDT"
+        )
+        return
+    # Списание и запись вывода фиксируем до перевода: при сбое вывод будет повторен
+    await session.commit()
+    
+    status = await settle_withdrawal(session, withdrawal, await send_transfer(withdrawal))
+    await session.commit()
+    
+    if status == COMPLETED:
+        await session.refresh(user, ["balance_minor"])
+        await message.answer(
+            "✅ Средства успешно выведены!\n\n"
+            f"Сумма: {amount} USDT\n"
+            f"Новый баланс: {user.balance} USDT"
+        )
+    elif status == REJECTED:
+        await message.answer(
+            "❌ Произошла ошибка при выводе средств, средства возвращены на баланс. Попробуйте позже."
+        )
+    else:
+        # Исход неизвестен: повтор с тем же spend_id, результат придет сообщением
+        await message.answer(
+            "⏳ CryptoBot не подтвердил перевод. Мы проверим его и сообщим результат; "
+            "до этого сумма остается списанной."
+        )
     
     await state.clear()
     from handlers.common import get_main_keyboard
     await message.answer("Выберите действие:", reply_markup=get_main_keyboard())
-
-# Обработчик уведомлений от CryptoBot
-@router.message(lambda message: message.get_command() == "/cryptobot_payment")
-async def handle_payment_notification(message: types.Message):
-    try:
-        data = message.get_args().split("_")
-        user_id = int(data[0])
-        amount = float(data[1])
-        
-        async with await get_session() as session:
-            user = await session.get(User, user_id)
-            if user:
-                user.balance += amount
-                await session.commit()
-                
-                await message.bot.send_message(
-                    user_id,
-                    f"✅ Ваш баланс пополнен на {amount} USDT\n"
-                    f"Текущий баланс: {user.balance} USDT"
-                )
-    except:
-        # Логируем ошибку, но не отвечаем на сообщение
-        pass 
\ No newline at end of file
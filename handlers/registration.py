@@ -1,18 +1,20 @@
-from aiogram import Router, types, F
+from aiogram import Router, types
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
-from database.db import get_session
+from sqlalchemy.ext.asyncio import AsyncSession
 from database.models import User
+from database.rollups import record_stats
 from datetime import datetime
 from handlers.common import get_main_keyboard
+from services.text_router import text_router
 
 router = Router()
 
 class RegistrationStates(StatesGroup):
     waiting_for_phone = State()
 
-@router.message(lambda message: message.text == "🔄 Начать регистрацию")
+@text_router.button("🔄 Начать регистрацию")
 async def start_registration(message: types.Message):
     keyboard = ReplyKeyboardMarkup(
         keyboard=[[KeyboardButton(text="📱 Поделиться номером", request_contact=True)]],
@@ -23,34 +25,37 @@ async def start_registration(message: types.Message):
         reply_markup=keyboard
     )
 
-@router.message(F.contact)
-async def process_phone_number(message: types.Message, state: FSMContext):
+async def has_contact(message: types.Message) -> bool:
+    # Асинхронный фильтр: синхронные (в том числе F.contact) aiogram выполняет в пуле потоков
+    return message.contact is not None
+
+@router.message(has_contact)
+async def process_phone_number(message: types.Message, state: FSMContext, session: AsyncSession, user: User):
     phone_number = message.contact.phone_number
     
-    async with await get_session() as session:
-        # Проверяем, не зарегистрирован ли уже этот номер
-        existing_user = await session.get(User, message.from_user.id)
-        if existing_user:
-            await message.answer(
-                "✅ Вы уже зарегистрированы!",
-                reply_markup=get_main_keyboard(message.from_user.id)
-            )
-            return
-        
-        # Создаем нового пользователя
-        new_user = User(
-            telegram_id=message.from_user.id,
-            username=message.from_user.username,
-            phone_number=phone_number,
-            balance=0.0,
-            rating=5.0,
-            registered_at=datetime.utcnow()
-        )
-        session.add(new_user)
-        await session.commit()
-        
+    # Проверяем, не зарегистрирован ли уже этот пользователь
+    if user:
         await message.answer(
-            "✅ Регистрация успешно завершена!\n"
-            "Теперь вы можете покупать и продавать номера.",
+            "✅ Вы уже зарегистрированы!",
             reply_markup=get_main_keyboard(message.from_user.id)
-        ) 
\ No newline at end of file
+        )
+        return
+    
+    # Создаем нового пользователя
+    new_user = User(
+        telegram_id=message.from_user.id,
+        username=message.from_user.username,
+        phone_number=phone_number,
+        balance_minor=0,
+        rating=5.0,
+        registered_at=datetime.utcnow()
+    )
+    session.add(new_user)
+    record_stats(session, new_users=1)
+    await session.flush()
+    
+    await message.answer(
+        "✅ Регистрация успешно завершена!\n"
+        "Теперь вы можете покупать и продавать номера.",
+        reply_markup=get_main_keyboard(message.from_user.id)
+    ) 
\ No newline at end of file
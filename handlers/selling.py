@@ -1,10 +1,15 @@
-from aiogram import Router, F, types
+from aiogram import Router, types
+from aiogram.filters import StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
-from database.db import get_session
+from database.db import after_commit
+from sqlalchemy.ext.asyncio import AsyncSession
 from database.models import User, PhoneListing
+from database.listing_index import listing_index
+from database.rollups import record_stats
 from config import RENTAL_PERIODS
+from services.text_router import text_router
 
 router = Router()
 
@@ -41,16 +46,14 @@ def get_services_keyboard():
     keyboard.append([KeyboardButton(text="❌ Отмена")])
     return ReplyKeyboardMarkup(keyboard=keyboard, resize_keyboard=True)
 
-@router.message(F.text == "📱 Продать номер")
-async def start_selling(message: types.Message, state: FSMContext):
-    async with await get_session() as session:
-        user = await session.get(User, message.from_user.id)
-        if not user:
-            await message.answer(
-                "❌ Вы не зарегистрированы!\n"
-                "Пожалуйста, пройдите регистрацию сначала."
-            )
-            return
+@text_router.button("📱 Продать номер")
+async def start_selling(message: types.Message, state: FSMContext, user: User):
+    if not user:
+        await message.answer(
+            "❌ Вы не зарегистрированы!\n"
+            "Пожалуйста, пройдите регистрацию сначала."
+        )
+        return
 
     await state.set_state(SellPhoneStates.choosing_duration)
     await message.answer(
@@ -58,7 +61,7 @@ async def start_selling(message: types.Message, state: FSMContext):
         reply_markup=get_duration_keyboard()
     )
 
-@router.message(SellPhoneStates.choosing_duration)
+@router.message(StateFilter(SellPhoneStates.choosing_duration))
 async def process_duration(message: types.Message, state: FSMContext):
     if message.text == "❌ Отмена":
         await state.clear()
@@ -83,7 +86,7 @@ async def process_duration(message: types.Message, state: FSMContext):
         reply_markup=get_services_keyboard()
     )
 
-@router.message(SellPhoneStates.choosing_service)
+@router.message(StateFilter(SellPhoneStates.choosing_service))
 async def process_service(message: types.Message, state: FSMContext):
     if message.text == "❌ Отмена":
         await state.clear()
@@ -106,8 +109,8 @@ async def process_service(message: types.Message, state: FSMContext):
         )
     )
 
-@router.message(SellPhoneStates.entering_price)
-async def process_price(message: types.Message, state: FSMContext):
+@router.message(StateFilter(SellPhoneStates.entering_price))
+async def process_price(message: types.Message, state: FSMContext, session: AsyncSession, user: User):
     if message.text == "❌ Отмена":
         await state.clear()
         from handlers.common import get_main_keyboard
@@ -125,17 +128,18 @@ async def process_price(message: types.Message, state: FSMContext):
     data = await state.get_data()
     
     # Создаем объявление в базе данных
-    async with await get_session() as session:
-        user = await session.get(User, message.from_user.id)
-        new_listing = PhoneListing(
-            seller_id=user.id,
-            service=data['service'],
-            duration=data['duration'],
-            price=price,
-            is_active=True
-        )
-        session.add(new_listing)
-        await session.commit()
+    new_listing = PhoneListing(
+        seller_id=user.id,
+        service=data['service'],
+        duration=data['duration'],
+        price=price,
+        is_active=True
+    )
+    session.add(new_listing)
+    record_stats(session, new_listings=1)
+    await session.flush()
+    # В индекс объявление попадает только после коммита
+    after_commit(session, lambda: listing_index.add(new_listing))
 
     await state.clear()
     from handlers.common import get_main_keyboard
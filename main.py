@@ -1,44 +1,75 @@
 import asyncio
 import logging
+from aiohttp import web
 from aiogram import Bot, Dispatcher, types
 from aiogram.filters import Command
-from aiogram.fsm.storage.memory import MemoryStorage
-from config import BOT_TOKEN
-from database.db import init_db
-from handlers import registration, common, selling, buying, disputes
+from database.models import User
+from config import (
+    BOT_TOKEN, BOT_MODE, WEB_SERVER_HOST, WEB_SERVER_PORT, WORKERS, LEDGER_CHECKPOINT_INTERVAL, LISTING_TTL,
+    TELEGRAM_GLOBAL_RATE, METRICS_HOST, METRICS_PORT,
+    TELEGRAM_WEBHOOK_URL, TELEGRAM_WEBHOOK_PATH, TELEGRAM_WEBHOOK_SECRET
+)
+from database.db import init_db, read_session
+from database.listing_index import listing_index
+from database.ledger import checkpoint_loop
+from services.broadcast import resume_broadcasts
+from services.listing_sweeper import sweeper_loop
+from services.withdrawals import retry_loop as withdrawal_retry_loop
+from services.outbox import OutboxSender
+from services.rate_limit import TelegramRateLimiter
+from services.metrics import ApiCallCounter, registry, setup_metrics
+from services.cryptopay import crypto_pay
+from services.cryptopay_webhook import setup_cryptopay_webhook
+from services.telegram_webhook import setup_telegram_webhook
+from services.fsm_storage import SQLiteStorage
+from services.workers import Supervisor
+from services.text_router import text_router
+from middlewares.database import DbSessionMiddleware, CommitBeforeRequest
+from middlewares.metrics import MetricsMiddleware
+from middlewares.user import UserMiddleware
+from handlers import registration, common, selling, buying, disputes, payments, ratings, admin
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 
 # Инициализация бота и диспетчера
 bot = Bot(token=BOT_TOKEN)
-storage = MemoryStorage()
+# Запись обновления фиксируется до ответа, а не после ожидания ограничителя и сети
+bot.session.middleware(CommitBeforeRequest())
+# Лимит Telegram общий для бота: при WORKERS > 1 он делится между супервизором и процессами
+bot.session.middleware(TelegramRateLimiter(
+    TELEGRAM_GLOBAL_RATE / (WORKERS + 1) if WORKERS > 1 else TELEGRAM_GLOBAL_RATE
+))
+# Считаются запросы, отправленные после ограничителя, включая повторы
+bot.session.middleware(ApiCallCounter())
+storage = SQLiteStorage()
 dp = Dispatcher(storage=storage)
 
+# Метрики обработчиков: время обновления с коммитом и запросы к БД
+metrics = MetricsMiddleware()
+dp.update.outer_middleware(metrics)
+dp.message.middleware(metrics)
+dp.callback_query.middleware(metrics)
+
+# Одна сессия БД на обновление и текущий пользователь из кэша
+dp.update.outer_middleware(DbSessionMiddleware())
+dp.update.outer_middleware(UserMiddleware())
+
 # Регистрация роутеров
 dp.include_router(registration.router)
 dp.include_router(common.router)
 dp.include_router(selling.router)
 dp.include_router(buying.router)
 dp.include_router(disputes.router)
-
-# Создание основной клавиатуры
-def get_main_keyboard():
-    keyboard = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="👤 Профиль"), KeyboardButton(text="💰 Баланс")],
-            [KeyboardButton(text="📱 Продать номер"), KeyboardButton(text="🛒 Купить номер")],
-            [KeyboardButton(text="💸 Вывести средства")]
-        ],
-        resize_keyboard=True
-    )
-    return keyboard
+dp.include_router(payments.router)
+dp.include_router(ratings.router)
+dp.include_router(admin.router)
+# Кнопки меню - последними: обработчики состояний FSM проверяются раньше
+dp.include_router(text_router)
 
 @dp.message(Command("start"))
-async def cmd_start(message: types.Message):
-    user_registered = await common.check_user_registered(message.from_user.id)
-    
-    if user_registered:
+async def cmd_start(message: types.Message, user: User):
+    if user:
         await message.answer(
             "👋 Добро пожаловать в ROXORT SMS!\n\n"
             "Здесь вы можете купить или продать доступ к номеру телефона "
@@ -53,30 +84,90 @@ async def cmd_start(message: types.Message):
             reply_markup=common.get_start_keyboard()
         )
 
-@dp.message(lambda message: message.text == "👤 Профиль")
-async def show_profile(message: types.Message):
-    # TODO: Добавить логику получения информации о профиле
-    await message.answer(
-        "📊 Ваш профиль:\n"
-        "ID: {}\n"
-        "Рейтинг: ⭐️ 5.0\n"
-        "Продано номеров: 0\n"
-        "Куплено номеров: 0\n"
-        "Дата регистрации: {}"
-        .format(message.from_user.id, message.date.strftime("%d.%m.%Y"))
-    )
-
-@dp.message(lambda message: message.text == "💰 Баланс")
-async def show_balance(message: types.Message):
-    # TODO: Добавить логику получения баланса
-    await message.answer("💰 Ваш текущий баланс: 0 USDT")
+async def setup_worker():
+    """Подготовка процесса, обрабатывающего обновления"""
+    # Загрузка индекса активных объявлений в память
+    await listing_index.load(read_session)
+    return bot, dp
 
 async def main():
     # Инициализация базы данных
     await init_db()
     
+    # При WORKERS > 1 обновления обрабатывают отдельные процессы
+    supervisor = Supervisor(setup_worker, bot=bot) if WORKERS > 1 else None
+    if supervisor:
+        supervisor.start()
+    else:
+        await setup_worker()
+    
+    # Продолжение рассылок, прерванных перезапуском
+    await resume_broadcasts(bot)
+    
+    # Периодическая сверка балансов с журналом проводок
+    checkpoints = asyncio.create_task(checkpoint_loop()) if LEDGER_CHECKPOINT_INTERVAL else None
+    # Снятие с продажи устаревших объявлений
+    sweeper = asyncio.create_task(sweeper_loop()) if LISTING_TTL else None
+    # Повтор выводов с неизвестным исходом перевода
+    withdrawals = asyncio.create_task(withdrawal_retry_loop())
+    # Отправка уведомлений, записанных обработчиками в outbox
+    outbox = OutboxSender(bot)
+    outbox.start()
+    
+    # HTTP-сервер для вебхуков CryptoBot и Telegram
+    app = web.Application()
+    setup_cryptopay_webhook(app)
+    updates = None
+    if supervisor:
+        supervisor.setup_web(app)
+    elif BOT_MODE == "webhook":
+        updates = setup_telegram_webhook(app, dp, bot)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEB_SERVER_HOST, WEB_SERVER_PORT).start()
+    
+    # Метрики - на отдельном сервере, чтобы не открывать их вместе с вебхуками
+    metrics_runner = None
+    if METRICS_PORT:
+        metrics_app = web.Application()
+        setup_metrics(metrics_app, supervisor.metrics_snapshot if supervisor else registry.snapshot)
+        metrics_runner = web.AppRunner(metrics_app)
+        await metrics_runner.setup()
+        await web.TCPSite(metrics_runner, METRICS_HOST, METRICS_PORT).start()
+    
     # Запуск бота
-    await dp.start_polling(bot)
+    try:
+        if BOT_MODE == "webhook":
+            if updates:
+                updates.start()
+            await bot.set_webhook(
+                TELEGRAM_WEBHOOK_URL + TELEGRAM_WEBHOOK_PATH,
+                secret_token=TELEGRAM_WEBHOOK_SECRET or None,
+                allowed_updates=dp.resolve_used_update_types()
+            )
+            await asyncio.Event().wait()
+        elif supervisor:
+            await bot.delete_webhook()
+            await supervisor.poll(bot, dp.resolve_used_update_types())
+        else:
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
+    finally:
+        if checkpoints:
+            checkpoints.cancel()
+        if sweeper:
+            sweeper.cancel()
+        withdrawals.cancel()
+        await runner.cleanup()
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        if updates:
+            await updates.stop()
+        if supervisor:
+            await supervisor.stop()
+        await outbox.stop()
+        await crypto_pay.close()
+        await storage.close()
 
 if __name__ == "__main__":
     asyncio.run(main()) 
\ No newline at end of file
@@ -0,0 +1,136 @@
+"""Одна сессия БД на обновление.
+
+DbSessionMiddleware открывает для каждого обновления сессию `session` (запись)
+и `reader` (пул только для чтения) и передает их в обработчики. В конце
+обработки `session` коммитится одним коммитом, при ошибке - откатывается.
+Сессии ленивые: соединение берется из пула только при первом запросе.
+
+Перед каждым запросом к Bot API из обработчика сессия обновления
+коммитится (CommitBeforeRequest - middleware сессии бота): блокировка записи
+SQLite не держится, пока ответ ждет ограничителя частоты и сети, а
+пользователь не получает "✅" об изменении, коммит которого еще может не
+пройти. Поэтому обработчик сначала делает все записи, затем отвечает.
+Для каждого обновления считаются SQL-запросы, время их выполнения и время
+работы с сессией.
+"""
+import asyncio
+import logging
+import time
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from aiogram import BaseMiddleware, Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.methods import TelegramMethod
+from aiogram.types import TelegramObject
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from database.db import async_session, read_session
+
+logger = logging.getLogger(__name__)
+
+
+class DbStats:
+    """Статистика работы с БД в рамках одного обновления"""
+    __slots__ = ("queries", "query_time", "query_started", "started", "duration")
+
+    def __init__(self):
+        self.queries = 0
+        # Суммарное время выполнения запросов; запросы одного обновления идут по очереди
+        self.query_time = 0.0
+        self.query_started = 0.0
+        self.started = time.perf_counter()
+        self.duration = 0.0
+
+
+_current_stats: ContextVar[Optional[DbStats]] = ContextVar("db_stats", default=None)
+# Сессия обновления и задача, которая его обрабатывает: задачи, запущенные
+# обработчиком, наследуют контекст, но коммитить чужую сессию не должны
+_current_session: ContextVar[Optional[Tuple[AsyncSession, asyncio.Task]]] = ContextVar("db_session", default=None)
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    stats = _current_stats.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.query_started = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _time_query(conn, cursor, statement, parameters, context, executemany):
+    stats = _current_stats.get()
+    if stats is not None:
+        stats.query_time += time.perf_counter() - stats.query_started
+
+
+class DbSessionMiddleware(BaseMiddleware):
+    def __init__(self, session_factory=async_session, read_factory=read_session):
+        self.session_factory = session_factory
+        self.read_factory = read_factory
+        self.updates = 0
+        self.queries = 0
+        self.max_queries = 0
+        self.duration = 0.0
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        stats = DbStats()
+        token = _current_stats.set(stats)
+        session_token = None
+        try:
+            async with self.session_factory() as session, self.read_factory() as reader:
+                data["session"] = session
+                data["reader"] = reader
+                data["db_stats"] = stats
+                session_token = _current_session.set((session, asyncio.current_task()))
+                try:
+                    result = await handler(event, data)
+                except Exception:
+                    await session.rollback()
+                    raise
+                if session.in_transaction():
+                    await session.commit()
+                return result
+        finally:
+            if session_token is not None:
+                _current_session.reset(session_token)
+            _current_stats.reset(token)
+            stats.duration = time.perf_counter() - stats.started
+            self.updates += 1
+            self.queries += stats.queries
+            self.max_queries = max(self.max_queries, stats.queries)
+            self.duration += stats.duration
+            logger.debug("Обновление: %s SQL-запросов (%.1f мс), %.1f мс", stats.queries,
+                         stats.query_time * 1000, stats.duration * 1000)
+
+    def stats(self) -> dict:
+        return {
+            "updates": self.updates,
+            "queries": self.queries,
+            "avg_queries": round(self.queries / self.updates, 2) if self.updates else 0,
+            "max_queries": self.max_queries,
+            "avg_duration_ms": round(self.duration / self.updates * 1000, 2) if self.updates else 0,
+        }
+
+
+class CommitBeforeRequest(BaseRequestMiddleware):
+    """Коммитит сессию обновления перед запросом обработчика к Bot API.
+
+    Подключается к сессии бота первым, до ограничителя частоты: ожидание
+    очереди и RetryAfter идет уже без открытой транзакции.
+    """
+
+    async def __call__(self, make_request: NextRequestMiddlewareType, bot: Bot, method: TelegramMethod):
+        current = _current_session.get()
+        if current is not None:
+            session, task = current
+            if task is asyncio.current_task() and session.in_transaction():
+                await session.commit()
+        return await make_request(bot, method)
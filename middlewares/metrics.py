@@ -0,0 +1,64 @@
+"""Метрики обработки обновлений по обработчикам.
+
+MetricsMiddleware подключается дважды:
+    dp.update.outer_middleware - первым, до DbSessionMiddleware: измеряет
+        обновление целиком, включая коммит, и берет из `db_stats` число
+        SQL-запросов и время их выполнения;
+    dp.message / dp.callback_query (inner) - запоминает имя обработчика,
+        который aiogram выбрал для события. Для кнопок меню это обработчик
+        из TextCommandRouter, а не его общий _dispatch.
+Значения складываются в services/metrics.registry.
+"""
+import time
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update
+
+from services.metrics import MetricsRegistry, UpdateMetrics, current_update, registry
+from services.text_router import TextCommandRouter
+
+
+def handler_name(handler, event: TelegramObject) -> str:
+    callback = handler.callback
+    owner = getattr(callback, "__self__", None)
+    if isinstance(owner, TextCommandRouter):
+        callback = owner.handlers[event.text].callback
+    return f"{callback.__module__.rsplit('.', 1)[-1]}.{callback.__name__}"
+
+
+class MetricsMiddleware(BaseMiddleware):
+    def __init__(self, metrics: MetricsRegistry = registry):
+        self.metrics = metrics
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        if not isinstance(event, Update):
+            # Внутренний уровень: обработчик уже выбран
+            update = current_update.get()
+            if update is not None and "handler" in data:
+                update.handler = handler_name(data["handler"], event)
+            return await handler(event, data)
+
+        update = UpdateMetrics()
+        token = current_update.set(update)
+        started = time.perf_counter()
+        failed = False
+        try:
+            return await handler(event, data)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            duration = time.perf_counter() - started
+            current_update.reset(token)
+            db_stats = data.get("db_stats")
+            self.metrics.observe_update(
+                update.handler, duration, failed,
+                db_stats.queries if db_stats is not None else 0,
+                db_stats.query_time if db_stats is not None else 0.0
+            )
@@ -0,0 +1,29 @@
+"""Текущий пользователь в обработчиках.
+
+UserMiddleware находит пользователя по telegram_id через кэш
+(database/user_cache.py) и передает его в обработчики как `user`
+(None - пользователь не зарегистрирован). Подключается после
+DbSessionMiddleware: пользователь привязан к сессии обновления.
+"""
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+from database.user_cache import user_cache
+
+
+class UserMiddleware(BaseMiddleware):
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        from_user = data.get("event_from_user")
+        session = data.get("session")
+        if from_user is not None and session is not None:
+            data["user"] = await user_cache.resolve(session, from_user.id)
+        else:
+            data["user"] = None
+        return await handler(event, data)
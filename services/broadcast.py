@@ -0,0 +1,188 @@
+"""Фоновая рассылка объявлений всем пользователям.
+
+Пользователи читаются из БД порциями по BROADCAST_CHUNK_SIZE, сообщения
+отправляются параллельно под общим ограничением частоты. После каждой порции
+прогресс сохраняется в таблицу broadcasts, поэтому после перезапуска рассылка
+продолжается с места остановки (последняя порция может быть отправлена повторно).
+"""
+import asyncio
+import logging
+import time
+from datetime import datetime
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest, TelegramAPIError
+from sqlalchemy import select
+
+from config import BROADCAST_RATE, BROADCAST_CONCURRENCY, BROADCAST_CHUNK_SIZE, BROADCAST_REPORT_INTERVAL
+from database.db import async_session
+from database.models import User, Broadcast
+from services.rate_limit import TokenBucket, bulk_traffic
+
+logger = logging.getLogger(__name__)
+
+# Количество попыток отправки одному пользователю при RetryAfter
+MAX_RETRIES = 5
+# BadRequest, означающий, что чата больше нет (аккаунт удален)
+CHAT_NOT_FOUND = "chat not found"
+
+_tasks = set()
+
+
+class BroadcastJob:
+    def __init__(self, bot: Bot, broadcast: Broadcast):
+        self.bot = bot
+        self.broadcast_id = broadcast.id
+        self.text = broadcast.text
+        self.admin_chat_id = broadcast.admin_chat_id
+        self.report_message_id = broadcast.report_message_id
+        self.last_user_id = broadcast.last_user_id or 0
+        self.counts = {
+            "delivered": broadcast.delivered or 0,
+            "blocked": broadcast.blocked or 0,
+            "failed": broadcast.failed or 0,
+        }
+        self.bucket = TokenBucket(BROADCAST_RATE)
+        self.semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+        self.started = time.monotonic()
+        self.sent_since_start = 0
+        self.last_report = 0.0
+
+    async def run(self):
+        with bulk_traffic():
+            await self._run()
+
+    async def _run(self):
+        try:
+            while True:
+                async with async_session() as session:
+                    result = await session.execute(
+                        select(User.id, User.telegram_id)
+                        .where(User.id > self.last_user_id)
+                        .order_by(User.id)
+                        .limit(BROADCAST_CHUNK_SIZE)
+                    )
+                    chunk = result.all()
+
+                if not chunk:
+                    break
+
+                await asyncio.gather(*(self._deliver(row.telegram_id) for row in chunk))
+                self.last_user_id = chunk[-1].id
+                await self._save_progress()
+                await self._report()
+
+            await self._save_progress(finished=True)
+            await self._report(final=True)
+        except Exception:
+            logger.exception("Рассылка #%s прервана", self.broadcast_id)
+
+    async def _deliver(self, chat_id: int):
+        async with self.semaphore:
+            for _ in range(MAX_RETRIES):
+                await self.bucket.acquire()
+                try:
+                    await self.bot.send_message(chat_id, f"📢 Объявление от администрации:\n\n{self.text}")
+                    self.counts["delivered"] += 1
+                    break
+                except TelegramRetryAfter:
+                    # Ограничитель бота поставил на паузу этот чат - повтор дождется ее окончания
+                    continue
+                except TelegramForbiddenError:
+                    # Пользователь заблокировал бота
+                    self.counts["blocked"] += 1
+                    break
+                except TelegramBadRequest as e:
+                    if CHAT_NOT_FOUND in e.message.lower():
+                        # Пользователь удалил аккаунт
+                        self.counts["blocked"] += 1
+                    else:
+                        # Сообщение не принято (текст, разметка) - это ошибка рассылки, а не пользователя
+                        logger.warning("Рассылка #%s: сообщение в чат %s не принято: %s",
+                                       self.broadcast_id, chat_id, e.message)
+                        self.counts["failed"] += 1
+                    break
+                except TelegramAPIError:
+                    self.counts["failed"] += 1
+                    break
+            else:
+                self.counts["failed"] += 1
+            self.sent_since_start += 1
+
+    async def _save_progress(self, finished: bool = False):
+        async with async_session() as session:
+            broadcast = await session.get(Broadcast, self.broadcast_id)
+            broadcast.last_user_id = self.last_user_id
+            broadcast.delivered = self.counts["delivered"]
+            broadcast.blocked = self.counts["blocked"]
+            broadcast.failed = self.counts["failed"]
+            if finished:
+                broadcast.status = "completed"
+                broadcast.finished_at = datetime.utcnow()
+            await session.commit()
+
+    def _report_text(self, final: bool) -> str:
+        elapsed = max(time.monotonic() - self.started, 0.001)
+        header = "✅ Рассылка завершена" if final else "📤 Идет рассылка"
+        return (
+            f"{header} #{self.broadcast_id}\n\n"
+            f"Доставлено: {self.counts['delivered']}\n"
+            f"Заблокировали бота: {self.counts['blocked']}\n"
+            f"Ошибок: {self.counts['failed']}\n"
+            f"Скорость: {self.sent_since_start / elapsed:.1f} сообщ./сек"
+        )
+
+    async def _report(self, final: bool = False):
+        now = time.monotonic()
+        if not final and now - self.last_report < BROADCAST_REPORT_INTERVAL:
+            return
+        self.last_report = now
+
+        try:
+            if self.report_message_id:
+                await self.bot.edit_message_text(
+                    self._report_text(final),
+                    chat_id=self.admin_chat_id,
+                    message_id=self.report_message_id
+                )
+            else:
+                await self.bot.send_message(self.admin_chat_id, self._report_text(final))
+        except TelegramAPIError:
+            # Отчет не должен останавливать рассылку
+            pass
+
+
+def start_broadcast(bot: Bot, broadcast: Broadcast) -> asyncio.Task:
+    """Запускает рассылку в фоне и возвращает задачу"""
+    task = asyncio.create_task(BroadcastJob(bot, broadcast).run())
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    return task
+
+
+async def create_broadcast(bot: Bot, admin_chat_id: int, text: str) -> Broadcast:
+    report = await bot.send_message(admin_chat_id, "📤 Рассылка запускается...")
+
+    async with async_session() as session:
+        broadcast = Broadcast(
+            text=text,
+            admin_chat_id=admin_chat_id,
+            report_message_id=report.message_id,
+            status="running"
+        )
+        session.add(broadcast)
+        await session.commit()
+
+    start_broadcast(bot, broadcast)
+    return broadcast
+
+
+async def resume_broadcasts(bot: Bot):
+    """Продолжает рассылки, прерванные перезапуском бота"""
+    async with async_session() as session:
+        result = await session.execute(select(Broadcast).where(Broadcast.status == "running"))
+        broadcasts = result.scalars().all()
+
+    for broadcast in broadcasts:
+        logger.info("Продолжаем рассылку #%s с пользователя %s", broadcast.id, broadcast.last_user_id)
+        start_broadcast(bot, broadcast)
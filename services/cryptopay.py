@@ -0,0 +1,97 @@
+"""Клиент Crypto Pay API (CryptoBot).
+
+Одна долгоживущая aiohttp-сессия на процесс с пулом keep-alive соединений,
+таймаутами и повторами с экспоненциальной задержкой при сетевых ошибках и
+ответах 5xx/429. Переводы идемпотентны: повтор с тем же spend_id не приводит
+к повторному списанию. Адрес API задается CRYPTO_PAY_API_URL, что позволяет
+подменить его локальным HTTP-сервером в тестах.
+"""
+import asyncio
+import logging
+import random
+from typing import Optional
+
+import aiohttp
+
+from config import (
+    CRYPTO_BOT_TOKEN, CRYPTO_PAY_API_URL, CRYPTO_PAY_CONNECTIONS,
+    CRYPTO_PAY_TIMEOUT, CRYPTO_PAY_RETRIES
+)
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class CryptoPayError(Exception):
+    """Crypto Pay API недоступен после всех повторов"""
+
+
+class CryptoPayClient:
+    def __init__(self, token: str = CRYPTO_BOT_TOKEN, base_url: str = CRYPTO_PAY_API_URL,
+                 connections: int = CRYPTO_PAY_CONNECTIONS, timeout: float = CRYPTO_PAY_TIMEOUT,
+                 retries: int = CRYPTO_PAY_RETRIES, backoff: float = 0.5):
+        self.token = token
+        self.base_url = base_url.rstrip("/")
+        self.connections = connections
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        # Сессия создается лениво, внутри работающего event loop
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.connections, keepalive_timeout=60),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                headers={"Crypto-Pay-API-Token": self.token}
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    async def request(self, method: str, params: dict = None) -> dict:
+        """Вызывает метод API и возвращает ответ вида {"ok": ..., "result"/"error": ...}"""
+        url = f"{self.base_url}/{method}"
+        for attempt in range(self.retries + 1):
+            try:
+                async with self.session.post(url, json=params or {}) as response:
+                    if response.status not in RETRY_STATUSES:
+                        return await response.json(content_type=None)
+                    error = f"HTTP {response.status}"
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = repr(e)
+
+            if attempt < self.retries:
+                delay = self.backoff * 2 ** attempt * (1 + random.random())
+                logger.warning("Crypto Pay %s: %s, повтор через %.1f с", method, error, delay)
+                await asyncio.sleep(delay)
+
+        raise CryptoPayError(f"{method}: {error}")
+
+    async def create_invoice(self, amount: float, payload: str = None) -> dict:
+        params = {
+            "asset": "USDT",
+            "amount": str(amount),
+            "description": "Пополнение баланса в ROXORT SMS",
+            "paid_btn_name": "back",
+            "paid_btn_url": "https://t.me/roxort_bot"
+        }
+        if payload is not None:
+            params["payload"] = payload
+        return await self.request("createInvoice", params)
+
+    async def transfer(self, user_id: int, amount: float, spend_id: str) -> dict:
+        return await self.request("transfer", {
+            "user_id": user_id,
+            "asset": "USDT",
+            "amount": str(amount),
+            "spend_id": spend_id
+        })
+
+
+crypto_pay = CryptoPayClient()
@@ -0,0 +1,101 @@
+"""Прием вебхуков Crypto Pay об оплаченных инвойсах.
+
+Подпись запроса проверяется по HMAC-SHA256 тела с ключом SHA256(токена).
+Каждый инвойс зачисляется ровно один раз: запись в deposits с уникальным
+invoice_id и проводка журнала (database/ledger.py) выполняются в одной транзакции.
+Уведомление пользователю записывается в outbox в той же транзакции.
+"""
+import hashlib
+import hmac
+import json
+import logging
+from urllib.parse import urlparse
+
+from aiohttp import web
+from sqlalchemy import select
+
+from config import CRYPTO_BOT_TOKEN, CRYPTO_BOT_WEBHOOK_URL
+from database.db import async_session, dialect_insert
+from database.models import User, Deposit
+from database.ledger import post, to_minor, DEPOSIT
+from database.outbox import enqueue
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_PATH = urlparse(CRYPTO_BOT_WEBHOOK_URL).path or "/cryptobot/webhook"
+
+
+def check_signature(body: bytes, signature: str, token: str = CRYPTO_BOT_TOKEN) -> bool:
+    secret = hashlib.sha256(token.encode()).digest()
+    expected = hmac.new(secret, body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature or "")
+
+
+async def credit_invoice(invoice: dict):
+    """Зачисляет оплаченный инвойс; возвращает (telegram_id, сумма) или None, если он уже зачислен"""
+    try:
+        telegram_id = int(invoice["payload"])
+        amount = float(invoice["amount"])
+    except (KeyError, TypeError, ValueError):
+        # Повтор вебхука не исправит инвойс: отвечаем 200, разбор - вручную
+        logger.error("Инвойс %s с некорректными payload/amount: %s", invoice.get("invoice_id"), invoice)
+        return None
+
+    async with async_session() as session:
+        inserted = await session.execute(
+            dialect_insert(Deposit.__table__, session.bind.dialect.name)
+            .values(
+                invoice_id=invoice["invoice_id"],
+                telegram_id=telegram_id,
+                amount=amount,
+                asset=invoice.get("asset")
+            )
+            .on_conflict_do_nothing(index_elements=["invoice_id"])
+        )
+        if inserted.rowcount == 0:
+            return None
+
+        user_id = await session.scalar(select(User.id).where(User.telegram_id == telegram_id))
+        if user_id is not None:
+            await post(session, user_id, to_minor(amount), DEPOSIT, f"invoice:{invoice['invoice_id']}")
+            enqueue(session, telegram_id, f"✅ Ваш баланс пополнен на {amount} USDT")
+        await session.commit()
+
+    if user_id is None:
+        # Инвойс остается в deposits, чтобы его можно было зачислить вручную
+        logger.error("Инвойс %s оплачен незарегистрированным %s", invoice["invoice_id"], telegram_id)
+        return None
+    return telegram_id, amount
+
+
+async def handle_cryptopay_update(request: web.Request) -> web.Response:
+    body = await request.read()
+    if not check_signature(body, request.headers.get("crypto-pay-api-signature")):
+        return web.Response(status=401)
+
+    # Некорректное обновление не исправится повторной доставкой - отвечаем 200
+    try:
+        update_data = json.loads(body)
+    except ValueError:
+        logger.error("Вебхук Crypto Pay с некорректным JSON: %r", body[:500])
+        return web.Response(text="ok")
+    if not isinstance(update_data, dict):
+        logger.error("Вебхук Crypto Pay с некорректным телом: %r", body[:500])
+        return web.Response(text="ok")
+    if update_data.get("update_type") != "invoice_paid":
+        return web.Response(text="ok")
+
+    invoice = update_data.get("payload") or {}
+    if not isinstance(invoice, dict) or not invoice.get("invoice_id"):
+        logger.error("Обновление Crypto Pay %s без инвойса: %s", update_data.get("update_id"), update_data)
+        return web.Response(text="ok")
+    if invoice.get("asset") != "USDT" or not invoice.get("payload"):
+        logger.warning("Пропущен инвойс %s: %s", invoice.get("invoice_id"), invoice)
+        return web.Response(text="ok")
+
+    await credit_invoice(invoice)
+    return web.Response(text="ok")
+
+
+def setup_cryptopay_webhook(app: web.Application):
+    app.router.add_post(WEBHOOK_PATH, handle_cryptopay_update)
@@ -0,0 +1,226 @@
+"""Хранилище FSM в локальном файле SQLite.
+
+Состояния и данные диалогов переживают перезапуск бота и доступны всем
+процессам, работающим с одним файлом (журнал WAL). Перед файлом стоит
+LRU-кэш: изменения сначала попадают в кэш и сбрасываются в файл пачкой раз в
+FSM_FLUSH_INTERVAL секунд. Кэш согласован между процессами, только если
+обновления одного пользователя всегда обрабатывает один процесс; иначе
+кэш нужно отключить (FSM_CACHE_SIZE=0), и запись пойдет сразу в файл.
+Диалоги, не менявшиеся дольше FSM_TTL секунд, считаются брошенными и удаляются.
+"""
+import asyncio
+import json
+import logging
+import time
+import zlib
+from collections import OrderedDict
+from typing import Any, Dict, Mapping, Optional, Tuple
+
+import aiosqlite
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType
+
+from config import FSM_STORAGE_PATH, FSM_CACHE_SIZE, FSM_FLUSH_INTERVAL, FSM_TTL
+
+logger = logging.getLogger(__name__)
+
+# Данные длиннее этого размера сжимаются zlib
+COMPRESS_THRESHOLD = 256
+PURGE_INTERVAL = 600
+
+
+def encode_data(data: Mapping[str, Any]) -> bytes:
+    raw = json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode()
+    if len(raw) > COMPRESS_THRESHOLD:
+        return b"z" + zlib.compress(raw)
+    return b"j" + raw
+
+
+def decode_data(blob: Optional[bytes]) -> Dict[str, Any]:
+    if not blob:
+        return {}
+    raw = zlib.decompress(blob[1:]) if blob[:1] == b"z" else blob[1:]
+    return json.loads(raw)
+
+
+class _Record:
+    __slots__ = ("state", "data", "updated_at")
+
+    def __init__(self, state: Optional[str], data: Dict[str, Any], updated_at: float):
+        self.state = state
+        self.data = data
+        self.updated_at = updated_at
+
+
+class SQLiteStorage(BaseStorage):
+    def __init__(self, path: str = FSM_STORAGE_PATH, cache_size: int = FSM_CACHE_SIZE,
+                 flush_interval: float = FSM_FLUSH_INTERVAL, ttl: float = FSM_TTL):
+        self.path = path
+        self.cache_size = cache_size
+        self.flush_interval = flush_interval
+        self.ttl = ttl
+        self._db: Optional[aiosqlite.Connection] = None
+        self._connect_lock = asyncio.Lock()
+        self._cache: "OrderedDict[str, _Record]" = OrderedDict()
+        # Измененные, но еще не записанные в файл записи; не вытесняются из памяти до записи
+        self._dirty: Dict[str, _Record] = {}
+        self._flushing: Dict[str, _Record] = {}
+        self._flusher: Optional[asyncio.Task] = None
+        self._last_purge = time.time()
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return ":".join(str(part) if part is not None else "" for part in (
+            key.bot_id, key.chat_id, key.user_id, key.thread_id,
+            key.business_connection_id, key.destiny
+        ))
+
+    async def _connection(self) -> aiosqlite.Connection:
+        if self._db is None:
+            async with self._connect_lock:
+                if self._db is None:
+                    db = await aiosqlite.connect(self.path)
+                    await db.execute("PRAGMA journal_mode=WAL")
+                    await db.execute("PRAGMA synchronous=NORMAL")
+                    await db.execute("PRAGMA busy_timeout=5000")
+                    await db.execute(
+                        "CREATE TABLE IF NOT EXISTS fsm ("
+                        "key TEXT PRIMARY KEY, state TEXT, data BLOB, updated_at REAL NOT NULL)"
+                    )
+                    await db.execute("CREATE INDEX IF NOT EXISTS ix_fsm_updated ON fsm (updated_at)")
+                    await db.commit()
+                    self._db = db
+        return self._db
+
+    def _expired(self, record: _Record) -> bool:
+        return self.ttl > 0 and record.updated_at < time.time() - self.ttl
+
+    async def _load(self, key: str) -> _Record:
+        record = self._dirty.get(key) or self._flushing.get(key) or self._cache.get(key)
+        if record is not None:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+        else:
+            db = await self._connection()
+            async with db.execute("SELECT state, data, updated_at FROM fsm WHERE key = ?", (key,)) as cursor:
+                row = await cursor.fetchone()
+            if row:
+                record = _Record(row[0], decode_data(row[1]), row[2])
+            else:
+                record = _Record(None, {}, time.time())
+            self._remember(key, record)
+
+        if self._expired(record):
+            record.state, record.data = None, {}
+        return record
+
+    def _remember(self, key: str, record: _Record):
+        if self.cache_size <= 0:
+            return
+        self._cache[key] = record
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def _store(self, key: str, record: _Record):
+        record.updated_at = time.time()
+        self._remember(key, record)
+        if self.cache_size <= 0:
+            await self._write({key: record})
+            return
+
+        self._dirty[key] = record
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def _write(self, records: Dict[str, _Record]):
+        db = await self._connection()
+        upserts, deletes = [], []
+        for key, record in records.items():
+            if record.state is None and not record.data:
+                deletes.append((key,))
+            else:
+                upserts.append((key, record.state, encode_data(record.data), record.updated_at))
+
+        if upserts:
+            await db.executemany(
+                "INSERT INTO fsm (key, state, data, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET state = excluded.state, "
+                "data = excluded.data, updated_at = excluded.updated_at",
+                upserts
+            )
+        if deletes:
+            await db.executemany("DELETE FROM fsm WHERE key = ?", deletes)
+        await db.commit()
+
+    async def flush(self):
+        """Записывает в файл все накопленные изменения одной транзакцией"""
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, {}
+        self._flushing = dirty
+        try:
+            await self._write(dirty)
+        except BaseException:
+            # Не теряем изменения: более свежие записи имеют приоритет
+            for key, record in dirty.items():
+                self._dirty.setdefault(key, record)
+            raise
+        finally:
+            self._flushing = {}
+
+    async def purge_expired(self) -> int:
+        """Удаляет брошенные диалоги, не менявшиеся дольше ttl"""
+        if self.ttl <= 0:
+            return 0
+        cutoff = time.time() - self.ttl
+        db = await self._connection()
+        cursor = await db.execute("DELETE FROM fsm WHERE updated_at < ?", (cutoff,))
+        await db.commit()
+        for key in [k for k, r in self._cache.items() if r.updated_at < cutoff and k not in self._dirty]:
+            del self._cache[key]
+        return cursor.rowcount
+
+    async def _flush_loop(self):
+        while self._dirty:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+                if time.time() - self._last_purge > PURGE_INTERVAL:
+                    self._last_purge = time.time()
+                    purged = await self.purge_expired()
+                    if purged:
+                        logger.info("Удалено брошенных диалогов FSM: %s", purged)
+            except Exception:
+                logger.exception("Ошибка записи FSM в %s", self.path)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        skey = self._key(key)
+        record = await self._load(skey)
+        new_state = state.state if isinstance(state, State) else state
+        await self._store(skey, _Record(new_state, record.data, record.updated_at))
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._load(self._key(key))).state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        skey = self._key(key)
+        record = await self._load(skey)
+        await self._store(skey, _Record(record.state, dict(data), record.updated_at))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return dict((await self._load(self._key(key))).data)
+
+    def stats(self) -> Tuple[int, int]:
+        """(записей в кэше, записей ожидают сброса в файл)"""
+        return len(self._cache), len(self._dirty)
+
+    async def close(self) -> None:
+        if self._flusher is not None:
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+            self._flusher = None
+        await self.flush()
+        if self._db is not None:
+            await self._db.close()
+            self._db = None
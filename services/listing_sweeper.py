@@ -0,0 +1,50 @@
+"""Снятие с продажи устаревших объявлений.
+
+Объявления старше LISTING_TTL деактивируются порциями по LISTING_SWEEP_BATCH:
+каждая порция - отдельная короткая транзакция, между порциями задача уступает
+цикл событий и блокировку записи SQLite обработчикам. Снятые объявления
+удаляются из индекса объявлений в памяти.
+"""
+import asyncio
+import logging
+from datetime import datetime, timedelta
+
+from config import LISTING_TTL, LISTING_SWEEP_INTERVAL, LISTING_SWEEP_BATCH, LISTING_SWEEP_PAUSE
+from database.db import async_session
+from database.listing_index import listing_index
+from database.listings import expire_listings_statement
+
+logger = logging.getLogger(__name__)
+
+
+async def sweep_expired_listings(
+    ttl: float = LISTING_TTL,
+    batch_size: int = LISTING_SWEEP_BATCH,
+    pause: float = LISTING_SWEEP_PAUSE
+) -> int:
+    """Деактивирует объявления старше ttl секунд; возвращает их количество"""
+    cutoff = datetime.utcnow() - timedelta(seconds=ttl)
+    swept = 0
+    while True:
+        async with async_session() as session:
+            ids = (await session.scalars(expire_listings_statement(cutoff, batch_size))).all()
+            await session.commit()
+
+        for listing_id in ids:
+            listing_index.remove(listing_id)
+        swept += len(ids)
+        if len(ids) < batch_size:
+            return swept
+        await asyncio.sleep(pause)
+
+
+async def sweeper_loop(interval: float = LISTING_SWEEP_INTERVAL):
+    """Периодическая очистка; запускается отдельной задачей"""
+    while True:
+        try:
+            swept = await sweep_expired_listings()
+            if swept:
+                logger.info("Снято с продажи устаревших объявлений: %s", swept)
+        except Exception:
+            logger.exception("Очистка устаревших объявлений завершилась ошибкой")
+        await asyncio.sleep(interval)
@@ -0,0 +1,263 @@
+"""Метрики обработчиков обновлений.
+
+Для каждого обработчика (модуль.функция) считаются обновления и ошибки,
+гистограмма времени обработки, SQL-запросы и время их выполнения, а также
+запросы к Bot API, сделанные во время обработки. Запросы вне обновлений
+(outbox, рассылки, getUpdates) попадают под обработчик "background".
+
+Данные процесса хранятся в `registry`. Процессы-обработчики (services/
+workers.py) присылают снимок вместе со статистикой, супервизор складывает
+снимки всех процессов. Снимок в текстовом формате Prometheus отдается по
+GET на METRICS_PATH отдельным HTTP-сервером на METRICS_HOST:METRICS_PORT,
+JSON - по METRICS_PATH + ".json".
+"""
+import asyncio
+import bisect
+import logging
+from contextvars import ContextVar
+from typing import Callable, Dict, List, Optional, Tuple
+
+import aiohttp
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.methods import TelegramMethod
+from aiohttp import web
+
+from config import METRICS_HOST, METRICS_PORT, METRICS_PATH
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограммы времени обработки, секунд
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Обработчик для событий без найденного обработчика и для запросов вне обновлений
+UNHANDLED = "unhandled"
+BACKGROUND = "background"
+
+
+class UpdateMetrics:
+    """Обрабатываемое обновление: имя обработчика задает MetricsMiddleware"""
+    __slots__ = ("handler",)
+
+    def __init__(self):
+        self.handler = UNHANDLED
+
+
+current_update: ContextVar[Optional[UpdateMetrics]] = ContextVar("update_metrics", default=None)
+
+
+class HandlerMetrics:
+    __slots__ = ("updates", "errors", "latency", "buckets", "queries", "query_time")
+
+    def __init__(self):
+        self.updates = 0
+        self.errors = 0
+        self.latency = 0.0
+        # Число обновлений в каждой корзине; последняя - больше LATENCY_BUCKETS[-1]
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.queries = 0
+        self.query_time = 0.0
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.handlers: Dict[str, HandlerMetrics] = {}
+        # (обработчик, метод Bot API) -> [запросов, ошибок]
+        self.api: Dict[Tuple[str, str], List[int]] = {}
+        # Номер процесса-обработчика; None - единственный процесс или супервизор
+        self.worker: Optional[int] = None
+
+    def observe_update(self, handler: str, duration: float, failed: bool, queries: int = 0,
+                       query_time: float = 0.0):
+        metrics = self.handlers.get(handler)
+        if metrics is None:
+            metrics = self.handlers[handler] = HandlerMetrics()
+        metrics.updates += 1
+        metrics.errors += failed
+        metrics.latency += duration
+        metrics.buckets[bisect.bisect_left(LATENCY_BUCKETS, duration)] += 1
+        metrics.queries += queries
+        metrics.query_time += query_time
+
+    def observe_api(self, method: str, failed: bool):
+        update = current_update.get()
+        key = (update.handler if update is not None else BACKGROUND, method)
+        counters = self.api.get(key)
+        if counters is None:
+            counters = self.api[key] = [0, 0]
+        counters[0] += 1
+        counters[1] += failed
+
+    def snapshot(self) -> dict:
+        """Накопленные значения в виде, пригодном для JSON и передачи между процессами"""
+        return {
+            "handlers": {
+                name: {
+                    "updates": m.updates,
+                    "errors": m.errors,
+                    "latency": m.latency,
+                    "buckets": list(m.buckets),
+                    "queries": m.queries,
+                    "query_time": m.query_time,
+                }
+                for name, m in self.handlers.items()
+            },
+            "api": [[handler, method, calls, errors] for (handler, method), (calls, errors) in self.api.items()],
+        }
+
+
+registry = MetricsRegistry()
+
+
+def merge_snapshots(snapshots: List[dict]) -> dict:
+    """Сумма снимков нескольких процессов"""
+    handlers: Dict[str, dict] = {}
+    api: Dict[Tuple[str, str], List[int]] = {}
+    for snapshot in snapshots:
+        for name, m in snapshot["handlers"].items():
+            total = handlers.get(name)
+            if total is None:
+                handlers[name] = {**m, "buckets": list(m["buckets"])}
+                continue
+            for key in ("updates", "errors", "latency", "queries", "query_time"):
+                total[key] += m[key]
+            total["buckets"] = [a + b for a, b in zip(total["buckets"], m["buckets"])]
+        for handler, method, calls, errors in snapshot["api"]:
+            counters = api.setdefault((handler, method), [0, 0])
+            counters[0] += calls
+            counters[1] += errors
+    return {
+        "handlers": handlers,
+        "api": [[handler, method, calls, errors] for (handler, method), (calls, errors) in api.items()],
+    }
+
+
+def estimate_quantile(buckets: List[int], q: float) -> float:
+    """Квантиль по гистограмме с линейной интерполяцией внутри корзины, как histogram_quantile"""
+    total = sum(buckets)
+    if not total:
+        return 0.0
+    rank = q * total
+    seen = 0
+    for index, count in enumerate(buckets):
+        if count and seen + count >= rank:
+            if index == len(LATENCY_BUCKETS):
+                return LATENCY_BUCKETS[-1]
+            lower = LATENCY_BUCKETS[index - 1] if index else 0.0
+            return lower + (LATENCY_BUCKETS[index] - lower) * (rank - seen) / count
+        seen += count
+    return LATENCY_BUCKETS[-1]
+
+
+def _label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def render_prometheus(snapshot: dict) -> str:
+    """Снимок в текстовом формате Prometheus"""
+    handlers = sorted(snapshot["handlers"].items())
+    lines = [
+        "# HELP bot_handler_duration_seconds Время обработки обновления, включая коммит",
+        "# TYPE bot_handler_duration_seconds histogram",
+    ]
+    for name, m in handlers:
+        label = _label(name)
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS, m["buckets"]):
+            cumulative += count
+            lines.append(f'bot_handler_duration_seconds_bucket{{handler="{label}",le="{bound}"}} {cumulative}')
+        lines.append(f'bot_handler_duration_seconds_bucket{{handler="{label}",le="+Inf"}} {m["updates"]}')
+        lines.append(f'bot_handler_duration_seconds_sum{{handler="{label}"}} {m["latency"]:.6f}')
+        lines.append(f'bot_handler_duration_seconds_count{{handler="{label}"}} {m["updates"]}')
+
+    counters = (
+        ("bot_handler_errors_total", "Обновления, завершившиеся исключением", "errors", "{}"),
+        ("bot_handler_db_queries_total", "SQL-запросы при обработке обновлений", "queries", "{}"),
+        ("bot_handler_db_seconds_total", "Время выполнения SQL-запросов", "query_time", "{:.6f}"),
+    )
+    for metric, help_text, key, fmt in counters:
+        lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} counter"]
+        lines += [f'{metric}{{handler="{_label(name)}"}} {fmt.format(m[key])}' for name, m in handlers]
+
+    api = sorted(snapshot["api"])
+    for metric, help_text, index in (
+        ("bot_api_requests_total", "Запросы к Bot API", 2),
+        ("bot_api_errors_total", "Запросы к Bot API, завершившиеся ошибкой", 3),
+    ):
+        lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} counter"]
+        lines += [f'{metric}{{handler="{_label(row[0])}",method="{row[1]}"}} {row[index]}' for row in api]
+    return "\n".join(lines) + "\n"
+
+
+def summarize(snapshot: dict) -> List[dict]:
+    """Сводка по обработчикам, от самых затратных по суммарному времени"""
+    api_calls: Dict[str, int] = {}
+    for handler, method, calls, errors in snapshot["api"]:
+        api_calls[handler] = api_calls.get(handler, 0) + calls
+    rows = []
+    for name, m in snapshot["handlers"].items():
+        updates = m["updates"]
+        rows.append({
+            "handler": name,
+            "updates": updates,
+            "error_rate": m["errors"] / updates,
+            "p50": estimate_quantile(m["buckets"], 0.5),
+            "p95": estimate_quantile(m["buckets"], 0.95),
+            "avg": m["latency"] / updates,
+            "total": m["latency"],
+            "queries": m["queries"] / updates,
+            "query_time": m["query_time"] / updates,
+            "api_calls": api_calls.get(name, 0) / updates,
+        })
+    rows.sort(key=lambda row: row["total"], reverse=True)
+    return rows
+
+
+async def collect_snapshot() -> dict:
+    """Снимок для сводки администратору.
+
+    В процессе-обработчике берется общий снимок у супервизора, при его
+    недоступности - снимок своего процесса.
+    """
+    if registry.worker is None or not METRICS_PORT:
+        return registry.snapshot()
+    host = "127.0.0.1" if METRICS_HOST in ("", "0.0.0.0") else METRICS_HOST
+    try:
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=3)) as session:
+            async with session.get(f"http://{host}:{METRICS_PORT}{METRICS_PATH}.json") as response:
+                response.raise_for_status()
+                return await response.json()
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        logger.warning("Метрики супервизора недоступны, показаны метрики процесса %s", registry.worker)
+        return registry.snapshot()
+
+
+class ApiCallCounter(BaseRequestMiddleware):
+    """Считает запросы бота к Bot API по обработчику, в котором они сделаны"""
+
+    def __init__(self, metrics: MetricsRegistry = registry):
+        self.metrics = metrics
+
+    async def __call__(self, make_request: NextRequestMiddlewareType, bot: Bot, method: TelegramMethod):
+        try:
+            response = await make_request(bot, method)
+        except Exception:
+            self.metrics.observe_api(type(method).__name__, True)
+            raise
+        self.metrics.observe_api(type(method).__name__, False)
+        return response
+
+
+def setup_metrics(app: web.Application, source: Callable[[], dict] = registry.snapshot):
+    """Маршруты метрик; source возвращает снимок (у супервизора - сумму по процессам)"""
+
+    async def handle_metrics(request: web.Request) -> web.Response:
+        return web.Response(
+            body=render_prometheus(source()).encode(),
+            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+        )
+
+    async def handle_json(request: web.Request) -> web.Response:
+        return web.json_response(source())
+
+    app.router.add_get(METRICS_PATH, handle_metrics)
+    app.router.add_get(METRICS_PATH + ".json", handle_json)
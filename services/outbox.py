@@ -0,0 +1,255 @@
+"""Отправка уведомлений из outbox.
+
+OutboxSender выбирает по одному сообщению на чат - самое раннее ожидающее,
+если его время попытки наступило, - и запускает по задаче на чат. Задача
+отправляет это сообщение и следующие за ним сообщения чата в порядке записи
+(до OUTBOX_BATCH за проход), разные чаты идут параллельно (до
+OUTBOX_CONCURRENCY). Поэтому чат с длинной очередью или ожидающий повтора
+не занимает выборку и не задерживает остальные. Если сообщение не
+отправилось, остальные сообщения этого чата ждут его повторной попытки.
+Результаты копятся в памяти и записываются в БД пачкой: одним UPDATE для
+всех доставленных и одним пакетным UPDATE для ошибок.
+
+Выборка запускается по сигналу после коммита в этом процессе и, для
+сообщений из процессов-обработчиков, раз в OUTBOX_POLL_INTERVAL секунд.
+"""
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, Set
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest
+from aiogram.types import InlineKeyboardMarkup
+from sqlalchemy import select, update, delete, func
+
+from config import (
+    OUTBOX_CONCURRENCY, OUTBOX_BATCH, OUTBOX_POLL_INTERVAL, OUTBOX_MAX_ATTEMPTS,
+    OUTBOX_RETRY_DELAY, OUTBOX_RETENTION
+)
+from database.db import async_session
+from database.loader import IN_CHUNK_SIZE
+from database.models import OutboxMessage
+from database.outbox import set_wakeup
+from services.rate_limit import bulk_traffic
+
+logger = logging.getLogger(__name__)
+
+# Секунд между удалениями старых отправленных сообщений
+PRUNE_INTERVAL = 60 * 60
+
+
+class OutboxSender:
+    def __init__(self, bot: Bot, concurrency: int = OUTBOX_CONCURRENCY, batch_size: int = OUTBOX_BATCH,
+                 poll_interval: float = OUTBOX_POLL_INTERVAL):
+        self.bot = bot
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self._wakeup = asyncio.Event()
+        self._loop_task = None
+        self._tasks: Set[asyncio.Task] = set()
+        # Чаты, в которые сейчас идет отправка
+        self._busy: Set[int] = set()
+        # Результаты, еще не записанные в БД: id -> время доставки / изменения строки
+        self._delivered: Dict[int, datetime] = {}
+        self._failures: Dict[int, dict] = {}
+        self._last_prune = 0.0
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+
+    def wake(self):
+        self._wakeup.set()
+
+    def start(self):
+        set_wakeup(self.wake)
+        self._loop_task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float = 10):
+        set_wakeup(None)
+        if self._loop_task:
+            self._loop_task.cancel()
+        if self._tasks:
+            await asyncio.wait(self._tasks, timeout=timeout)
+        await self._flush()
+
+    def stats(self) -> dict:
+        return {
+            "sent": self.sent,
+            "retried": self.retried,
+            "failed": self.failed,
+            "busy_chats": len(self._busy),
+            "unflushed": len(self._delivered) + len(self._failures),
+        }
+
+    async def _run(self):
+        # Уведомления уступают очередь к Telegram ответам пользователям
+        with bulk_traffic():
+            await self._loop()
+
+    async def _loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self._flush()
+                await self._dispatch()
+                await self._prune()
+            except Exception:
+                logger.exception("Ошибка обработки outbox")
+
+    @staticmethod
+    def _pending_rows():
+        return select(
+            OutboxMessage.id, OutboxMessage.chat_id, OutboxMessage.text,
+            OutboxMessage.reply_markup, OutboxMessage.attempts, OutboxMessage.next_attempt_at
+        ).where(OutboxMessage.status == "pending")
+
+    async def _dispatch(self):
+        # Первое ожидающее сообщение каждого чата: если оно ждет повторной
+        # попытки, чат в выборку не попадает - порядок важнее
+        heads = (
+            select(func.min(OutboxMessage.id))
+            .where(OutboxMessage.status == "pending")
+            .group_by(OutboxMessage.chat_id)
+        )
+        # Только основная сессия: реплика может не видеть свежих сообщений или
+        # отставать по статусу и вернуть уже доставленные
+        async with async_session() as session:
+            rows = (await session.execute(
+                self._pending_rows()
+                .where(OutboxMessage.id.in_(heads), OutboxMessage.next_attempt_at <= datetime.utcnow())
+                .order_by(OutboxMessage.id)
+                # Занятые чаты пропускаются ниже и не должны вытеснять свободные
+                .limit(self.batch_size + len(self._busy))
+            )).all()
+
+        for row in rows:
+            # Результат по первому сообщению еще не записан - чат дождется следующего прохода
+            if row.chat_id in self._busy or row.id in self._delivered or row.id in self._failures:
+                continue
+            self._busy.add(row.chat_id)
+            task = asyncio.create_task(self._deliver_chat(row))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _chat_backlog(self, chat_id: int, after_id: int, limit: int) -> List:
+        """Следующие ожидающие сообщения чата в порядке записи"""
+        async with async_session() as session:
+            return (await session.execute(
+                self._pending_rows()
+                .where(OutboxMessage.chat_id == chat_id, OutboxMessage.id > after_id)
+                .order_by(OutboxMessage.id)
+                .limit(limit)
+            )).all()
+
+    async def _deliver_chat(self, head):
+        chat_id = head.chat_id
+        try:
+            async with self.semaphore:
+                if not await self._send(head):
+                    return
+                # Остаток очереди чата, не больше OUTBOX_BATCH за проход: длинная
+                # очередь продолжится в следующем проходе и не займет слот надолго
+                now = datetime.utcnow()
+                for message in await self._chat_backlog(chat_id, head.id, self.batch_size - 1):
+                    if message.next_attempt_at > now or not await self._send(message):
+                        break
+        finally:
+            self._busy.discard(chat_id)
+            # Доставленное записываем при следующем проходе, не дожидаясь таймера
+            self.wake()
+
+    async def _send(self, message) -> bool:
+        markup = InlineKeyboardMarkup.model_validate_json(message.reply_markup) if message.reply_markup else None
+        try:
+            await self.bot.send_message(message.chat_id, message.text, reply_markup=markup)
+        except TelegramRetryAfter as e:
+            self._retry(message, e.retry_after, str(e), count_attempt=False)
+            return False
+        except (TelegramForbiddenError, TelegramBadRequest) as e:
+            # Бот заблокирован или сообщение не принимается - повтор не поможет
+            self._fail(message, str(e))
+            return True
+        except Exception as e:
+            if message.attempts + 1 >= OUTBOX_MAX_ATTEMPTS:
+                self._fail(message, str(e))
+                return True
+            self._retry(message, OUTBOX_RETRY_DELAY * 2 ** message.attempts, str(e))
+            return False
+
+        self._delivered[message.id] = datetime.utcnow()
+        self.sent += 1
+        return True
+
+    def _retry(self, message, delay: float, error: str, count_attempt: bool = True):
+        self.retried += 1
+        self._failures[message.id] = {
+            "id": message.id,
+            "status": "pending",
+            "attempts": message.attempts + (1 if count_attempt else 0),
+            "next_attempt_at": datetime.utcnow() + timedelta(seconds=delay),
+            "last_error": error[:500],
+        }
+
+    def _fail(self, message, error: str):
+        self.failed += 1
+        logger.warning("Уведомление %s в чат %s не отправлено: %s", message.id, message.chat_id, error)
+        self._failures[message.id] = {
+            "id": message.id,
+            "status": "failed",
+            "attempts": message.attempts + 1,
+            "next_attempt_at": datetime.utcnow(),
+            "last_error": error[:500],
+        }
+
+    async def _flush(self):
+        """Записывает накопленные результаты отправки"""
+        delivered, self._delivered = self._delivered, {}
+        failures, self._failures = self._failures, {}
+        if not delivered and not failures:
+            return
+
+        try:
+            async with async_session() as session:
+                ids = sorted(delivered)
+                for start in range(0, len(ids), IN_CHUNK_SIZE):
+                    chunk = ids[start:start + IN_CHUNK_SIZE]
+                    await session.execute(
+                        update(OutboxMessage)
+                        .where(OutboxMessage.id.in_(chunk))
+                        .values(status="delivered", delivered_at=delivered[chunk[-1]])
+                        .execution_options(synchronize_session=False)
+                    )
+                if failures:
+                    await session.execute(update(OutboxMessage), list(failures.values()))
+                await session.commit()
+        except Exception:
+            # Не записанное вернется при следующем проходе, сообщения не будут отправлены повторно
+            self._delivered.update(delivered)
+            for message_id, failure in failures.items():
+                self._failures.setdefault(message_id, failure)
+            raise
+
+    async def _prune(self):
+        if time.monotonic() - self._last_prune < PRUNE_INTERVAL:
+            return
+        self._last_prune = time.monotonic()
+        cutoff = datetime.utcnow() - timedelta(seconds=OUTBOX_RETENTION)
+        async with async_session() as session:
+            old = (
+                select(OutboxMessage.id)
+                .where(OutboxMessage.status != "pending", OutboxMessage.created_at < cutoff)
+                .limit(self.batch_size * 10)
+            )
+            result = await session.execute(
+                delete(OutboxMessage).where(OutboxMessage.id.in_(old.scalar_subquery()))
+            )
+            await session.commit()
+        if result.rowcount:
+            logger.info("Удалено старых уведомлений из outbox: %s", result.rowcount)
@@ -0,0 +1,203 @@
+"""Ограничение частоты запросов к Telegram API.
+
+TelegramRateLimiter подключается к сессии бота и пропускает каждый запрос,
+адресованный чату, через две корзины токенов: корзину этого чата и общую
+корзину бота. Общие токены выдаются по очереди с приоритетом: ответы
+пользователям идут раньше массовых отправок (рассылка, outbox), которые
+помечаются контекстом bulk_traffic(). RetryAfter от Telegram ставит на паузу
+только чат, к которому относился запрос: ответ пользователю повторяется после
+паузы, массовая отправка получает исключение и повторяет сама.
+"""
+import asyncio
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Optional, Union
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import TelegramMethod
+
+from config import TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST, TELEGRAM_RETRY_WAIT
+
+# Приоритеты исходящих запросов
+INTERACTIVE = "interactive"
+BULK = "bulk"
+
+# Повторов ответа пользователю после RetryAfter
+INTERACTIVE_RETRIES = 2
+# Корзин чатов, после которого простаивающие удаляются
+CHAT_BUCKETS_LIMIT = 10_000
+# Ожидание дольше этого (секунд) считается задержкой ограничителем
+THROTTLE_THRESHOLD = 0.001
+
+_traffic: ContextVar[str] = ContextVar("telegram_traffic", default=INTERACTIVE)
+
+
+class TokenBucket:
+    """Корзина токенов: не более rate операций в секунду, всплески до capacity"""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def pause(self, seconds: float):
+        """Останавливает выдачу токенов, например по RetryAfter от Telegram"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def paused(self) -> bool:
+        return time.monotonic() < self._paused_until
+
+    def idle(self) -> bool:
+        """Корзина полна, не на паузе и никто не ждет - ее можно удалить без потери ограничения"""
+        now = time.monotonic()
+        self._refill(now)
+        return self._tokens >= self.capacity and now >= self._paused_until and not self._lock.locked()
+
+    async def acquire(self, tokens: float = 1):
+        # Ожидающие получают токены по очереди, в порядке вызова
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+
+                self._refill(now)
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self._tokens) / self.rate)
+
+
+@contextmanager
+def bulk_traffic():
+    """Запросы внутри контекста (и созданных в нем задач) идут с низким приоритетом"""
+    token = _traffic.set(BULK)
+    try:
+        yield
+    finally:
+        _traffic.reset(token)
+
+
+class TelegramRateLimiter(BaseRequestMiddleware):
+    def __init__(self, rate: float = TELEGRAM_GLOBAL_RATE, chat_rate: float = TELEGRAM_CHAT_RATE,
+                 chat_burst: int = TELEGRAM_CHAT_BURST, retry_wait: float = TELEGRAM_RETRY_WAIT):
+        self.bucket = TokenBucket(rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.retry_wait = retry_wait
+        self._chats: Dict[Union[int, str], TokenBucket] = {}
+        self._chats_limit = CHAT_BUCKETS_LIMIT
+        # Ожидающие общего токена, по приоритетам
+        self._queues = {INTERACTIVE: deque(), BULK: deque()}
+        self._wakeup = asyncio.Event()
+        self._dispatcher: Optional[asyncio.Task] = None
+        self.requests = {INTERACTIVE: 0, BULK: 0}
+        self.throttled = {INTERACTIVE: 0, BULK: 0}
+        self.retry_after = 0
+        self.retried = 0
+
+    async def __call__(self, make_request: NextRequestMiddlewareType, bot: Bot, method: TelegramMethod):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            # getUpdates, ответы на callback и прочие запросы не к чату не ограничиваются
+            return await make_request(bot, method)
+
+        priority = _traffic.get()
+        self.requests[priority] += 1
+        retries = INTERACTIVE_RETRIES if priority == INTERACTIVE else 0
+        while True:
+            await self._acquire(chat_id, priority)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                self.retry_after += 1
+                self._chat(chat_id).pause(e.retry_after)
+                if not retries or e.retry_after > self.retry_wait:
+                    raise
+                retries -= 1
+                self.retried += 1
+
+    async def _acquire(self, chat_id: Union[int, str], priority: str):
+        started = time.monotonic()
+        await self._chat(chat_id).acquire()
+
+        future = asyncio.get_running_loop().create_future()
+        self._queues[priority].append(future)
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        self._wakeup.set()
+        # Отмена ожидающего отменяет и future - диспетчер его пропустит
+        await future
+
+        if time.monotonic() - started > THROTTLE_THRESHOLD:
+            self.throttled[priority] += 1
+
+    def _next_waiter(self) -> Optional[asyncio.Future]:
+        for priority in (INTERACTIVE, BULK):
+            waiters = self._queues[priority]
+            while waiters and waiters[0].done():
+                waiters.popleft()
+            if waiters:
+                return waiters[0]
+        return None
+
+    async def _dispatch(self):
+        """Выдает общие токены: сначала ответам пользователям, затем массовым отправкам"""
+        while True:
+            if self._next_waiter() is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            await self.bucket.acquire()
+            # Пока ждали токен, мог прийти запрос с более высоким приоритетом
+            future = self._next_waiter()
+            if future is not None:
+                for waiters in self._queues.values():
+                    if waiters and waiters[0] is future:
+                        waiters.popleft()
+                future.set_result(None)
+
+    def _chat(self, chat_id: Union[int, str]) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= self._chats_limit:
+                self._prune_chats()
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _prune_chats(self):
+        self._chats = {chat_id: bucket for chat_id, bucket in self._chats.items() if not bucket.idle()}
+        # Если почти все корзины заняты, следующая очистка - после удвоения
+        self._chats_limit = max(CHAT_BUCKETS_LIMIT, len(self._chats) * 2)
+
+    def stats(self) -> dict:
+        return {
+            "queued": {priority: sum(not w.done() for w in waiters) for priority, waiters in self._queues.items()},
+            "requests": dict(self.requests),
+            "throttled": dict(self.throttled),
+            "retry_after": self.retry_after,
+            "retried": self.retried,
+            "chats": len(self._chats),
+            "paused_chats": sum(1 for bucket in self._chats.values() if bucket.paused()),
+        }
+
+
+def rate_limiter_stats(bot: Bot) -> Optional[dict]:
+    """Статистика ограничителя, подключенного к сессии бота"""
+    for middleware in bot.session.middleware:
+        if isinstance(middleware, TelegramRateLimiter):
+            return middleware.stats()
+    return None
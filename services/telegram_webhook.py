@@ -0,0 +1,102 @@
+"""Прием обновлений Telegram через вебхук.
+
+Обновления складываются в ограниченную очередь и обрабатываются пулом из
+WEBHOOK_CONCURRENCY задач, которые передают их в Dispatcher. Если очередь
+заполнена, ответ Telegram задерживается до освобождения места, и Telegram
+сам снижает темп доставки. Глубина очереди и счетчики доступны по GET на
+WEBHOOK_STATS_PATH.
+"""
+import asyncio
+import logging
+import time
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+from aiohttp import web
+
+from config import (
+    TELEGRAM_WEBHOOK_PATH, TELEGRAM_WEBHOOK_SECRET, WEBHOOK_CONCURRENCY,
+    WEBHOOK_QUEUE_SIZE, WEBHOOK_STATS_PATH
+)
+
+logger = logging.getLogger(__name__)
+
+
+class UpdateQueue:
+    def __init__(self, dp: Dispatcher, bot: Bot, concurrency: int = WEBHOOK_CONCURRENCY,
+                 maxsize: int = WEBHOOK_QUEUE_SIZE):
+        self.dp = dp
+        self.bot = bot
+        self.concurrency = concurrency
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self.workers = []
+        self.in_flight = 0
+        self.processed = 0
+        self.failed = 0
+        self.started = time.monotonic()
+
+    async def put(self, update: Update):
+        await self.queue.put(update)
+
+    async def _worker(self):
+        while True:
+            update = await self.queue.get()
+            self.in_flight += 1
+            try:
+                await self.dp.feed_update(self.bot, update)
+                self.processed += 1
+            except Exception:
+                self.failed += 1
+                logger.exception("Ошибка обработки обновления %s", update.update_id)
+            finally:
+                self.in_flight -= 1
+                self.queue.task_done()
+
+    def start(self):
+        self.workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    async def stop(self, timeout: float = 10):
+        """Дожидается обработки уже принятых обновлений и останавливает пул"""
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Не обработано обновлений при остановке: %s", self.queue.qsize())
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.queue.qsize(),
+            "queue_size": self.queue.maxsize,
+            "in_flight": self.in_flight,
+            "concurrency": self.concurrency,
+            "processed": self.processed,
+            "failed": self.failed,
+            "uptime": round(time.monotonic() - self.started, 1),
+        }
+
+
+def check_secret(request: web.Request) -> bool:
+    """Проверяет секрет, переданный Telegram в заголовке запроса"""
+    return not TELEGRAM_WEBHOOK_SECRET or \
+        request.headers.get("X-Telegram-Bot-Api-Secret-Token") == TELEGRAM_WEBHOOK_SECRET
+
+
+def setup_telegram_webhook(app: web.Application, dp: Dispatcher, bot: Bot) -> UpdateQueue:
+    updates = UpdateQueue(dp, bot)
+
+    async def handle_update(request: web.Request) -> web.Response:
+        if not check_secret(request):
+            return web.Response(status=401)
+
+        update = Update.model_validate(await request.json(), context={"bot": bot})
+        await updates.put(update)
+        return web.Response()
+
+    async def handle_stats(request: web.Request) -> web.Response:
+        return web.json_response(updates.stats())
+
+    app.router.add_post(TELEGRAM_WEBHOOK_PATH, handle_update)
+    app.router.add_get(WEBHOOK_STATS_PATH, handle_stats)
+    return updates
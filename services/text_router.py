@@ -0,0 +1,44 @@
+"""Маршрутизация нажатий кнопок главного меню.
+
+Обработчики кнопок регистрируются в text_router по тексту кнопки и хранятся
+в словаре: для каждого сообщения выполняется один поиск по словарю вместо
+проверки фильтров всех кнопок всех роутеров. text_router подключается к
+диспетчеру последним, поэтому обработчики состояний FSM в остальных роутерах
+срабатывают раньше кнопок. Состояния в роутерах задаются через StateFilter:
+синхронные фильтры (лямбды, State) aiogram вызывает через asyncio.to_thread,
+и каждый из них стоил обновлению переключения в пул потоков.
+"""
+from typing import Callable, Dict
+
+from aiogram import Router
+from aiogram.dispatcher.event.handler import CallableObject
+from aiogram.types import Message
+
+
+class TextCommandRouter(Router):
+    def __init__(self, *, name: str = None):
+        super().__init__(name=name)
+        self.handlers: Dict[str, CallableObject] = {}
+        self.message.register(self._dispatch, self._match)
+
+    def button(self, *texts: str) -> Callable:
+        """Регистрирует обработчик для одной или нескольких кнопок"""
+        def decorator(callback: Callable) -> Callable:
+            handler = CallableObject(callback)
+            for text in texts:
+                if text in self.handlers:
+                    raise ValueError(f"Кнопка {text!r} уже зарегистрирована")
+                self.handlers[text] = handler
+            return callback
+        return decorator
+
+    async def _match(self, message: Message) -> bool:
+        # Синхронные фильтры aiogram выполняет в пуле потоков, поэтому фильтр асинхронный
+        return message.text in self.handlers
+
+    async def _dispatch(self, message: Message, **data):
+        # Обработчик получает только те данные, которые объявлены в его параметрах
+        return await self.handlers[message.text].call(message, **data)
+
+
+text_router = TextCommandRouter(name="text_commands")
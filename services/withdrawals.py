@@ -0,0 +1,142 @@
+"""Вывод средств в CryptoBot.
+
+Списание и запись withdrawals фиксируются одним коммитом до перевода.
+Исход перевода:
+    ok                 - вывод завершен;
+    ok: false          - API явно отказал, списанное возвращается проводкой
+                         WITHDRAWAL_REVERSAL;
+    нет ответа         - повторы клиента исчерпаны на таймауте, 5xx или обрыве
+                         связи, и неизвестно, прошел ли перевод. Списание
+                         остается, вывод ждет повтора с тем же spend_id
+                         (retry_loop); повтор идемпотентен и не выплатит дважды.
+Ошибка API, связанная со spend_id, на повторе означает, что перевод мог уже
+пройти: такой вывод переводится в review для ручной проверки, без возврата.
+Смена статуса - условный UPDATE по status='pending', поэтому обработчик и
+повтор не проведут возврат дважды.
+"""
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config import WITHDRAWAL_RETRY_DELAY, WITHDRAWAL_RETRY_INTERVAL, WITHDRAWAL_RETRY_BATCH
+from database.db import async_session
+from database.ledger import post, from_minor, WITHDRAWAL, WITHDRAWAL_REVERSAL
+from database.models import User, Withdrawal
+from database.outbox import enqueue
+from services.cryptopay import crypto_pay, CryptoPayError
+
+logger = logging.getLogger(__name__)
+
+PENDING = "pending"
+COMPLETED = "completed"
+REJECTED = "rejected"
+REVIEW = "review"
+
+
+async def open_withdrawal(session: AsyncSession, user: User, amount_minor: int,
+                          spend_id: str) -> Optional[Withdrawal]:
+    """Списывает сумму и создает запись вывода; None - средств недостаточно"""
+    balance = await post(session, user.id, -amount_minor, WITHDRAWAL, spend_id, require_funds=True)
+    if balance is None:
+        return None
+    withdrawal = Withdrawal(
+        spend_id=spend_id,
+        user_id=user.id,
+        telegram_id=user.telegram_id,
+        amount_minor=amount_minor,
+        # Повтор не начнется, пока идет первая попытка в обработчике
+        next_attempt_at=datetime.utcnow() + timedelta(seconds=WITHDRAWAL_RETRY_DELAY)
+    )
+    session.add(withdrawal)
+    return withdrawal
+
+
+async def send_transfer(withdrawal: Withdrawal) -> Optional[dict]:
+    """Ответ API на перевод; None - исход неизвестен"""
+    try:
+        return await crypto_pay.transfer(
+            withdrawal.telegram_id, from_minor(withdrawal.amount_minor), withdrawal.spend_id
+        )
+    except (CryptoPayError, ValueError) as e:
+        # ValueError - ответ, который не удалось разобрать как JSON
+        logger.warning("Вывод %s: исход перевода неизвестен: %r", withdrawal.spend_id, e)
+        return None
+
+
+async def settle_withdrawal(session: AsyncSession, withdrawal: Withdrawal,
+                            response: Optional[dict]) -> Optional[str]:
+    """Записывает исход перевода; возвращает новый статус (None - вывод уже завершен другим)"""
+    now = datetime.utcnow()
+    pending = update(Withdrawal).where(Withdrawal.id == withdrawal.id, Withdrawal.status == PENDING)
+
+    if response is None:
+        await session.execute(pending.values(
+            attempts=Withdrawal.attempts + 1,
+            next_attempt_at=now + timedelta(seconds=WITHDRAWAL_RETRY_DELAY),
+            last_error="нет ответа"
+        ))
+        return PENDING
+
+    error = None
+    if response.get("ok"):
+        status = COMPLETED
+    else:
+        error = str(response.get("error"))
+        # Повтор с уже использованным spend_id: первый запрос мог пройти
+        status = REVIEW if "SPEND_ID" in error.upper() else REJECTED
+
+    claimed = (await session.execute(
+        pending.values(status=status, last_error=error, finished_at=now).returning(Withdrawal.id)
+    )).scalar_one_or_none()
+    if claimed is None:
+        return None
+
+    if status == REJECTED:
+        await post(session, withdrawal.user_id, withdrawal.amount_minor, WITHDRAWAL_REVERSAL, withdrawal.spend_id)
+        logger.warning("Вывод %s отклонен: %s", withdrawal.spend_id, error)
+    elif status == REVIEW:
+        logger.error("Вывод %s требует ручной проверки: %s", withdrawal.spend_id, error)
+    return status
+
+
+async def retry_withdrawals(batch_size: int = WITHDRAWAL_RETRY_BATCH) -> int:
+    """Повторяет выводы с неизвестным исходом; возвращает число завершенных"""
+    async with async_session() as session:
+        due = (await session.scalars(
+            select(Withdrawal)
+            .where(Withdrawal.status == PENDING, Withdrawal.next_attempt_at <= datetime.utcnow())
+            .order_by(Withdrawal.next_attempt_at)
+            .limit(batch_size)
+        )).all()
+
+    settled = 0
+    for withdrawal in due:
+        response = await send_transfer(withdrawal)
+        async with async_session() as session:
+            status = await settle_withdrawal(session, withdrawal, response)
+            amount = from_minor(withdrawal.amount_minor)
+            if status == COMPLETED:
+                enqueue(session, withdrawal.telegram_id, f"✅ Вывод {amount} USDT выполнен.")
+            elif status == REJECTED:
+                enqueue(session, withdrawal.telegram_id,
+                        f"❌ Вывод {amount} USDT не выполнен, средства возвращены на баланс.")
+            await session.commit()
+        if status not in (None, PENDING):
+            settled += 1
+    return settled
+
+
+async def retry_loop(interval: float = WITHDRAWAL_RETRY_INTERVAL):
+    """Периодический повтор выводов; запускается отдельной задачей"""
+    while True:
+        try:
+            settled = await retry_withdrawals()
+            if settled:
+                logger.info("Завершено выводов после повтора: %s", settled)
+        except Exception:
+            logger.exception("Повтор выводов завершился ошибкой")
+        await asyncio.sleep(interval)
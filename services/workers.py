@@ -0,0 +1,278 @@
+"""Обработка обновлений в нескольких процессах.
+
+Главный процесс (супервизор) получает обновления (long polling или вебхук) и
+раздает их WORKERS процессам по from_user.id, поэтому все обновления одного
+пользователя обрабатываются одним процессом и по порядку. Процессы работают с
+общей БД и общим файлом FSM. Каждый процесс периодически присылает
+статистику и снимок метрик обработчиков; сводка доступна по GET на
+WORKERS_STATS_PATH, сумма метрик - через metrics_snapshot (services/metrics.py).
+Упавший процесс перезапускается.
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+from aiohttp import web
+
+from config import (
+    WORKERS, WORKER_CONCURRENCY, WORKER_STATS_INTERVAL, WORKERS_STATS_PATH,
+    LISTING_INDEX_REFRESH, BOT_MODE, TELEGRAM_WEBHOOK_PATH
+)
+from services.metrics import registry, merge_snapshots
+from services.rate_limit import rate_limiter_stats
+from services.telegram_webhook import check_secret
+
+logger = logging.getLogger(__name__)
+
+WorkerSetup = Callable[[], Awaitable[Tuple[Bot, Dispatcher]]]
+
+
+def update_user_id(raw: dict) -> int:
+    """ID пользователя, от которого пришло обновление (0, если его нет)"""
+    for key, value in raw.items():
+        if key == "update_id" or not isinstance(value, dict):
+            continue
+        sender = value.get("from") or value.get("user") or value.get("chat")
+        if isinstance(sender, dict) and "id" in sender:
+            return sender["id"]
+        message = value.get("message")
+        if isinstance(message, dict) and "chat" in message:
+            return message["chat"]["id"]
+    return 0
+
+
+class _Worker:
+    """Обработка обновлений внутри процесса: последовательно для одного пользователя"""
+
+    def __init__(self, index: int, bot: Bot, dp: Dispatcher):
+        self.index = index
+        self.bot = bot
+        self.dp = dp
+        self.semaphore = asyncio.Semaphore(WORKER_CONCURRENCY)
+        # Блокировка пользователя и число его обновлений, ожидающих или обрабатываемых
+        self.user_locks: Dict[int, list] = {}
+        self.tasks = set()
+        self.pending = 0
+        self.in_flight = 0
+        self.processed = 0
+        self.failed = 0
+        self.started = time.monotonic()
+
+    async def handle(self, raw: dict):
+        user_id = update_user_id(raw)
+        entry = self.user_locks.setdefault(user_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        lock = entry[0]
+        try:
+            # Lock отдается ожидающим в порядке вызова, что сохраняет порядок обновлений пользователя
+            async with lock, self.semaphore:
+                self.pending -= 1
+                self.in_flight += 1
+                try:
+                    update = Update.model_validate(raw, context={"bot": self.bot})
+                    await self.dp.feed_update(self.bot, update)
+                    self.processed += 1
+                except Exception:
+                    self.failed += 1
+                    logger.exception("Процесс %s: ошибка обработки обновления %s",
+                                     self.index, raw.get("update_id"))
+                finally:
+                    self.in_flight -= 1
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.user_locks[user_id]
+
+    def submit(self, raw: dict):
+        self.pending += 1
+        task = asyncio.create_task(self.handle(raw))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def stats(self, backlog: int) -> dict:
+        return {
+            "worker": self.index,
+            "pid": os.getpid(),
+            "queue_depth": self.pending + backlog,
+            "in_flight": self.in_flight,
+            "processed": self.processed,
+            "failed": self.failed,
+            "telegram": rate_limiter_stats(self.bot),
+            "uptime": round(time.monotonic() - self.started, 1),
+            "reported_at": time.time(),
+            "metrics": registry.snapshot(),
+        }
+
+
+async def _run_worker(index: int, setup: WorkerSetup, updates, stats):
+    from database.db import read_session
+    from database.listing_index import listing_index
+
+    registry.worker = index
+    bot, dp = await setup()
+    worker = _Worker(index, bot, dp)
+    loop = asyncio.get_running_loop()
+
+    async def report():
+        while True:
+            try:
+                backlog = updates.qsize()
+            except NotImplementedError:
+                backlog = 0
+            stats.put(worker.stats(backlog))
+            await asyncio.sleep(WORKER_STATS_INTERVAL)
+
+    async def refresh_listings():
+        # Объявления создаются и покупаются в других процессах - перечитываем индекс
+        while True:
+            await asyncio.sleep(LISTING_INDEX_REFRESH)
+            try:
+                await listing_index.load(read_session)
+            except Exception:
+                logger.exception("Процесс %s: не удалось обновить индекс объявлений", index)
+
+    background = [asyncio.create_task(report())]
+    if LISTING_INDEX_REFRESH > 0:
+        background.append(asyncio.create_task(refresh_listings()))
+
+    try:
+        while True:
+            raw = await loop.run_in_executor(None, updates.get)
+            if raw is None:
+                break
+            worker.submit(raw)
+
+        if worker.tasks:
+            await asyncio.gather(*worker.tasks, return_exceptions=True)
+    finally:
+        for task in background:
+            task.cancel()
+        await dp.storage.close()
+        await bot.session.close()
+
+
+def _worker_process(index: int, setup: WorkerSetup, updates, stats):
+    logging.basicConfig(level=logging.INFO, format=f"[worker {index}] %(levelname)s:%(name)s:%(message)s")
+    asyncio.run(_run_worker(index, setup, updates, stats))
+
+
+class Supervisor:
+    def __init__(self, setup: WorkerSetup, workers: int = WORKERS, bot: Optional[Bot] = None):
+        self.setup = setup
+        # Бот супервизора: его запросы (рассылки, уведомления) тоже попадают в статистику
+        self.bot = bot
+        self.count = workers
+        self.context = multiprocessing.get_context("spawn")
+        self.stats_queue = self.context.Queue()
+        self.queues: List = []
+        self.processes: List[Optional[multiprocessing.Process]] = []
+        self.reports: Dict[int, dict] = {}
+        self.routed = 0
+        self.restarts = 0
+        self._monitor: Optional[asyncio.Task] = None
+
+    def _spawn(self, index: int):
+        process = self.context.Process(
+            target=_worker_process,
+            args=(index, self.setup, self.queues[index], self.stats_queue),
+            name=f"bot-worker-{index}",
+            daemon=True
+        )
+        process.start()
+        self.processes[index] = process
+
+    def start(self):
+        self.queues = [self.context.Queue() for _ in range(self.count)]
+        self.processes = [None] * self.count
+        for index in range(self.count):
+            self._spawn(index)
+        self._monitor = asyncio.create_task(self._monitor_loop())
+        logger.info("Запущено процессов-обработчиков: %s", self.count)
+
+    def route(self, raw: dict):
+        self.queues[update_user_id(raw) % self.count].put(raw)
+        self.routed += 1
+
+    async def _monitor_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                report = await loop.run_in_executor(None, self.stats_queue.get, True, WORKER_STATS_INTERVAL)
+                self.reports[report["worker"]] = report
+            except queue.Empty:
+                pass
+
+            for index, process in enumerate(self.processes):
+                if process is not None and not process.is_alive():
+                    logger.error("Процесс %s завершился с кодом %s, перезапуск", index, process.exitcode)
+                    self.restarts += 1
+                    self._spawn(index)
+
+    async def poll(self, bot: Bot, allowed_updates: List[str] = None):
+        """Long polling в супервизоре с раздачей обновлений процессам"""
+        offset = None
+        while True:
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=allowed_updates)
+            except Exception:
+                logger.exception("Ошибка получения обновлений")
+                await asyncio.sleep(1)
+                continue
+
+            for update in updates:
+                self.route(update.model_dump(mode="json", exclude_none=True))
+                offset = update.update_id + 1
+
+    def stats(self) -> dict:
+        now = time.time()
+        workers = []
+        for index, process in enumerate(self.processes):
+            report = dict(self.reports.get(index, {"worker": index}))
+            report.pop("metrics", None)
+            report["alive"] = bool(process and process.is_alive())
+            if "reported_at" in report:
+                report["report_age"] = round(now - report.pop("reported_at"), 1)
+            workers.append(report)
+        stats = {"workers": workers, "routed": self.routed, "restarts": self.restarts}
+        if self.bot is not None:
+            stats["telegram"] = rate_limiter_stats(self.bot)
+        return stats
+
+    def metrics_snapshot(self) -> dict:
+        """Метрики всех процессов на момент их последних отчетов и самого супервизора"""
+        snapshots = [report["metrics"] for report in self.reports.values() if "metrics" in report]
+        return merge_snapshots(snapshots + [registry.snapshot()])
+
+    def setup_web(self, app: web.Application):
+        async def handle_update(request: web.Request) -> web.Response:
+            if not check_secret(request):
+                return web.Response(status=401)
+            self.route(await request.json())
+            return web.Response()
+
+        async def handle_stats(request: web.Request) -> web.Response:
+            return web.json_response(self.stats())
+
+        if BOT_MODE == "webhook":
+            app.router.add_post(TELEGRAM_WEBHOOK_PATH, handle_update)
+        app.router.add_get(WORKERS_STATS_PATH, handle_stats)
+
+    async def stop(self, timeout: float = 10):
+        if self._monitor is not None:
+            self._monitor.cancel()
+        for worker_queue in self.queues:
+            worker_queue.put(None)
+
+        loop = asyncio.get_running_loop()
+        for process in self.processes:
+            if process is None:
+                continue
+            await loop.run_in_executor(None, process.join, timeout)
+            if process.is_alive():
+                process.terminate()